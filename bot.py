@@ -32,9 +32,12 @@ from telegram.error import BadRequest, RetryAfter
 from telegram.ext import filters, MessageHandler
 
 import database as db
-from config import TELEGRAM_BOT_TOKEN, ADMIN_USER_ID
-from pokemon_data import POKEMON_REGIONS, ALL_POKEMON, POKEMON_BY_ID, ALL_POKEMON_SPAWNABLE, ALL_POKEMON_PACKS, UNOWN_IDS
-from bot_utils import format_money, get_rarity, RARITY_VISUALS, DUPLICATE_MONEY_VALUES, get_formatted_name
+import sticker_assets
+from rate_limiter import PriorityRateLimiter, background_job, background_sends, fan_out
+from spawn_scheduler import SpawnScheduler
+from config import TELEGRAM_BOT_TOKEN, ADMIN_USER_ID, STICKER_STORAGE_CHAT_ID
+from pokemon_data import POKEMON_REGIONS, ALL_POKEMON, POKEMON_BY_ID, ALL_POKEMON_SPAWNABLE, ALL_POKEMON_PACKS, UNOWN_IDS, POKEMON_FORMS
+from bot_utils import format_money, get_rarity, RARITY_VISUALS, DUPLICATE_MONEY_VALUES, get_formatted_name, get_image_path, peek_content_hash
 from events import EVENTS, KANTO_EVENT_KEYS, JOHTO_EVENT_KEYS
 
 from flask import request, jsonify, make_response
@@ -100,15 +103,16 @@ def win_minigame():
 
         prize_name = SHOP_CONFIG[prize_id]['name']
 
+        # Guardamos la victoria en la BD ANTES de dar nada: si llegan dos peticiones a la vez, solo una entra
+        safe_name = first_name.replace('*', '').replace('_', '')
+        result_text = f"👤 {safe_name}: {prize_name} ✅"
+        if not db.update_minigame_winner(chat_id, msg_id, user_id, result_text):
+            return jsonify({"error": "already_played"}), 200
+
         # Entregamos premio
         db.get_or_create_user(user_id, first_name)
         db.add_item_to_inventory(user_id, prize_id, 1)
 
-        # Guardamos la victoria en la BD
-        safe_name = first_name.replace('*', '').replace('_', '')
-        result_text = f"👤 {safe_name}: {prize_name} ✅"
-        db.update_minigame_winner(chat_id, msg_id, user_id, result_text)
-
         updated_state = db.get_minigame(chat_id, msg_id)
 
         # Actualizamos el mensaje en Telegram
@@ -163,6 +167,8 @@ EVENT_CHANCE = 0.15
 DELIBIRD_STATE = {}
 MIN_SPAWN_TIME = 7200  # 2 horas
 MAX_SPAWN_TIME = 14400  # 4 horas
+SPAWN_TICK_SECONDS = 5  # Cada cuánto mira el planificador si a algún grupo le toca aparición
+SPAWN_SCHEDULER = SpawnScheduler(MIN_SPAWN_TIME, MAX_SPAWN_TIME)
 
 # --- JIRACHI ---
 JIRACHI_STATE = {}
@@ -441,49 +447,114 @@ for pokemon_item in ALL_POKEMON:
 POKEMON_PER_PAGE = 52
 PACK_OPEN_COOLDOWN = 30
 
-# --- SISTEMA DE FORMAS MULTIPLES (Hoenn) ---
-# Mapeo: Forma A (0,1), Forma B (2,3), Forma C (4,5), Forma D (6,7)
-POKEMON_FORMS = {
-    351: {0: ('A', 'Normal'), 2: ('B', 'Soleado'), 4: ('C', 'Lluvia'), 6: ('D', 'Nieve')},
-    352: {0: ('A', 'Normal'), 2: ('B', 'Camuflaje')},
-    386: {0: ('A', 'Normal'), 2: ('B', 'Ataque'), 4: ('C', 'Defensa'), 6: ('D', 'Velocidad')}
-}
-
-
 def get_form_offset(pokemon_id):
     """Devuelve un 'desplazamiento' aleatorio (0, 2, 4, 6) si el Pokémon tiene formas."""
     if pokemon_id in POKEMON_FORMS:
         return random.choice(list(POKEMON_FORMS[pokemon_id].keys()))
     return 0
 
-def get_image_path(pokemon_id, is_shiny_value, form=None):
-    """Genera la ruta de la imagen leyendo el valor exacto guardado (0 al 7) o la forma directamente."""
-    if pokemon_id > 20000:
-        region = "Unown"
-    elif pokemon_id > 251:
-        region = "Hoenn"
-    elif pokemon_id > 151:
-        region = "Johto"
-    else:
-        region = "Kanto"
 
-    is_true_shiny = (is_shiny_value % 2 != 0)  # Si es impar (1, 3, 5, 7) es Shiny
-    base_form_val = is_shiny_value - 1 if is_true_shiny else is_shiny_value
+# --- REGISTRO DE FILE_ID DE STICKERS ---
+# Cada imagen se sube a Telegram UNA vez: guardamos el file_id que nos devuelve (en memoria y en la BD)
+# y los siguientes envíos mandan solo ese identificador. La clave es la ruta + hash del contenido,
+# así una imagen retocada con el mismo nombre se vuelve a subir.
+STICKER_FILE_IDS = {}  # ruta -> (hash, file_id)
+# Respuestas de la Bot API cuando un file_id guardado ya no vale (solo entonces se vuelve a subir)
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference expired')
+_sticker_registry_loaded = False
+STICKER_MANIFEST = None  # Inventario de Stickers/ (se genera al arrancar, ver sticker_manifest_job)
 
-    shiny_str = 'Shiny/' if is_true_shiny else ''
-    s_suffix = 's' if is_true_shiny else ''
 
-    if pokemon_id in POKEMON_FORMS:
-        if form:
-            form_letter = form
-        else:
-            form_letter = POKEMON_FORMS[pokemon_id].get(base_form_val, ('A', ''))[0]
-        return f"Stickers/{region}/{shiny_str}{pokemon_id}{form_letter}{s_suffix}.png"
+async def load_sticker_file_ids():
+    global _sticker_registry_loaded
+    try:
+        STICKER_FILE_IDS.update(await db.aio.get_sticker_file_ids())
+        _sticker_registry_loaded = True
+    except Exception as e:
+        logger.error(f"No se pudo cargar el registro de file_id de stickers: {e}")
+
+
+async def remember_sticker_file_id(path, content_hash, file_id):
+    STICKER_FILE_IDS[path] = (content_hash, file_id)
+    try:
+        await db.aio.set_sticker_file_id(path, content_hash, file_id)
+    except Exception as e:
+        logger.error(f"No se pudo guardar el file_id de {path}: {e}")
+
+
+async def send_sticker_cached(bot, chat_id, image_path, **kwargs):
+    """
+    Igual que bot.send_sticker con el fichero abierto, pero reutiliza el file_id si esa imagen
+    ya se subió antes. Si Telegram rechaza el file_id guardado, sube el fichero y lo renueva.
+    """
+    if not _sticker_registry_loaded:
+        await load_sticker_file_ids()
+
+    # La primera vez hay que leer la imagen entera para el hash: eso va al executor, no al bucle del bot
+    content_hash = peek_content_hash(image_path)
+    if content_hash is None:
+        content_hash = await asyncio.get_running_loop().run_in_executor(None, sticker_assets.content_hash, image_path)
+
+    cached = STICKER_FILE_IDS.get(image_path)
+    if cached and cached[0] == content_hash:
+        try:
+            return await bot.send_sticker(chat_id=chat_id, sticker=cached[1], **kwargs)
+        except BadRequest as e:
+            # Solo los errores del propio file_id justifican volver a subir (no "chat not found", etc.)
+            if not any(text in str(e).lower() for text in STALE_FILE_ID_ERRORS):
+                raise
+            logger.warning(f"file_id caducado para {image_path}, se vuelve a subir: {e}")
+            STICKER_FILE_IDS.pop(image_path, None)
+
+    with open(image_path, 'rb') as sticker_file:
+        msg = await bot.send_sticker(chat_id=chat_id, sticker=sticker_file, **kwargs)
+    if msg and msg.sticker:
+        await remember_sticker_file_id(image_path, content_hash, msg.sticker.file_id)
+    return msg
+
+
+@background_job
+async def sticker_manifest_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Al arrancar: inventario de Stickers/ (avisa de las imágenes que faltan) y, si hay chat almacén
+    configurado, sube en segundo plano las que aún no tienen file_id. Así ningún spawn ni sobre
+    tiene que esperar a la primera subida de una imagen.
+    """
+    global STICKER_MANIFEST
+    loop = asyncio.get_running_loop()
+    STICKER_MANIFEST = await loop.run_in_executor(None, sticker_assets.build_manifest)
+    files, missing = STICKER_MANIFEST['files'], STICKER_MANIFEST['missing']
+    logger.info(f"🗂️ Stickers: {len(files)} imágenes, {len(missing)} faltan, {len(STICKER_MANIFEST['unused'])} sin usar.")
+    for path in missing:
+        logger.warning(f"❌ Falta la imagen del sticker: {path}")
+
+    if not STICKER_STORAGE_CHAT_ID:
+        return
 
-    return f"Stickers/{region}/{shiny_str}{pokemon_id}{s_suffix}.png"
+    if not _sticker_registry_loaded:
+        await load_sticker_file_ids()
+    # Se precalienta el fichero que se envía de verdad (la variante WebP si está generada);
+    # leer y hashear cientos de imágenes va al executor, no al bucle del bot
+    targets = await loop.run_in_executor(None, sticker_assets.sent_file_hashes, list(files))
+    pending = [path for path, content_hash in targets.items()
+               if STICKER_FILE_IDS.get(path, (None,))[0] != content_hash]
+    logger.info(f"📤 Precalentando {len(pending)} stickers en el chat almacén...")
+    # El ritmo lo marca el limitador de envíos (cubeta del chat almacén, prioridad de fondo)
+    for path in pending:
+        try:
+            await send_sticker_cached(context.bot, STICKER_STORAGE_CHAT_ID, path, disable_notification=True)
+        except Exception as e:
+            logger.error(f"No se pudo precalentar {path}: {e}")
+    logger.info("📤 Precalentamiento de stickers terminado.")
 
 # --- FUNCIONES AUXILIARES ---
 
+def combo_mails(user_ids, money, item_id, message):
+    """Correos de dinero + objeto para cada usuario (en ese orden), listos para db.add_mail_many."""
+    return [(uid, item_type, details, message) for uid in user_ids
+            for item_type, details in (('money', str(money)), ('inventory_item', item_id))]
+
+
 async def is_group_qualified(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     try:
         member = await context.bot.get_chat_member(chat_id, ADMIN_USER_ID)
@@ -501,8 +572,7 @@ async def check_and_unlock_johto(chat_id, context):
     """Verifica si el grupo ha alcanzado el 75% de Kanto y desbloquea Johto."""
     # Solo si no está desbloqueado ya
     if not db.is_event_completed(chat_id, 'amelia_johto_unlock'):
-        group_unique_kanto = db.get_group_unique_kanto_ids(chat_id)
-        if len(group_unique_kanto) >= 113:
+        if db.get_group_region_count(chat_id, 'kanto') >= 113:
             db.mark_event_completed(chat_id, 'amelia_johto_unlock')
 
             amelia_text = (
@@ -579,7 +649,7 @@ async def resolve_safari_catch_job(context: ContextTypes.DEFAULT_TYPE):
     user_mention = f'<a href="tg://user?id={user_id}">{first_name}</a>'
 
     db.get_or_create_user(user_id, first_name)
-    if chat_id in db.get_active_groups():
+    if db.is_group_active(chat_id):
         db.register_user_in_group(user_id, chat_id)
         db.add_pokemon_to_group_pokedex(chat_id, pokemon_id)
         db.increment_group_monthly_stickers(user_id, chat_id)
@@ -608,22 +678,16 @@ async def resolve_safari_catch_job(context: ContextTypes.DEFAULT_TYPE):
 
     # --- Premios Extra (Kanto, Johto, Unown) ---
     if not db.is_kanto_completed_by_user(user_id) and db.get_user_unique_kanto_count(user_id) >= 151:
-        db.set_kanto_completed_by_user(user_id)
-        db.update_money(user_id, 3000)
-        db.add_item_to_inventory(user_id, 'pack_shiny_kanto', 1)
-        reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+        if db.grant_album_reward(user_id, 'kanto', 3000, 'pack_shiny_kanto'):
+            reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
     if not db.is_johto_completed_by_user(user_id) and db.get_user_unique_johto_count(user_id) >= 100:
-        db.set_johto_completed_by_user(user_id)
-        db.update_money(user_id, 3000)
-        db.add_item_to_inventory(user_id, 'pack_shiny_johto', 1)
-        reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+        if db.grant_album_reward(user_id, 'johto', 3000, 'pack_shiny_johto'):
+            reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
     if not db.is_unown_completed_by_user(user_id) and db.get_user_unique_unown_count(user_id) >= 28:
-        db.set_unown_completed_by_user(user_id)
-        db.update_money(user_id, 2000)
-        db.add_item_to_inventory(user_id, 'pack_shiny_unown', 1)
-        reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+        if db.grant_album_reward(user_id, 'unown', 2000, 'pack_shiny_unown'):
+            reward_text += f"\n\n🎊 ¡Felicidades {user_mention}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
 
     # 6. Construir texto final
     final_text = (
@@ -653,8 +717,8 @@ async def claim_hoenn_starter_handler(update: Update, context: ContextTypes.DEFA
     user = query.from_user
     chat_id = query.message.chat.id
 
-    # 1. Comprobamos en la base de datos si ya ha pulsado el botón
-    if db.check_event_button_claim(chat_id, 'amelia_hoenn_unlock', user.id):
+    # 1. Registramos la pulsación en la base de datos; si ya estaba, es que ya lo había cogido
+    if not db.add_event_button_claim(chat_id, 'amelia_hoenn_unlock', user.id):
         return await query.answer("¡Ya has escaneado a tu inicial de Hoenn!", show_alert=True)
 
     # 2. Elegimos al inicial y tiramos los dados para shiny
@@ -665,8 +729,7 @@ async def claim_hoenn_starter_handler(update: Update, context: ContextTypes.DEFA
     is_shiny_val = 1 if is_shiny_bool else 0
     rarity = get_rarity('C', is_shiny_bool)  # Los tres son rareza C
 
-    # 4. Registramos en la base de datos que ya lo ha cogido
-    db.add_event_button_claim(chat_id, 'amelia_hoenn_unlock', user.id)
+    # 4. (Ya quedó registrado en el paso 1)
 
     # 5. Guardamos el sticker
     status = db.add_sticker_smart(user.id, pokemon_id, is_shiny_val)
@@ -682,31 +745,23 @@ async def claim_hoenn_starter_handler(update: Update, context: ContextTypes.DEFA
     premio_texto = ""
     # Kanto
     if not db.is_kanto_completed_by_user(user.id) and db.get_user_unique_kanto_count(user.id) >= 151:
-        db.set_kanto_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_kanto', 1)
-        premio_texto += "\n\n🎊 ¡Felicidades, has completado Kanto! 🎊"
+        if db.grant_album_reward(user.id, 'kanto', 3000, 'pack_shiny_kanto'):
+            premio_texto += "\n\n🎊 ¡Felicidades, has completado Kanto! 🎊"
 
     # Johto
     if not db.is_johto_completed_by_user(user.id) and db.get_user_unique_johto_count(user.id) >= 100:
-        db.set_johto_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_johto', 1)
-        premio_texto += "\n\n🎊 ¡Felicidades, has completado Johto! 🎊"
+        if db.grant_album_reward(user.id, 'johto', 3000, 'pack_shiny_johto'):
+            premio_texto += "\n\n🎊 ¡Felicidades, has completado Johto! 🎊"
 
     # Hoenn
     if not db.is_hoenn_completed_by_user(user.id) and db.get_user_unique_hoenn_count(user.id) >= 135:
-        db.set_hoenn_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_hoenn', 1)
-        premio_texto += "\n\n🎊 ¡Felicidades, has completado Hoenn! 🎊"
+        if db.grant_album_reward(user.id, 'hoenn', 3000, 'pack_shiny_hoenn'):
+            premio_texto += "\n\n🎊 ¡Felicidades, has completado Hoenn! 🎊"
 
     # Unown
     if not db.is_unown_completed_by_user(user.id) and db.get_user_unique_unown_count(user.id) >= 28:
-        db.set_unown_completed_by_user(user.id)
-        db.update_money(user.id, 2000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_unown', 1)
-        premio_texto += "\n\n🎊 ¡Felicidades, has completado el Álbum Unown! 🎊"
+        if db.grant_album_reward(user.id, 'unown', 2000, 'pack_shiny_unown'):
+            premio_texto += "\n\n🎊 ¡Felicidades, has completado el Álbum Unown! 🎊"
 
     # Si hay premios por completar álbum, se los enviamos en un mensaje privado o al grupo para que no rompa el pop-up
     if premio_texto:
@@ -788,8 +843,7 @@ async def check_and_unlock_regions(chat_id, context):
     """Verifica el progreso del grupo y va desbloqueando regiones."""
     # 1. DESBLOQUEO DE JOHTO (75% de Kanto = 113)
     if not db.is_event_completed(chat_id, 'amelia_johto_unlock'):
-        group_unique_kanto = db.get_group_unique_kanto_ids(chat_id)
-        if len(group_unique_kanto) >= 113:
+        if db.get_group_region_count(chat_id, 'kanto') >= 113:
             db.mark_event_completed(chat_id, 'amelia_johto_unlock')
 
             amelia_text = (
@@ -806,11 +860,7 @@ async def check_and_unlock_regions(chat_id, context):
     # 2. DESBLOQUEO DE HOENN (75% de Johto = 68 aprox, 91 * 0.75)
     # NOTA: Usamos 68 como el 75% del reto grupal de 91
     if not db.is_event_completed(chat_id, 'amelia_hoenn_unlock'):
-        raw_johto_ids = db.get_group_unique_johto_ids(chat_id)
-        excluded_johto = {172, 173, 174, 175, 201, 236, 238, 239, 240}
-        valid_johto_ids = [pid for pid in raw_johto_ids if pid not in excluded_johto]
-
-        if len(valid_johto_ids) >= 68:
+        if db.get_group_region_count(chat_id, 'johto') >= 68:
             db.mark_event_completed(chat_id, 'amelia_hoenn_unlock')
 
             amelia_text = (
@@ -863,6 +913,7 @@ def refresh_deletion_timer(context: ContextTypes.DEFAULT_TYPE, message: Message,
 
 
 # --- RANKING MENSUAL ---
+@background_job
 async def check_monthly_job(context: ContextTypes.DEFAULT_TYPE, force=False):
     """Tarea mensual: Ranking por grupo y reseteo."""
     now = datetime.now(TZ_SPAIN)
@@ -872,6 +923,7 @@ async def check_monthly_job(context: ContextTypes.DEFAULT_TYPE, force=False):
 
         groups_data = {}
         global_pack_winners = set()
+        prize_mails = []  # Se guardan todos de golpe al final
 
         # 1. Recopilar datos
         for chat_id in active_groups:
@@ -906,11 +958,11 @@ async def check_monthly_job(context: ContextTypes.DEFAULT_TYPE, force=False):
                             if len(pool) > 0:
                                 prize_item = pool.pop(0)
                                 p_name = "Sobre Grande" if 'large' in prize_item else "Sobre Mediano" if 'medium' in prize_item else "Sobre Pequeño"
-                                db.add_mail(uid, 'inventory_item', prize_item, f"🏆 Premio Ranking Grupo {chat_id}")
+                                prize_mails.append((uid, 'inventory_item', prize_item, f"🏆 Premio Ranking Grupo {chat_id}"))
                                 global_pack_winners.add(uid)
                                 prize_text = f"(+ {p_name} 🎴)"
                             else:
-                                db.add_mail(uid, 'money', '500', f"Premio Ranking Grupo {chat_id}")
+                                prize_mails.append((uid, 'money', '500', f"Premio Ranking Grupo {chat_id}"))
                                 prize_text = "(+500₽)"
 
                     medals = ["🥇", "🥈", "🥉"]
@@ -918,16 +970,20 @@ async def check_monthly_job(context: ContextTypes.DEFAULT_TYPE, force=False):
                     line = f"{visual_rank} {uname}: {count} stickers {prize_text}"
                     data['lines'].append(line)
 
+        # Todos los premios al buzón en una sola inserción masiva
+        db.add_mail_many(prize_mails)
+
         # 3. Envío y Guardado
         for chat_id, data in groups_data.items():
-            lines = data['lines']
-            if not lines: continue
+            if data['lines']:
+                # --- CORRECCIÓN: USAR VARIABLE GLOBAL ---
+                RANKING_ARCHIVE[chat_id] = data['lines']
+                # ----------------------------------------
 
-            # --- CORRECCIÓN: USAR VARIABLE GLOBAL ---
-            RANKING_ARCHIVE[chat_id] = lines
-            # ----------------------------------------
+        async def send_ranking(chat_id):
+            await send_ranking_page(context.bot, chat_id, RANKING_ARCHIVE[chat_id], 0)
 
-            await send_ranking_page(context.bot, chat_id, lines, 0)
+        await fan_out("ranking_mensual", [c for c, d in groups_data.items() if d['lines']], send_ranking)
 
         # 4. Reseteo
         db.reset_group_monthly_stickers()
@@ -1063,42 +1119,23 @@ async def albumdex_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         owner_user = interactor_user
         if update.message: cmd_msg_id = update.message.message_id
 
-    db.get_or_create_user(owner_user.id, owner_user.first_name)
+    await db.aio.get_or_create_user(owner_user.id, owner_user.first_name)
     if update.effective_chat.type in ['group', 'supergroup']:
-        db.register_user_in_group(owner_user.id, update.effective_chat.id)
-
-    user_collection = db.get_all_user_stickers(owner_user.id)
+        await db.aio.register_user_in_group(owner_user.id, update.effective_chat.id)
 
-    user_collection = db.get_all_user_stickers(owner_user.id)
+    # Todos los contadores salen del resumen de colección (una sola lectura por clave primaria)
+    summary = await db.aio.get_user_collection_summary(owner_user.id)
 
-    # --- 1. LÓGICA DE CONTEO NACIONAL ---
-    national_unique = set()  # Contará especies únicas (Normal o Shiny, da igual)
-    national_shiny = set()
-
-    for pid, is_shiny in user_collection:
-        mapped_id = 201 if pid in UNOWN_IDS else pid
-
-        # Lo añadimos a las especies únicas sí o sí
-        national_unique.add(mapped_id)
-
-        # Si es shiny, lo añadimos al contador de brillantes
-        if is_shiny == 1:
-            national_shiny.add(mapped_id)
-
-    owned_unique = len(national_unique)
-    owned_shiny = len(national_shiny)
+    # --- 1. CONTEO NACIONAL (especies únicas, Unown cuenta como #201) ---
+    owned_unique = summary['owned_unique']
+    owned_shiny = summary['owned_shiny']
 
     # Conteo específico de letras Unown
-    owned_unown = len({s[0] for s in user_collection if s[0] in UNOWN_IDS})
+    owned_unown = summary['owned_unown']
     total_pokemon_count = 386 # Base inamovible (Kanto 151 + Johto 100 + Hoenn 135)
 
     # --- 2. CONTEO DE RAREZAS ---
-    rarity_counts = {rarity: 0 for rarity in RARITY_VISUALS.keys()}
-    for pokemon_id, is_shiny in user_collection:
-        pokemon_data = POKEMON_BY_ID.get(pokemon_id)
-        if pokemon_data:
-            final_rarity = get_rarity(pokemon_data['category'], is_shiny)
-            if final_rarity in rarity_counts: rarity_counts[final_rarity] += 1
+    rarity_counts = {rarity: summary['rarity_counts'].get(rarity, 0) for rarity in RARITY_VISUALS.keys()}
 
     # --- 3. DISEÑO VISUAL ---
     rarity_lines = [f"{emoji}{rarity_counts[code]}" for code, emoji in RARITY_VISUALS.items()]
@@ -1381,9 +1418,7 @@ async def admin_ban_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         db.ban_group(target_chat_id)
 
         # 2. Detener procesos activos
-        jobs = context.job_queue.get_jobs_by_name(f"spawn_{target_chat_id}")
-        for job in jobs:
-            job.schedule_removal()
+        await SPAWN_SCHEDULER.cancel(target_chat_id)
 
         # 3. Confirmar
         await update.message.reply_text(f"🚫 Grupo `{target_chat_id}` ha sido **BANEADO** silenciosamente.",
@@ -1498,10 +1533,8 @@ async def admin_send_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE
 
             final_item = USER_FRIENDLY_ITEM_IDS.get(item, item)
 
-            for uid in group_users:
-                db.add_mail(uid, 'money', str(money), msg_text)
-                db.add_mail(uid, 'inventory_item', final_item, msg_text)
-                # Notificación (Opcional, copia el bloque try/except de send_to_all si quieres avisarles)
+            db.add_mail_many(combo_mails(group_users, money, final_item, msg_text))
+            # Notificación (Opcional, copia el bloque try/except de send_to_all si quieres avisarles)
 
         # ... (Puedes añadir lógica para 'money' o 'sticker' sueltos si quieres, siguiendo el patrón) ...
         # Para simplificar, este ejemplo asume que usarás mayormente 'combo' o 'inventory_item'
@@ -1519,8 +1552,7 @@ async def admin_send_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE
             if first_arg not in type_map and first_arg not in ITEM_NAMES and first_arg not in USER_FRIENDLY_ITEM_IDS and first_arg != 'pack_shiny_kanto':
                 return await update.message.reply_text("Tipo inválido.")
 
-            for uid in group_users:
-                db.add_mail(uid, db_type, item_val, msg_text)
+            db.add_mail_many((uid, db_type, item_val, msg_text) for uid in group_users)
 
         await update.message.reply_text(
             f"✅ Regalo enviado a los {len(group_users)} miembros del grupo `{target_chat_id}`.",
@@ -1913,12 +1945,12 @@ async def send_sticker_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             # Generamos la ruta usando la fábrica inteligente de rutas
             image_path = get_image_path(pokemon_id, is_shiny_val)
 
-            with open(image_path, 'rb') as sticker_file:
-                await context.bot.send_sticker(
-                    chat_id=message.chat_id,
-                    sticker=sticker_file,
-                    disable_notification=True
-                )
+            await send_sticker_cached(
+                context.bot,
+                message.chat_id,
+                image_path,
+                disable_notification=True
+            )
 
             await query.answer()
 
@@ -1929,11 +1961,8 @@ async def send_sticker_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.answer("¡Uy! No encuentro la imagen de ese sticker.", show_alert=True)
 
 
-async def refresh_codes_board(bot: Bot, chat_id: int):
-    """Actualiza el mensaje fijo de códigos (si existe)."""
-    board_msg_id = db.get_codes_board_msg(chat_id)
-    if not board_msg_id: return
-
+def build_codes_board_text():
+    """Texto del tablón de códigos (igual para todos los grupos). Borra antes los caducados."""
     db.delete_expired_codes()
     all_codes = db.get_all_friend_codes()
 
@@ -1959,6 +1988,16 @@ async def refresh_codes_board(bot: Bot, chat_id: int):
     text += "🔶*América:*\n" + ("\n".join(regions['América']) if regions['América'] else "_Vacío_") + "\n\n"
     text += "🔶*Asia:*\n" + ("\n".join(regions['Asia']) if regions['Asia'] else "_Vacío_") + "\n\n"
     text += "ℹ Para añadir tu código a la lista, escribe en este chat un mensaje con el siguiente formato:\n\n Nick Región Código\n\n • Ejemplo: Sixtomaru Europa 6T4A2944 \n\n _Para eliminar un código de la lista, escribe /borrarcodigo seguido del código a eliminar, por ejemplo: /borrarcodigo 6T4A2944_"
+    return text
+
+
+async def refresh_codes_board(bot: Bot, chat_id: int, text=None):
+    """Actualiza el mensaje fijo de códigos (si existe). `text` permite reutilizar uno ya generado."""
+    board_msg_id = db.get_codes_board_msg(chat_id)
+    if not board_msg_id: return
+
+    if text is None:
+        text = build_codes_board_text()
 
     keyboard = [
         [InlineKeyboardButton("🔄 Renovar Código", callback_data="codes_menu_renew")]
@@ -2189,9 +2228,8 @@ async def spawn_pokemon(context: ContextTypes.DEFAULT_TYPE):
                 # --- ENVÍO CON AGENTE DE RESCATE ---
                 try:
                     # 1. Enviar el Sticker
-                    with open(image_path, 'rb') as sticker_file:
-                        sticker_msg = await context.bot.send_sticker(chat_id=chat_id, sticker=sticker_file,
-                                                                     read_timeout=20, write_timeout=20)
+                    sticker_msg = await send_sticker_cached(context.bot, chat_id, image_path,
+                                                            read_timeout=20, write_timeout=20)
 
                     # Pausa mágica de 1 segundo para desatascar la red y crear tensión
                     await asyncio.sleep(1.0)
@@ -2247,14 +2285,19 @@ async def spawn_pokemon(context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"⚠️ Error crítico en el ciclo de spawn para el chat {chat_id}: {e}")
 
         finally:
-            # Reprogramar siempre el bucle infinito
+            # Reprogramar siempre el bucle infinito (la hora queda guardada en la BD)
             try:
-                if chat_id in db.get_active_groups():
-                    next_delay = random.randint(MIN_SPAWN_TIME, MAX_SPAWN_TIME)
-                    context.job_queue.run_once(spawn_pokemon, next_delay, chat_id=chat_id, name=f"spawn_{chat_id}")
-                    logger.info(f"Próximo spawn en chat {chat_id} en {next_delay} segundos.")
+                if db.is_group_active(chat_id):
+                    next_delay = await SPAWN_SCHEDULER.schedule(chat_id)
+                    logger.info(f"Próximo spawn en chat {chat_id} en {next_delay:.0f} segundos.")
+                else:
+                    await SPAWN_SCHEDULER.cancel(chat_id)
             except Exception as e:
-                logger.error(f"Error crítico reprogramando spawn: {e}")
+                # Sin BD seguimos en memoria: el grupo no puede quedarse sin apariciones por un fallo puntual
+                # (si el fallo fue al guardar, schedule ya lo dejó en el heap)
+                if SPAWN_SCHEDULER.is_running(chat_id):
+                    SPAWN_SCHEDULER.reschedule_in_memory(chat_id)
+                logger.error(f"Error crítico reprogramando spawn (sigue programado en memoria): {e}")
 
 
 # --- COMANDO SECRETO PARA EL ADMIN: FORZAR APARICIÓN ---
@@ -2281,8 +2324,7 @@ async def force_spawn_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         image_path = get_image_path(pokemon_data['id'], is_shiny_val)
 
         try:
-            with open(image_path, 'rb') as sticker_file:
-                sticker_msg = await context.bot.send_sticker(chat_id=chat_id, sticker=sticker_file)
+            sticker_msg = await send_sticker_cached(context.bot, chat_id, image_path)
 
             # Micro-pausa de seguridad para no saturar la red y dar holgura a Render
             await asyncio.sleep(0.5)
@@ -2448,13 +2490,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         schedule_jirachi_for_group(chat.id, context.application)
         db.set_group_active(chat.id, True)
 
-        current_jobs = context.job_queue.get_jobs_by_name(f"spawn_{chat.id}")
-        if not current_jobs:
-            initial_delay = random.randint(MIN_SPAWN_TIME, MAX_SPAWN_TIME)
-            context.job_queue.run_once(spawn_pokemon, initial_delay, chat_id=chat.id, name=f"spawn_{chat.id}")
+        if not SPAWN_SCHEDULER.is_scheduled(chat.id):
+            initial_delay = await SPAWN_SCHEDULER.schedule(chat.id)
             msg = await update.message.reply_text("✅ Aparición de Pokémon salvajes activada.",
                                                   disable_notification=True)
-            logger.info(f"Juego iniciado en {chat.id}. Spawn inicial en {initial_delay}s.")
+            logger.info(f"Juego iniciado en {chat.id}. Spawn inicial en {initial_delay:.0f}s.")
         else:
             msg = await update.message.reply_text("El bot ya está en funcionamiento.", disable_notification=True)
 
@@ -2482,16 +2522,14 @@ async def stop_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Este comando solo puede ser usado por administradores.", disable_notification=True)
         return
 
-    jobs = context.job_queue.get_jobs_by_name(f"spawn_{chat.id}")
-    if not jobs:
+    if not SPAWN_SCHEDULER.is_scheduled(chat.id):
         msg = await update.message.reply_text("El juego ya está detenido.", disable_notification=True)
         schedule_message_deletion(context, update.message, 5)
         schedule_message_deletion(context, msg, 30)
         return
-    for job in jobs:
-        job.schedule_removal()
 
     db.set_group_active(chat.id, False)
+    await SPAWN_SCHEDULER.cancel(chat.id)
     msg = await update.message.reply_text("❌ La aparición de Pokémon salvajes se ha desactivado.", disable_notification=True)
     schedule_message_deletion(context, update.message, 5)
     schedule_message_deletion(context, msg, 30)
@@ -2721,10 +2759,10 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     user = query.from_user
-    db.get_or_create_user(user.id, user.first_name)
+    await db.aio.get_or_create_user(user.id, user.first_name)
 
     if message.chat.type in ['group', 'supergroup']:
-        db.register_user_in_group(user.id, message.chat.id)
+        await db.aio.register_user_in_group(user.id, message.chat.id)
 
     try:
         _, _, pokemon_id_str, is_shiny_str, rarity = query.data.split('_')
@@ -2734,13 +2772,6 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.answer()
         return
 
-    # BUSCAMOS EL POKÉMON EN LA BASE DE DATOS PERSISTENTE (Supabase)
-    spawn_data = db.get_active_spawn(msg_id)
-
-    if not spawn_data:
-        await query.answer("¡Alguien ha sido más rápido que tú! 💨", show_alert=True)
-        return
-
     # Gestionamos los enfriamientos en RAM (solo duran 30s)
     context.chat_data.setdefault('spawn_cooldowns', {})
     if msg_id not in context.chat_data['spawn_cooldowns']:
@@ -2752,19 +2783,31 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     cooldown_duration = 30
     if current_time - last_attempt_time < cooldown_duration:
+        # Si ya lo atrapó otro, eso es lo que hay que decir, no el enfriamiento
+        if not await db.aio.get_active_spawn(msg_id):
+            await query.answer("¡Alguien ha sido más rápido que tú! 💨", show_alert=True)
+            return
         time_left = math.ceil(cooldown_duration - (current_time - last_attempt_time))
         await query.answer(
             f"Espera unos {time_left} segundos a que se recargue la energía del Álbumdex antes de intentarlo de nuevo.",
             show_alert=True)
         return
 
-    current_chance = db.get_user_capture_chance(user.id)
+    current_chance = await db.aio.get_user_capture_chance(user.id)
+    is_captured = random.randint(1, 100) <= current_chance
+
+    # BUSCAMOS EL POKÉMON EN LA BASE DE DATOS PERSISTENTE (Supabase)
+    # Si la foto sale bien, lo reclamamos y borramos en una sola sentencia: solo un jugador puede ganarlo
+    # (si no devuelve nada, otro llegó antes)
+    if is_captured:
+        spawn_data = await db.aio.claim_active_spawn(msg_id)
+        if not spawn_data:
+            await query.answer("¡Alguien ha sido más rápido que tú! 💨", show_alert=True)
+            return
 
-    if random.randint(1, 100) <= current_chance:
         # --- ¡ATRAPADO EXITOSAMENTE! ---
 
-        # 1. Lo borramos de la base de datos para que nadie más pueda cogerlo
-        db.remove_active_spawn(msg_id)
+        # 1. Ya no está en la base de datos: nadie más puede cogerlo
 
         # 2. EL TRUCO DEL CAMARERO: Respondemos a Telegram AL INSTANTE para evitar el error "Query too old"
         try:
@@ -2774,11 +2817,11 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # 3. Cálculos matemáticos con calma
         new_chance = max(80, current_chance - 5)
-        db.update_user_capture_chance(user.id, new_chance)
+        await db.aio.update_user_capture_chance(user.id, new_chance)
 
         # 4. Sumar al ranking local (Puntos para el grupo)
         if message.chat.type in ['group', 'supergroup']:
-            db.increment_group_monthly_stickers(user.id, message.chat.id)
+            await db.aio.increment_group_monthly_stickers(user.id, message.chat.id)
 
         # 5. Borramos los mensajes en Telegram (Sticker y Texto)
         try:
@@ -2801,7 +2844,7 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         user_link = user.mention_html()
 
         # 6. LÓGICA SMART (Añadir a la colección)
-        status = db.add_sticker_smart(user.id, pokemon_id, is_shiny)
+        status = await db.aio.add_sticker_smart(user.id, pokemon_id, is_shiny)
         message_text = ""
 
         if status == 'NEW':
@@ -2810,39 +2853,33 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             message_text = f"♻ ¡Genial, {user_link}! Conseguiste un sticker de {pokemon_display} {rarity_emoji}. Como solo tenías 1, te lo guardas para intercambiarlo."
         else:
             money_earned = DUPLICATE_MONEY_VALUES.get(rarity, 100)
-            db.update_money(user.id, money_earned)
+            await db.aio.update_money(user.id, money_earned)
             message_text = f"✔️ ¡Genial, {user_link}! Conseguiste un sticker de {pokemon_display} {rarity_emoji}. Como ya lo tienes repetido, se convierte en <b>{format_money(money_earned)}₽</b> 💰."
 
         # 7. RETO GRUPAL & DESBLOQUEO JOHTO
         if message.chat.type in ['group', 'supergroup']:
-            db.add_pokemon_to_group_pokedex(message.chat.id, pokemon_id)
+            await db.aio.add_pokemon_to_group_pokedex(message.chat.id, pokemon_id)
             await check_and_unlock_regions(message.chat.id, context)
 
         # 8. PREMIOS INDIVIDUALES (Álbumes completos)
 
         # Kanto (151)
-        if not db.is_kanto_completed_by_user(user.id):
-            if db.get_user_unique_kanto_count(user.id) >= 151:
-                db.set_kanto_completed_by_user(user.id)
-                db.update_money(user.id, 3000)
-                db.add_item_to_inventory(user.id, 'pack_shiny_kanto', 1)
-                message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+        if not await db.aio.is_kanto_completed_by_user(user.id):
+            if await db.aio.get_user_unique_kanto_count(user.id) >= 151:
+                if await db.aio.grant_album_reward(user.id, 'kanto', 3000, 'pack_shiny_kanto'):
+                    message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
         # Johto (100)
-        if not db.is_johto_completed_by_user(user.id):
-            if db.get_user_unique_johto_count(user.id) >= 100:
-                db.set_johto_completed_by_user(user.id)
-                db.update_money(user.id, 3000)
-                db.add_item_to_inventory(user.id, 'pack_shiny_johto', 1)
-                message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+        if not await db.aio.is_johto_completed_by_user(user.id):
+            if await db.aio.get_user_unique_johto_count(user.id) >= 100:
+                if await db.aio.grant_album_reward(user.id, 'johto', 3000, 'pack_shiny_johto'):
+                    message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
         # Unown (28)
-        if not db.is_unown_completed_by_user(user.id):
-            if db.get_user_unique_unown_count(user.id) >= 28:
-                db.set_unown_completed_by_user(user.id)
-                db.update_money(user.id, 2000)
-                db.add_item_to_inventory(user.id, 'pack_shiny_unown', 1)
-                message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+        if not await db.aio.is_unown_completed_by_user(user.id):
+            if await db.aio.get_user_unique_unown_count(user.id) >= 28:
+                if await db.aio.grant_album_reward(user.id, 'unown', 2000, 'pack_shiny_unown'):
+                    message_text += f"\n\n🎊 ¡Felicidades {user_link}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
 
         # 9. PREMIOS RETOS GRUPALES
         is_qualified = await is_group_qualified(message.chat.id, context)
@@ -2850,54 +2887,38 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
         if message.chat.type in ['group', 'supergroup']:
             # 1. RETO KANTO (151)
-            if not db.is_event_completed(chat_id, 'kanto_group_challenge'):
-                group_unique_ids = db.get_group_unique_kanto_ids(chat_id)
-                if len(group_unique_ids) >= 151:
-                    db.mark_event_completed(chat_id, 'kanto_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'kanto_group_challenge'):
+                if await db.aio.get_group_region_count(chat_id, 'kanto') >= 151:
+                    await db.aio.mark_event_completed(chat_id, 'kanto_group_challenge')
                     if is_qualified:
-                        group_users = db.get_users_in_group(chat_id)
-                        for uid in group_users:
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Kanto")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_kanto', "Premio Reto Grupal: Kanto")
+                        group_users = await db.aio.get_users_in_group(chat_id)
+                        await db.aio.add_mail_many(
+                            combo_mails(group_users, 2000, 'pack_shiny_kanto', "Premio Reto Grupal: Kanto"))
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Kanto en su buzón."
                     else:
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>!"
 
             # 2. RETO JOHTO (91)
-            excluded_johto = {172, 173, 174, 175, 201, 236, 238, 239, 240}
-            if not db.is_event_completed(chat_id, 'johto_group_challenge'):
-                raw_johto_ids = db.get_group_unique_johto_ids(chat_id)
-                valid_johto_ids = [pid for pid in raw_johto_ids if pid not in excluded_johto]
-                if len(valid_johto_ids) >= 91:
-                    db.mark_event_completed(chat_id, 'johto_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'johto_group_challenge'):
+                if await db.aio.get_group_region_count(chat_id, 'johto') >= 91:
+                    await db.aio.mark_event_completed(chat_id, 'johto_group_challenge')
                     if is_qualified:
-                        group_users = db.get_users_in_group(chat_id)
-                        for uid in group_users:
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Johto")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_johto', "Premio Reto Grupal: Johto")
+                        group_users = await db.aio.get_users_in_group(chat_id)
+                        await db.aio.add_mail_many(
+                            combo_mails(group_users, 2000, 'pack_shiny_johto', "Premio Reto Grupal: Johto"))
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Johto en su buzón."
                     else:
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>!"
 
             # 3. RETO HOENN (133)
-            excluded_hoenn = {298, 360}
-            if not db.is_event_completed(chat_id, 'hoenn_group_challenge'):
-                # Usamos una query directa para ser más eficientes
-                raw_hoenn_ids = db.query_db(
-                    'SELECT pokemon_id FROM group_pokedex WHERE chat_id = %s AND pokemon_id >= 252 AND pokemon_id <= 386',
-                    (chat_id,))
-                group_ids_hoenn = {row[0] for row in raw_hoenn_ids} if raw_hoenn_ids else set()
-
-                valid_hoenn_ids = [pid for pid in group_ids_hoenn if pid not in excluded_hoenn]
-
-                if len(valid_hoenn_ids) >= 133:
-                    db.mark_event_completed(chat_id, 'hoenn_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'hoenn_group_challenge'):
+                # Progreso sacado de la Pokédex grupal en memoria (sin Azurill ni Wynaut)
+                if await db.aio.get_group_region_count(chat_id, 'hoenn') >= 133:
+                    await db.aio.mark_event_completed(chat_id, 'hoenn_group_challenge')
                     if is_qualified:
-                        group_users = db.get_users_in_group(chat_id)
-                        for uid in group_users:
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Hoenn")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_hoenn',
-                                        "Premio Reto Grupal: Hoenn")
+                        group_users = await db.aio.get_users_in_group(chat_id)
+                        await db.aio.add_mail_many(
+                            combo_mails(group_users, 2000, 'pack_shiny_hoenn', "Premio Reto Grupal: Hoenn"))
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Hoenn en su buzón."
                     else:
                         message_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>!"
@@ -2907,13 +2928,18 @@ async def claim_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     else:
         # --- FALLO AL INTENTAR CAPTURAR (Foto Movida) ---
+        # Si ya no está, lo que toca decir es que otro fue más rápido (sin tocar la probabilidad)
+        if not await db.aio.get_active_spawn(msg_id):
+            await query.answer("¡Alguien ha sido más rápido que tú! 💨", show_alert=True)
+            return
+
         try:
             await query.answer()
         except Exception:
             pass  # Si falla por latencia de red, lo ignoramos
 
         new_chance = min(100, current_chance + 5)
-        db.update_user_capture_chance(user.id, new_chance)
+        await db.aio.update_user_capture_chance(user.id, new_chance)
 
         # Aplicamos el cooldown por fallar
         context.chat_data['spawn_cooldowns'][msg_id][user.id] = current_time
@@ -3157,19 +3183,12 @@ async def safari_hunt_btn_handler(update: Update, context: ContextTypes.DEFAULT_
     if not state:
         return await query.answer("Este Pokémon ya ha huido o el evento ha caducado.", show_alert=True)
 
-    if any(p['id'] == user.id for p in state['participants']):
+    # Apuntamos al jugador (una sola inserción; si ya estaba, no entra)
+    if not db.add_safari_participant(msg_id, user.id, user.first_name):
         return await query.answer("La energía del Álbumdex se agotó.", show_alert=True)
 
-    # Apuntamos al jugador
-    state['participants'].append({
-        'id': user.id,
-        'first_name': user.first_name
-    })
-
-    # Si es el primero, arrancamos el reloj
-    job_started = state['job_started']
-    if not job_started:
-        job_started = True
+    # Si es el primero, arrancamos el reloj (solo uno consigue marcarlo aunque pulsen a la vez)
+    if not state['job_started'] and db.mark_safari_job_started(msg_id):
         context.job_queue.run_once(
             resolve_safari_catch_job,
             60,
@@ -3186,8 +3205,6 @@ async def safari_hunt_btn_handler(update: Update, context: ContextTypes.DEFAULT_
             name=f"safari_resolve_{chat_id}_{msg_id}"
         )
 
-    # GUARDAMOS LOS CAMBIOS EN SUPABASE
-    db.update_safari_participants(msg_id, state['participants'], job_started)
     await query.answer("¡Tomaste una foto!", show_alert=True)
 
 
@@ -3312,7 +3329,7 @@ async def claim_mail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     try:
         _, mail_id_str, owner_id_str = query.data.split('_')
-        mail_id, owner_id = int(mail_id_str), int(owner_id_str)
+        mail_id, owner_id = db.parse_mail_id(mail_id_str), int(owner_id_str)
         if interactor_user.id != owner_id:
             await query.answer("Este regalo no es para ti.", show_alert=True)
             return
@@ -3320,12 +3337,14 @@ async def claim_mail_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("Error en el botón de reclamar.", show_alert=True)
         return
 
-    mail_item = db.get_mail_item_by_id(mail_id)
+    mail_item = db.get_mail_item_by_id(mail_id, owner_id)
     if not mail_item or mail_item['claimed'] or mail_item['recipient_user_id'] != owner_id:
         await query.answer("Este regalo no es para ti o ya ha sido reclamado.", show_alert=True)
         return
 
-    db.claim_mail_item(mail_id)
+    if not db.claim_mail_item(mail_id, owner_id):
+        await query.answer("Este regalo ya ha sido reclamado.", show_alert=True)
+        return
     user = interactor_user
     item_type, item_details = mail_item['item_type'], mail_item['item_details']
     user_mention = user.mention_markdown()
@@ -3392,58 +3411,31 @@ async def claim_all_mail_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("Error en el botón.", show_alert=True)
         return
 
-    # 1. Recuperamos todos los correos sin leer
-    mails = db.get_user_mail(owner_id)
-    if not mails:
+    # 1. Todo el buzón de golpe: marcado, objetos y dinero en un número fijo de consultas
+    summary = await db.aio.claim_all_mail(owner_id)
+    if not summary['claimed']:
         await query.answer("Tu buzón ya está vacío.", show_alert=True)
         return await buzon(update, context)
 
-    total_money = 0
+    total_money = summary['money']
     items_collected = {}  # Para agrupar los sobres iguales (Ej: 3 Sobre Grande Nacional)
-    stickers_collected = []  # Para listar los Pokémon sueltos
-
-    # 2. Procesamos cada correo
-    for mail in mails:
-        mail_id = mail['mail_id']
-        item_type = mail['item_type']
-        item_details = mail['item_details']
-
-        # Marcamos como leído en la base de datos
-        db.claim_mail_item(mail_id)
-
-        if item_type == 'money':
-            total_money += int(item_details)
-
-        elif item_type == 'inventory_item':
-            db.add_item_to_inventory(owner_id, item_details, 1)
-            item_name = ITEM_NAMES.get(item_details, "Objeto Desconocido")
-            items_collected[item_name] = items_collected.get(item_name, 0) + 1
-
-        elif item_type == 'single_sticker':
-            poke_id, is_shiny_int = map(int, item_details.split('_'))
-            is_shiny = is_shiny_int
-            pokemon_data = POKEMON_BY_ID.get(poke_id)
-
-            if pokemon_data:
-                p_display = get_formatted_name(pokemon_data, is_shiny)
-                rarity = get_rarity(pokemon_data['category'], is_shiny)
-                r_emoji = RARITY_VISUALS.get(rarity, '')
-
-                status = db.add_sticker_smart(owner_id, poke_id, is_shiny)
-                if status == 'NEW':
-                    stickers_collected.append(f"🔸 🆕 {p_display} {r_emoji}")
-                elif status == 'DUPLICATE':
-                    stickers_collected.append(f"🔸 ♻️ {p_display} {r_emoji}")
-                else:
-                    money = DUPLICATE_MONEY_VALUES.get(rarity, 100)
-                    total_money += money
-                    stickers_collected.append(f"🔸 ✔️ {p_display} {r_emoji} (+{format_money(money)}₽)")
+    for item_id, qty in summary['items'].items():
+        item_name = ITEM_NAMES.get(item_id, "Objeto Desconocido")
+        items_collected[item_name] = items_collected.get(item_name, 0) + qty
 
-    # 3. Dar el dinero total acumulado (si hay)
-    if total_money > 0:
-        db.update_money(owner_id, total_money)
+    stickers_collected = []  # Para listar los Pokémon sueltos
+    for poke_id, is_shiny, status, money in summary['stickers']:
+        pokemon_data = POKEMON_BY_ID[poke_id]
+        p_display = get_formatted_name(pokemon_data, is_shiny)
+        r_emoji = RARITY_VISUALS.get(get_rarity(pokemon_data['category'], is_shiny), '')
+        if status == 'NEW':
+            stickers_collected.append(f"🔸 🆕 {p_display} {r_emoji}")
+        elif status == 'DUPLICATE':
+            stickers_collected.append(f"🔸 ♻️ {p_display} {r_emoji}")
+        else:
+            stickers_collected.append(f"🔸 ✔️ {p_display} {r_emoji} (+{format_money(money)}₽)")
 
-    # 4. Construir el Mensaje de Resumen
+    # 2. Construir el Mensaje de Resumen
     summary_text = f"📦 **¡Buzón Vaciado!**\n{interactor_user.mention_markdown()} ha recogido:\n\n"
 
     if items_collected:
@@ -3456,7 +3448,7 @@ async def claim_all_mail_handler(update: Update, context: ContextTypes.DEFAULT_T
     if total_money > 0:
         summary_text += f"\n💰 **Dinero total recogido:** {format_money(total_money)}₽"
 
-    # 5. Enviar mensaje y recargar buzón
+    # 3. Enviar mensaje y recargar buzón
     await context.bot.send_message(chat_id=query.message.chat_id, text=summary_text, parse_mode='Markdown')
     await buzon(update, context)
 
@@ -3507,7 +3499,7 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = update.effective_message
         chat_id = message.chat_id
 
-        db.get_or_create_user(interactor_user.id, interactor_user.first_name)
+        await db.aio.get_or_create_user(interactor_user.id, interactor_user.first_name)
 
         is_public = (query.data == "tombola_claim_public")
         is_panel = (query.data == "panel_tombola")
@@ -3528,7 +3520,7 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Verificar si ya jugó hoy
         today_str = datetime.now(TZ_SPAIN).strftime('%Y-%m-%d')
-        if db.get_last_daily_claim(owner_id) == today_str:
+        if await db.aio.get_last_daily_claim(owner_id) == today_str:
             await query.answer("⏳ Ya has probado suerte hoy. ¡Vuelve mañana!", show_alert=True)
             if not is_public and not is_panel:
                 try:
@@ -3539,7 +3531,7 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Dar premio
-        db.update_last_daily_claim(owner_id, today_str)
+        await db.aio.update_last_daily_claim(owner_id, today_str)
         prize = random.choices(DAILY_PRIZES, weights=DAILY_WEIGHTS, k=1)[0]
 
         # Sanitizar nombre (Evita que nombres con símbolos rompan el Markdown de Telegram)
@@ -3548,20 +3540,19 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
         alert_text = ""
 
         if prize['type'] == 'money':
-            db.update_money(owner_id, prize['value'])
+            await db.aio.update_money(owner_id, prize['value'])
             list_line = f"- {safe_name}: {prize['emoji']} {prize['value']}₽"
             alert_text = f"¡{prize['emoji']} Has ganado {prize['value']}₽!"
         else:
-            db.add_item_to_inventory(owner_id, prize['value'], 1)
+            await db.aio.add_item_to_inventory(owner_id, prize['value'], 1)
             list_line = f"- {safe_name}: {prize['emoji']} Sobre Mágico"
             alert_text = f"¡{prize['emoji']} PREMIO GORDO! Un Sobre Mágico."
 
         # --- ACTUALIZAR LISTA USANDO SUPABASE ---
-        state = db.get_tombola_state(chat_id)
+        await db.aio.add_tombola_winner(chat_id, owner_id, list_line)
+        state = await db.aio.get_tombola_state(chat_id)
         if not state:
-            state = {'msg_id': None, 'winners': []}
-
-        state['winners'].append(list_line)
+            state = {'msg_id': None, 'winners': [list_line]}
 
         base_header = (
             "🎟️ *Tómbola Diaria* 🎟️\n\n"
@@ -3582,7 +3573,7 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown',
                     read_timeout=20, write_timeout=20
                 )
-                db.set_tombola_state(chat_id, daily_msg_id, state['winners'])
+                await db.aio.set_tombola_state(chat_id, daily_msg_id)
                 msg_updated = True
             except BadRequest:
                 pass  # Si el mensaje se borró, forzamos crear uno nuevo
@@ -3596,7 +3587,7 @@ async def tombola_claim(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown',
                 disable_notification=True, read_timeout=20, write_timeout=20
             )
-            db.set_tombola_state(chat_id, msg.message_id, state['winners'])
+            await db.aio.set_tombola_state(chat_id, msg.message_id)
 
         # Limpieza de comandos privados
         if not is_public and not is_panel:
@@ -4083,6 +4074,7 @@ async def egg_check_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer(text, show_alert=True)
 
 
+@background_job
 async def egg_hatch_job(context: ContextTypes.DEFAULT_TYPE):
     """Revisa huevos listos para abrirse."""
     current_time = time.time()
@@ -4134,25 +4126,19 @@ async def egg_hatch_job(context: ContextTypes.DEFAULT_TYPE):
 
         if not db.is_kanto_completed_by_user(user_id):
             if db.get_user_unique_kanto_count(user_id) >= 151:
-                db.set_kanto_completed_by_user(user_id)
-                db.update_money(user_id, 3000)
-                db.add_item_to_inventory(user_id, 'pack_shiny_kanto', 1)
-                premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+                if db.grant_album_reward(user_id, 'kanto', 3000, 'pack_shiny_kanto'):
+                    premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
         if not db.is_johto_completed_by_user(user_id):
             if db.get_user_unique_johto_count(user_id) >= 100:
-                db.set_johto_completed_by_user(user_id)
-                db.update_money(user_id, 3000)
-                db.add_item_to_inventory(user_id, 'pack_shiny_johto', 1)
-                premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+                if db.grant_album_reward(user_id, 'johto', 3000, 'pack_shiny_johto'):
+                    premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
                 # Hoenn (¡AÑADIMOS ESTE BLOQUE AHORA!)
         if not db.is_hoenn_completed_by_user(user_id):
             if db.get_user_unique_hoenn_count(user_id) >= 135:
-                db.set_hoenn_completed_by_user(user_id)
-                db.update_money(user_id, 3000)
-                db.add_item_to_inventory(user_id, 'pack_shiny_hoenn', 1)
-                premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
+                if db.grant_album_reward(user_id, 'hoenn', 3000, 'pack_shiny_hoenn'):
+                    premios_extra += f"\n\n🎊 ¡Felicidades {user_mention}, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
 
         # -----------------------------------
 
@@ -4170,8 +4156,7 @@ async def egg_hatch_job(context: ContextTypes.DEFAULT_TYPE):
             # Ruta de imagen dinámica
             path = get_image_path(pokemon_id, is_shiny)
 
-            with open(path, 'rb') as f:
-                await context.bot.send_sticker(chat_id=user_id, sticker=f)
+            await send_sticker_cached(context.bot, user_id, path)
 
             # --- AÑADIMOS EL BOTÓN AQUÍ ---
             keyboard = [[InlineKeyboardButton("Recibir otro 🥚", callback_data=f"egg_claim_{user_id}")]]
@@ -4235,7 +4220,7 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("⏳ Alguien ya está abriendo un sobre. Por favor, espera a que termine.", show_alert=True)
         return
 
-    if not any(i['item_id'] == item_id and i['quantity'] > 0 for i in db.get_user_inventory(user.id)):
+    if not any(i['item_id'] == item_id and i['quantity'] > 0 for i in await db.aio.get_user_inventory(user.id)):
         await query.answer("¡No tienes este sobre!", show_alert=True)
         await message.delete()
         return
@@ -4243,7 +4228,7 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         context.chat_data['is_opening_pack'] = True
         await message.delete()
-        db.remove_item_from_inventory(user.id, item_id, 1)
+        await db.aio.remove_item_from_inventory(user.id, item_id, 1)
 
         pack_config = SHOP_CONFIG.get(item_id, {})
         pack_size = pack_config.get('size', 1)
@@ -4294,7 +4279,7 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 base_pool = ALL_POKEMON_PACKS
 
             if is_magic:
-                user_quantities = db.get_user_collection_quantities(user.id)
+                user_quantities = await db.aio.get_user_collection_quantities(user.id)
                 for _ in range(pack_size):
                     missing_shinies = []
                     for p in base_pool:
@@ -4420,7 +4405,7 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 from pokemon_data import POKEMON_UNOWN
                 base_pool = POKEMON_UNOWN
 
-            user_quantities = db.get_user_collection_quantities(user.id)
+            user_quantities = await db.aio.get_user_collection_quantities(user.id)
 
             for _ in range(pack_size):
                 is_shiny_bool = random.random() < SHINY_CHANCE
@@ -4505,17 +4490,26 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # --- EVALUAR LOS RESULTADOS DEL SOBRE ACTUAL ---
         summary_parts = []
+        money_total = 0
 
-        for result in pack_results:
+        # Entregamos todo el sobre de golpe (estados en el mismo orden que las cartas)
+        statuses = await db.aio.grant_stickers_bulk(user.id, [(r['data']['id'], r['is_shiny']) for r in pack_results])
+
+        if message.chat.type in ['group', 'supergroup']:
+            # Carta a carta, como siempre: si una carta desbloquea Johto/Hoenn, las siguientes ya cuentan
+            for r in pack_results:
+                await db.aio.add_pokemon_to_group_pokedex(message.chat.id, r['data']['id'])
+                await check_and_unlock_regions(message.chat.id, context)
+
+        for result, status in zip(pack_results, statuses):
             p, s_val = result['data'], result['is_shiny']
             is_true_shiny = (s_val % 2 != 0)
             rarity = get_rarity(p['category'], is_true_shiny)
 
             try:
                 path = get_image_path(p['id'], s_val)
-                with open(path, 'rb') as f:
-                    msg = await context.bot.send_sticker(chat_id=message.chat_id, sticker=f, disable_notification=True)
-                    message_ids_to_delete.append(msg.message_id)
+                msg = await send_sticker_cached(context.bot, message.chat_id, path, disable_notification=True)
+                message_ids_to_delete.append(msg.message_id)
                 await asyncio.sleep(1.0)
             except Exception as e:
                 logger.error(f"Error enviando sticker {p['id']}: {e}")
@@ -4528,88 +4522,67 @@ async def open_pack_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 base_val = s_val - 1 if is_true_shiny else s_val
                 form_name = f" Forma {POKEMON_FORMS[p['id']][base_val][1]}"
 
-            if message.chat.type in ['group', 'supergroup']:
-                db.add_pokemon_to_group_pokedex(message.chat.id, p['id'])
-                await check_and_unlock_regions(message.chat.id, context)
-
-            status = db.add_sticker_smart(user.id, p['id'], s_val)
-
             if status == 'NEW':
                 summary_parts.append(f"🔸🆕 {p_display}{form_name} {r_emoji}")
             elif status == 'DUPLICATE':
                 summary_parts.append(f"🔸♻️ {p_display}{form_name} {r_emoji}")
             else:
                 money = DUPLICATE_MONEY_VALUES.get(rarity, 100)
-                db.update_money(user.id, money)
+                money_total += money
                 summary_parts.append(f"🔸✔️ {p_display}{form_name} {r_emoji} (+{format_money(money)}₽)")
 
+        if money_total:
+            await db.aio.update_money(user.id, money_total)
+
         final_text = f"{summary_header_name} de {user.mention_html()}:\n\n" + "\n".join(summary_parts)
 
         # --- PREMIOS INDIVIDUALES Y RETOS GRUPALES ---
-        if not db.is_kanto_completed_by_user(user.id) and db.get_user_unique_kanto_count(user.id) >= 151:
-            db.set_kanto_completed_by_user(user.id)
-            db.update_money(user.id, 3000)
-            db.add_item_to_inventory(user.id, 'pack_shiny_kanto', 1)
-            final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
-
-        if not db.is_johto_completed_by_user(user.id) and db.get_user_unique_johto_count(user.id) >= 100:
-            db.set_johto_completed_by_user(user.id)
-            db.update_money(user.id, 3000)
-            db.add_item_to_inventory(user.id, 'pack_shiny_johto', 1)
-            final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
-
-        if not db.is_hoenn_completed_by_user(user.id) and db.get_user_unique_hoenn_count(user.id) >= 135:
-            db.set_hoenn_completed_by_user(user.id)
-            db.update_money(user.id, 3000)
-            db.add_item_to_inventory(user.id, 'pack_shiny_hoenn', 1)
-            final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
-
-        if not db.is_unown_completed_by_user(user.id) and db.get_user_unique_unown_count(user.id) >= 28:
-            db.set_unown_completed_by_user(user.id)
-            db.update_money(user.id, 2000)
-            db.add_item_to_inventory(user.id, 'pack_shiny_unown', 1)
-            final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+        if not await db.aio.is_kanto_completed_by_user(user.id) and await db.aio.get_user_unique_kanto_count(user.id) >= 151:
+            if await db.aio.grant_album_reward(user.id, 'kanto', 3000, 'pack_shiny_kanto'):
+                final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+
+        if not await db.aio.is_johto_completed_by_user(user.id) and await db.aio.get_user_unique_johto_count(user.id) >= 100:
+            if await db.aio.grant_album_reward(user.id, 'johto', 3000, 'pack_shiny_johto'):
+                final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+
+        if not await db.aio.is_hoenn_completed_by_user(user.id) and await db.aio.get_user_unique_hoenn_count(user.id) >= 135:
+            if await db.aio.grant_album_reward(user.id, 'hoenn', 3000, 'pack_shiny_hoenn'):
+                final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
+
+        if not await db.aio.is_unown_completed_by_user(user.id) and await db.aio.get_user_unique_unown_count(user.id) >= 28:
+            if await db.aio.grant_album_reward(user.id, 'unown', 2000, 'pack_shiny_unown'):
+                final_text += f"\n\n🎊 ¡Felicidades {user.mention_html()}, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
 
         is_qualified = await is_group_qualified(message.chat_id, context)
         chat_id = message.chat_id
 
         if message.chat.type in ['group', 'supergroup']:
-            if not db.is_event_completed(chat_id, 'kanto_group_challenge'):
-                if len(db.get_group_unique_kanto_ids(chat_id)) >= 151:
-                    db.mark_event_completed(chat_id, 'kanto_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'kanto_group_challenge'):
+                if await db.aio.get_group_region_count(chat_id, 'kanto') >= 151:
+                    await db.aio.mark_event_completed(chat_id, 'kanto_group_challenge')
                     if is_qualified:
-                        for uid in db.get_users_in_group(chat_id):
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Kanto")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_kanto', "Premio Reto Grupal: Kanto")
+                        await db.aio.add_mail_many(combo_mails(await db.aio.get_users_in_group(chat_id), 2000,
+                                                               'pack_shiny_kanto', "Premio Reto Grupal: Kanto"))
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Kanto en su buzón."
                     else:
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>!"
 
-            excluded_johto = {172, 173, 174, 175, 201, 236, 238, 239, 240}
-            if not db.is_event_completed(chat_id, 'johto_group_challenge'):
-                valid_johto = [p for p in db.get_group_unique_johto_ids(chat_id) if p not in excluded_johto]
-                if len(valid_johto) >= 91:
-                    db.mark_event_completed(chat_id, 'johto_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'johto_group_challenge'):
+                if await db.aio.get_group_region_count(chat_id, 'johto') >= 91:
+                    await db.aio.mark_event_completed(chat_id, 'johto_group_challenge')
                     if is_qualified:
-                        for uid in db.get_users_in_group(chat_id):
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Johto")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_johto', "Premio Reto Grupal: Johto")
+                        await db.aio.add_mail_many(combo_mails(await db.aio.get_users_in_group(chat_id), 2000,
+                                                               'pack_shiny_johto', "Premio Reto Grupal: Johto"))
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Johto en su buzón."
                     else:
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>!"
 
-            excluded_hoenn = {298, 360}
-            if not db.is_event_completed(chat_id, 'hoenn_group_challenge'):
-                raw_hoenn = db.query_db(
-                    'SELECT pokemon_id FROM group_pokedex WHERE chat_id = %s AND pokemon_id >= 252 AND pokemon_id <= 386',
-                    (chat_id,))
-                valid_hoenn = [r[0] for r in raw_hoenn if r[0] not in excluded_hoenn] if raw_hoenn else []
-                if len(valid_hoenn) >= 133:
-                    db.mark_event_completed(chat_id, 'hoenn_group_challenge')
+            if not await db.aio.is_event_completed(chat_id, 'hoenn_group_challenge'):
+                if await db.aio.get_group_region_count(chat_id, 'hoenn') >= 133:
+                    await db.aio.mark_event_completed(chat_id, 'hoenn_group_challenge')
                     if is_qualified:
-                        for uid in db.get_users_in_group(chat_id):
-                            db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Hoenn")
-                            db.add_mail(uid, 'inventory_item', 'pack_shiny_hoenn', "Premio Reto Grupal: Hoenn")
+                        await db.aio.add_mail_many(combo_mails(await db.aio.get_users_in_group(chat_id), 2000,
+                                                               'pack_shiny_hoenn', "Premio Reto Grupal: Hoenn"))
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Hoenn en su buzón."
                     else:
                         final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>!"
@@ -4696,8 +4669,9 @@ async def multisobre_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     final_text = f"🎴 <b>Apertura Múltiple de {user.mention_html()}</b> 🎴\n<i>{cantidad}x {pack_name}</i>\n\n"
     user_quantities = db.get_user_collection_quantities(user.id)
+    generated_packs = []
 
-    for i in range(cantidad):
+    for _ in range(cantidad):
         pack_results = []
 
         # --- TIRADA DE SOBRE DIOS (0.1%) ---
@@ -4923,6 +4897,21 @@ async def multisobre_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 s_val = form_offset + (1 if is_shiny_bool else 0)
                 pack_results.append({'data': p_data, 'is_shiny': s_val})
 
+        generated_packs.append((is_god_pack, pack_results))
+
+    # --- ENTREGA EN BLOQUE: un número fijo de consultas sea cual sea la cantidad de sobres ---
+    all_cards = [(r['data']['id'], r['is_shiny']) for _, pack_results in generated_packs for r in pack_results]
+    statuses = iter(await db.aio.grant_stickers_bulk(user.id, all_cards))
+
+    if update.effective_chat.type in ['group', 'supergroup']:
+        # Carta a carta, como siempre: si una carta desbloquea Johto/Hoenn, las siguientes ya cuentan
+        # (la Pokédex grupal y los eventos están en memoria, así que esto no cuesta consultas de más)
+        for p_id, _ in all_cards:
+            db.add_pokemon_to_group_pokedex(chat_id, p_id)
+            await check_and_unlock_regions(chat_id, context)
+
+    money_total = 0
+    for i, (is_god_pack, pack_results) in enumerate(generated_packs):
         # --- EVALUAR LOS RESULTADOS DEL SOBRE ACTUAL ---
         summary_parts = []
         for result in pack_results:
@@ -4930,11 +4919,7 @@ async def multisobre_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             is_true_shiny = (s_val % 2 != 0)
             rarity = get_rarity(p['category'], is_true_shiny)
 
-            if update.effective_chat.type in ['group', 'supergroup']:
-                db.add_pokemon_to_group_pokedex(chat_id, p['id'])
-                await check_and_unlock_regions(chat_id, context)
-
-            status = db.add_sticker_smart(user.id, p['id'], s_val)
+            status = next(statuses)
             p_display = get_formatted_name(p, is_true_shiny)
             r_emoji = RARITY_VISUALS.get(rarity, '')
 
@@ -4949,7 +4934,7 @@ async def multisobre_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 summary_parts.append(f"🔸♻️ {p_display}{form_name} {r_emoji}")
             else:
                 money = DUPLICATE_MONEY_VALUES.get(rarity, 100)
-                db.update_money(user.id, money)
+                money_total += money
                 summary_parts.append(f"🔸✔️ {p_display}{form_name} {r_emoji} (+{format_money(money)}₽)")
 
         if is_god_pack:
@@ -4965,72 +4950,57 @@ async def multisobre_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         final_text += pack_summary
 
+    if money_total:
+        db.update_money(user.id, money_total)
+
     premios_extra = ""
     if not db.is_kanto_completed_by_user(user.id) and db.get_user_unique_kanto_count(user.id) >= 151:
-        db.set_kanto_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_kanto', 1)
-        premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+        if db.grant_album_reward(user.id, 'kanto', 3000, 'pack_shiny_kanto'):
+            premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Kanto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
     if not db.is_johto_completed_by_user(user.id) and db.get_user_unique_johto_count(user.id) >= 100:
-        db.set_johto_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_johto', 1)
-        premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+        if db.grant_album_reward(user.id, 'johto', 3000, 'pack_shiny_johto'):
+            premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Johto</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
     if not db.is_hoenn_completed_by_user(user.id) and db.get_user_unique_hoenn_count(user.id) >= 135:
-        db.set_hoenn_completed_by_user(user.id)
-        db.update_money(user.id, 3000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_hoenn', 1)
-        premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
+        if db.grant_album_reward(user.id, 'hoenn', 3000, 'pack_shiny_hoenn'):
+            premios_extra += f"\n🎊 ¡Felicidades, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
 
     if not db.is_unown_completed_by_user(user.id) and db.get_user_unique_unown_count(user.id) >= 28:
-        db.set_unown_completed_by_user(user.id)
-        db.update_money(user.id, 2000)
-        db.add_item_to_inventory(user.id, 'pack_shiny_unown', 1)
-        premios_extra += f"\n🎊 ¡Felicidades, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+        if db.grant_album_reward(user.id, 'unown', 2000, 'pack_shiny_unown'):
+            premios_extra += f"\n🎊 ¡Felicidades, has completado el <b>Álbum Unown</b>! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
 
     final_text += premios_extra
 
     is_qualified = await is_group_qualified(chat_id, context)
 
     if update.effective_chat.type in ['group', 'supergroup']:
-        if not db.is_event_completed(chat_id, 'kanto_group_challenge') and len(
-                db.get_group_unique_kanto_ids(chat_id)) >= 151:
+        if not db.is_event_completed(chat_id, 'kanto_group_challenge') and \
+                db.get_group_region_count(chat_id, 'kanto') >= 151:
             db.mark_event_completed(chat_id, 'kanto_group_challenge')
             if is_qualified:
-                for uid in db.get_users_in_group(chat_id):
-                    db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Kanto")
-                    db.add_mail(uid, 'inventory_item', 'pack_shiny_kanto', "Premio Reto Grupal: Kanto")
+                db.add_mail_many(combo_mails(db.get_users_in_group(chat_id), 2000,
+                                             'pack_shiny_kanto', "Premio Reto Grupal: Kanto"))
                 final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Kanto en su buzón."
             else:
                 final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Kanto</b>!"
 
-        excluded_johto = {172, 173, 174, 175, 201, 236, 238, 239, 240}
         if not db.is_event_completed(chat_id, 'johto_group_challenge'):
-            valid_johto = [p for p in db.get_group_unique_johto_ids(chat_id) if p not in excluded_johto]
-            if len(valid_johto) >= 91:
+            if db.get_group_region_count(chat_id, 'johto') >= 91:
                 db.mark_event_completed(chat_id, 'johto_group_challenge')
                 if is_qualified:
-                    for uid in db.get_users_in_group(chat_id):
-                        db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Johto")
-                        db.add_mail(uid, 'inventory_item', 'pack_shiny_johto', "Premio Reto Grupal: Johto")
+                    db.add_mail_many(combo_mails(db.get_users_in_group(chat_id), 2000,
+                                                 'pack_shiny_johto', "Premio Reto Grupal: Johto"))
                     final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Johto en su buzón."
                 else:
                     final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Johto</b>!"
 
-        excluded_hoenn = {298, 360}
         if not db.is_event_completed(chat_id, 'hoenn_group_challenge'):
-            raw_hoenn = db.query_db(
-                'SELECT pokemon_id FROM group_pokedex WHERE chat_id = %s AND pokemon_id >= 252 AND pokemon_id <= 386',
-                (chat_id,))
-            valid_hoenn = [r[0] for r in raw_hoenn if r[0] not in excluded_hoenn] if raw_hoenn else []
-            if len(valid_hoenn) >= 133:
+            if db.get_group_region_count(chat_id, 'hoenn') >= 133:
                 db.mark_event_completed(chat_id, 'hoenn_group_challenge')
                 if is_qualified:
-                    for uid in db.get_users_in_group(chat_id):
-                        db.add_mail(uid, 'money', '2000', "Premio Reto Grupal: Hoenn")
-                        db.add_mail(uid, 'inventory_item', 'pack_shiny_hoenn', "Premio Reto Grupal: Hoenn")
+                    db.add_mail_many(combo_mails(db.get_users_in_group(chat_id), 2000,
+                                                 'pack_shiny_hoenn', "Premio Reto Grupal: Hoenn"))
                     final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>! Cada jugador ha recibido 2000₽ y un Sobre Brillante Hoenn en su buzón."
                 else:
                     final_text += f"\n\n🌍🎉 ¡FELICIDADES AL GRUPO! ¡Habéis completado el reto de <b>Hoenn</b>!"
@@ -5211,15 +5181,16 @@ async def admin_godpack_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 3. Mostrar y evaluar resultados
     summary_parts = []
-    for result in pack_results:
+    money_total = 0
+    statuses = await db.aio.grant_stickers_bulk(user.id, [(r['data']['id'], r['is_shiny']) for r in pack_results])
+    for result, status in zip(pack_results, statuses):
         p, s_val = result['data'], result['is_shiny']
         rarity = get_rarity(p['category'], True)
 
         try:
             path = get_image_path(p['id'], s_val)
-            with open(path, 'rb') as f:
-                msg = await context.bot.send_sticker(chat_id=chat_id, sticker=f, disable_notification=True)
-                message_ids_to_delete.append(msg.message_id)
+            msg = await send_sticker_cached(context.bot, chat_id, path, disable_notification=True)
+            message_ids_to_delete.append(msg.message_id)
             await asyncio.sleep(1.0)
         except Exception as e:
             logger.error(f"Error God Pack: {e}")
@@ -5232,17 +5203,18 @@ async def admin_godpack_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             base_val = s_val - 1
             form_name = f" Forma {POKEMON_FORMS[p['id']][base_val][1]}"
 
-        status = db.add_sticker_smart(user.id, p['id'], s_val)
-
         if status == 'NEW':
             summary_parts.append(f"🔸🆕 {p_display}{form_name} {r_emoji}")
         elif status == 'DUPLICATE':
             summary_parts.append(f"🔸♻️ {p_display}{form_name} {r_emoji}")
         else:
             money = DUPLICATE_MONEY_VALUES.get(rarity, 100)
-            db.update_money(user.id, money)
+            money_total += money
             summary_parts.append(f"🔸✔️ {p_display}{form_name} {r_emoji} (+{format_money(money)}₽)")
 
+    if money_total:
+        db.update_money(user.id, money_total)
+
     final_text = f"🌟 <b>Resultado del Sobre Brillante {display_region}✨✨ de {user.mention_html()}:</b>\n\n" + "\n".join(
         summary_parts)
 
@@ -5318,12 +5290,10 @@ async def regalar_objeto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return await message.reply_text(
             "⚠️ No detecté a ningún usuario. Asegúrate de mencionar (@) o responder a un mensaje.")
 
-    count = 0
     for uid in targets:
         db.get_or_create_user(uid, None)
-        msg = "¡Un regalo!"
-        db.add_mail(uid, 'inventory_item', item_id, msg)
-        count += 1
+    msg = "¡Un regalo!"
+    count = db.add_mail_many((uid, 'inventory_item', item_id, msg) for uid in targets)
 
     item_name = ITEM_NAMES.get(item_id, item_id)
     await message.reply_text(f"✅ Enviado *{item_name}* al buzón de {count} usuarios.", parse_mode='Markdown')
@@ -5531,6 +5501,92 @@ async def resetmoney_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown')
 
 
+# --- DIFUSIONES EN SEGUNDO PLANO ---
+# El aviso de correo a todos ya no corre dentro del comando del admin: es un job que carga los usuarios
+# por páginas (con su preferencia de notificación), los avisa en paralelo bajo el limitador de envíos
+# y guarda el cursor tras cada página. Si el bot se reinicia, post_init lo retoma donde iba.
+MAIL_NOTICE_TEXT = "📬 **¡Tienes correo! Ha llegado algo a tu /buzon**\n\n _Para dejar de recibir notificaciones del buzón, escribe:_ /notiboff"
+BROADCAST_PAGE_SIZE = 500
+BROADCAST_CONCURRENCY = 25  # Envíos en vuelo a la vez (el ritmo real lo pone el limitador global)
+BROADCAST_REPORT_EVERY = 15  # Segundos entre actualizaciones del mensaje de progreso
+
+
+def broadcast_progress_text(job, finished=False):
+    done = job['sent'] + job['skipped'] + job['failed']
+    header = f"✅ Difusión #{job['job_id']} terminada." if finished else f"⏳ Difusión #{job['job_id']} en marcha..."
+    return (f"{header}\n👥 Procesados: {done}/{job['total']}\n📩 Avisados: {job['sent']}\n"
+            f"🔕 Silenciados: {job['skipped']}\n⚠️ Fallidos: {job['failed']}")
+
+
+async def report_broadcast_progress(bot, job, finished=False):
+    if not job.get('progress_msg_id'):
+        return
+    try:
+        await bot.edit_message_text(chat_id=job['admin_chat_id'], message_id=job['progress_msg_id'],
+                                    text=broadcast_progress_text(job, finished))
+    except BadRequest:
+        pass  # "message is not modified" o el admin borró el mensaje
+
+
+async def start_broadcast(context: ContextTypes.DEFAULT_TYPE, admin_chat_id, text=MAIL_NOTICE_TEXT):
+    """Crea la difusión, deja el mensaje de progreso al admin y lanza el job. Devuelve el job_id."""
+    job_id = await db.aio.create_broadcast_job(text, admin_chat_id)
+    job = await db.aio.get_broadcast_job(job_id)
+    msg = await context.bot.send_message(chat_id=admin_chat_id, text=broadcast_progress_text(job),
+                                         disable_notification=True)
+    await db.aio.set_broadcast_progress_msg(job_id, msg.message_id)
+    context.job_queue.run_once(broadcast_job, 0, data=job_id, name=f"broadcast_{job_id}")
+    return job_id
+
+
+@background_job
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    job_id = context.job.data
+    job = await db.aio.get_broadcast_job(job_id)
+    if not job or job['status'] != 'running':
+        return
+
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def notify(uid):
+        async with semaphore:
+            try:
+                await context.bot.send_message(chat_id=uid, text=job['text'], parse_mode='Markdown')
+                return True
+            except Exception:
+                return False  # Bloqueó al bot, cuenta borrada...
+
+    cursor = job['last_user_id'] or 0
+    last_report = time.time()
+    while True:
+        page = await db.aio.get_broadcast_recipients(cursor, BROADCAST_PAGE_SIZE)
+        if not page:
+            break
+
+        targets = [uid for uid, enabled in page if enabled]
+        results = await asyncio.gather(*(notify(uid) for uid in targets))
+        sent = sum(results)
+        cursor = page[-1][0]
+        await db.aio.advance_broadcast_job(job_id, cursor, sent, len(page) - len(targets), len(results) - sent)
+
+        if time.time() - last_report >= BROADCAST_REPORT_EVERY:
+            last_report = time.time()
+            await report_broadcast_progress(context.bot, await db.aio.get_broadcast_job(job_id))
+
+    await db.aio.finish_broadcast_job(job_id)
+    job = await db.aio.get_broadcast_job(job_id)
+    logger.info(f"📬 Difusión #{job_id} terminada: {job['sent']} avisados, {job['skipped']} silenciados, "
+                f"{job['failed']} fallidos.")
+    await report_broadcast_progress(context.bot, job, finished=True)
+
+
+async def resume_broadcasts(application: Application):
+    """Al arrancar, retoma las difusiones que se quedaron a medias por un reinicio."""
+    for job in await db.aio.get_unfinished_broadcast_jobs():
+        logger.info(f"📬 Reanudando difusión #{job['job_id']} desde el usuario {job['last_user_id']}.")
+        application.job_queue.run_once(broadcast_job, 10, data=job['job_id'], name=f"broadcast_{job['job_id']}")
+
+
 async def send_to_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or update.effective_user.id != ADMIN_USER_ID: return
     try:
@@ -5538,7 +5594,6 @@ async def send_to_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not args: return await update.message.reply_text("Uso: /sendtoall <tipo/id|combo> [args] [mensaje]",
                                                             disable_notification=True)
 
-        all_users = db.get_all_user_ids()
         first_arg = args[0].lower()
 
         # --- LÓGICA ESPECIAL PARA COMBO ---
@@ -5551,32 +5606,14 @@ async def send_to_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 item_name = ITEM_NAMES.get(final_item_id, final_item_id)
                 if final_item_id == 'pack_shiny_kanto': item_name = "Sobre Brillante Kanto"
 
-                notified_count = 0
-                skipped_count = 0
-                await update.message.reply_text(f"⏳ Enviando COMBO a {len(all_users)} usuarios...",
-                                                disable_notification=True)
-
-                for uid in all_users:
-                    db.add_mail(uid, 'money', str(money_amount), message)
-                    db.add_mail(uid, 'inventory_item', final_item_id, message)
-
-                    # --- CHECK: ¿QUIERE NOTIFICACIONES? ---
-                    if db.is_user_notification_enabled(uid):
-                        try:
-                            await context.bot.send_message(
-                                chat_id=uid,
-                                text=f"📬 **¡Tienes correo! Ha llegado algo a tu /buzon**\n\n _Para dejar de recibir notificaciones del buzón, escribe:_ /notiboff",
-                                parse_mode='Markdown'
-                            )
-                            notified_count += 1
-                            await asyncio.sleep(0.05)
-                        except Exception:
-                            pass
-                    else:
-                        skipped_count += 1
+                # El regalo se guarda una sola vez para todos; los avisos van en segundo plano
+                await db.aio.add_broadcast_mail('money', str(money_amount), message)
+                await db.aio.add_broadcast_mail('inventory_item', final_item_id, message)
+                job_id = await start_broadcast(context, update.effective_chat.id)
 
                 await update.message.reply_text(
-                    f"✅ Combo enviado.\n📩 Avisados: {notified_count}\n🔕 Silenciados: {skipped_count}",
+                    f"✅ Combo ({format_money(money_amount)}₽ + {item_name}) guardado en el buzón de todos.\n"
+                    f"📬 Avisando en segundo plano (difusión #{job_id}).",
                     disable_notification=True)
                 return
 
@@ -5613,30 +5650,12 @@ async def send_to_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 return await update.message.reply_text(f"Tipo no reconocido: '{first_arg}'.", disable_notification=True)
 
-        notified_count = 0
-        skipped_count = 0
-        await update.message.reply_text(f"⏳ Enviando regalos a {len(all_users)} usuarios...", disable_notification=True)
-
-        for uid in all_users:
-            db.add_mail(uid, item_type, item_details, message)
-
-            # --- CHECK: ¿QUIERE NOTIFICACIONES? ---
-            if db.is_user_notification_enabled(uid):
-                try:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text=f"📬 **¡Tienes correo! Ha llegado algo a tu /buzon**\n\n _Para dejar de recibir notificaciones del buzón, escribe:_ /notiboff",
-                        parse_mode='Markdown'
-                    )
-                    notified_count += 1
-                    await asyncio.sleep(0.05)
-                except Exception:
-                    pass
-            else:
-                skipped_count += 1
+        # El regalo se guarda una sola vez para todos; los avisos van en segundo plano
+        await db.aio.add_broadcast_mail(item_type, item_details, message)
+        job_id = await start_broadcast(context, update.effective_chat.id)
 
         await update.message.reply_text(
-            f"✅ Regalo enviado a {len(all_users)} jugadores.\n📩 Avisados: {notified_count}\n🔕 Silenciados: {skipped_count}",
+            f"✅ Regalo guardado en el buzón de todos los jugadores.\n📬 Avisando en segundo plano (difusión #{job_id}).",
             disable_notification=True
         )
 
@@ -5932,8 +5951,7 @@ async def retos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db.register_user_in_group(user.id, chat_id)
 
     # --- LÓGICA KANTO ---
-    group_ids_kanto = db.get_group_unique_kanto_ids(chat_id)
-    total_kanto = len(group_ids_kanto)
+    total_kanto = db.get_group_region_count(chat_id, 'kanto')
     target_kanto = 151
 
     text = "🤝 **Retos Grupales** 🤝\n\n"
@@ -5950,11 +5968,8 @@ async def retos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     johto_unlocked = total_kanto >= 113
 
     if johto_unlocked:
-        group_ids_johto = db.get_group_unique_johto_ids(chat_id)
-        excluded_johto = {172, 173, 174, 175, 201, 236, 238, 239, 240}
-        valid_johto_ids = [pid for pid in group_ids_johto if pid not in excluded_johto]
-
-        total_johto = len(valid_johto_ids)
+        # Sin bebés ni el Unown base: ya vienen descontados en el contador
+        total_johto = db.get_group_region_count(chat_id, 'johto')
         target_johto = 91
 
         if total_johto >= target_johto:
@@ -5969,18 +5984,9 @@ async def retos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         hoenn_unlocked = total_johto >= 68
 
         if hoenn_unlocked:
-            # Reutilizamos la función de la BD para sacar los IDs grupales de Hoenn
+            # Contador de la Pokédex grupal en memoria, sin bebés de Hoenn (Azurill y Wynaut)
             # (No te preocupes por las formas múltiples, group_pokedex ya guarda el ID base, ej: 351, 386)
-            raw_group_ids_hoenn = db.query_db(
-                'SELECT pokemon_id FROM group_pokedex WHERE chat_id = %s AND pokemon_id >= 252 AND pokemon_id <= 386',
-                (chat_id,))
-            group_ids_hoenn = {row[0] for row in raw_group_ids_hoenn} if raw_group_ids_hoenn else set()
-
-            # Excluimos bebés de Hoenn (Azurill y Wynaut)
-            excluded_hoenn = {298, 360}
-            valid_hoenn_ids = [pid for pid in group_ids_hoenn if pid not in excluded_hoenn]
-
-            total_hoenn = len(valid_hoenn_ids)
+            total_hoenn = db.get_group_region_count(chat_id, 'hoenn')
             target_hoenn = 133
 
             if total_hoenn >= target_hoenn:
@@ -6257,6 +6263,7 @@ async def notic_off_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- TAREA DIARIA DE REVISIÓN DE CADUCIDAD ---
 
+@background_job
 async def check_code_expiration_job(context: ContextTypes.DEFAULT_TYPE):
     """Revisa si hay códigos que caducan en 3 días, avisa, y actualiza los tablones."""
     # 1. Limpieza de caducados de la base de datos
@@ -6285,20 +6292,18 @@ async def check_code_expiration_job(context: ContextTypes.DEFAULT_TYPE):
                         ),
                         parse_mode='Markdown'
                     )
-                    await asyncio.sleep(0.1)
                 except Exception:
                     pass
 
     # --- NUEVO: ACTUALIZAR TODOS LOS TABLONES FIJOS ---
-    active_groups = db.get_active_groups()
-    for chat_id in active_groups:
-        try:
-            # Esto forzará que el mensaje anclado re-calcule los días restantes
-            # y borre visualmente los que acaban de caducar hoy.
-            await refresh_codes_board(context.bot, chat_id)
-            await asyncio.sleep(0.1)  # Pausa anti-spam de Telegram
-        except Exception as e:
-            logger.error(f"Error actualizando tablón de códigos en {chat_id}: {e}")
+    # Esto forzará que el mensaje anclado re-calcule los días restantes
+    # y borre visualmente los que acaban de caducar hoy. El texto es el mismo para todos: se genera una vez.
+    board_text = build_codes_board_text()
+
+    async def refresh_board(chat_id):
+        await refresh_codes_board(context.bot, chat_id, board_text)
+
+    await fan_out("tablon_codigos", db.get_active_groups(), refresh_board)
 
 
 # --- SISTEMA DE INTERCAMBIOS ---
@@ -7111,46 +7116,34 @@ async def trade_final_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Comprobamos al Sender (El que inició el intercambio)
     if not db.is_kanto_completed_by_user(sender_id):
         if db.get_user_unique_kanto_count(sender_id) >= 151:
-            db.set_kanto_completed_by_user(sender_id)
-            db.update_money(sender_id, 3000)
-            db.add_item_to_inventory(sender_id, 'pack_shiny_kanto', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado *Kanto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+            if db.grant_album_reward(sender_id, 'kanto', 3000, 'pack_shiny_kanto'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado *Kanto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
     if not db.is_johto_completed_by_user(sender_id):
         if db.get_user_unique_johto_count(sender_id) >= 100:
-            db.set_johto_completed_by_user(sender_id)
-            db.update_money(sender_id, 3000)
-            db.add_item_to_inventory(sender_id, 'pack_shiny_johto', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado *Johto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+            if db.grant_album_reward(sender_id, 'johto', 3000, 'pack_shiny_johto'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado *Johto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
     if not db.is_unown_completed_by_user(sender_id):
         if db.get_user_unique_unown_count(sender_id) >= 28:
-            db.set_unown_completed_by_user(sender_id)
-            db.update_money(sender_id, 2000)
-            db.add_item_to_inventory(sender_id, 'pack_shiny_unown', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado el *Álbum Unown*! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+            if db.grant_album_reward(sender_id, 'unown', 2000, 'pack_shiny_unown'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {sender.mention_markdown()}, has completado el *Álbum Unown*! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
 
     # Comprobamos al Target (El que aceptó el intercambio)
     if not db.is_kanto_completed_by_user(target_id):
         if db.get_user_unique_kanto_count(target_id) >= 151:
-            db.set_kanto_completed_by_user(target_id)
-            db.update_money(target_id, 3000)
-            db.add_item_to_inventory(target_id, 'pack_shiny_kanto', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado *Kanto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
+            if db.grant_album_reward(target_id, 'kanto', 3000, 'pack_shiny_kanto'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado *Kanto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Kanto!"
 
     if not db.is_johto_completed_by_user(target_id):
         if db.get_user_unique_johto_count(target_id) >= 100:
-            db.set_johto_completed_by_user(target_id)
-            db.update_money(target_id, 3000)
-            db.add_item_to_inventory(target_id, 'pack_shiny_johto', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado *Johto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
+            if db.grant_album_reward(target_id, 'johto', 3000, 'pack_shiny_johto'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado *Johto*! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Johto!"
 
     if not db.is_unown_completed_by_user(target_id):
         if db.get_user_unique_unown_count(target_id) >= 28:
-            db.set_unown_completed_by_user(target_id)
-            db.update_money(target_id, 2000)
-            db.add_item_to_inventory(target_id, 'pack_shiny_unown', 1)
-            premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado el *Álbum Unown*! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
+            if db.grant_album_reward(target_id, 'unown', 2000, 'pack_shiny_unown'):
+                premios_extra += f"\n\n🎊 ¡Felicidades {target.mention_markdown()}, has completado el *Álbum Unown*! 🎊\n¡Recibes 2000₽ y un Sobre Brillante Unown!"
     # ---------------------------------------------------------
 
     final_text = (
@@ -7181,6 +7174,7 @@ async def trade_timeout_job(context: ContextTypes.DEFAULT_TYPE):
         pass  # Si ya no existe, no pasa nada
 
 
+@background_job
 async def regional_event_announcement_job(context: ContextTypes.DEFAULT_TYPE):
     """Avisa a las 10:00 si hay un evento regional activo."""
     today_str = datetime.now(TZ_SPAIN).strftime('%Y-%m-%d')
@@ -7192,13 +7186,11 @@ async def regional_event_announcement_job(context: ContextTypes.DEFAULT_TYPE):
 
     if active_regional_event:
         text = f"📜 <b>Evento activo. Durante el día de hoy solo aparecerán Pokémon y Eventos de {active_regional_event}.</b>"
-        active_groups = db.get_active_groups()
-        for chat_id in active_groups:
-            try:
-                await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
-                await asyncio.sleep(0.1)
-            except:
-                pass
+
+        async def announce(chat_id):
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+
+        await fan_out("evento_regional", db.get_active_groups(), announce)
 
 async def trade_cancel_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el botón de Cancelar en el menú de selección de intercambio."""
@@ -7285,14 +7277,11 @@ async def retos_view_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = int(data[3])
 
     # Recalculamos flags por si le dan a Volver
-    group_ids_kanto = db.get_group_unique_kanto_ids(chat_id)
-    is_johto_unlocked = 1 if len(group_ids_kanto) >= 113 else 0
+    is_johto_unlocked = 1 if db.get_group_region_count(chat_id, 'kanto') >= 113 else 0
 
     is_hoenn_unlocked = 0
     if is_johto_unlocked:
-        raw_johto = db.get_group_unique_johto_ids(chat_id)
-        valid_johto = [pid for pid in raw_johto if pid not in {172, 173, 174, 175, 201, 236, 238, 239, 240}]
-        if len(valid_johto) >= 68:
+        if db.get_group_region_count(chat_id, 'johto') >= 68:
             is_hoenn_unlocked = 1
 
     rarity_counts = {'C': 0, 'B': 0, 'A': 0, 'S': 0}
@@ -7301,7 +7290,7 @@ async def retos_view_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = ""
 
     if region == 'kanto':
-        group_ids = group_ids_kanto
+        group_ids = db.get_group_unique_kanto_ids(chat_id)
         for p in ALL_POKEMON:
             if p['id'] > 151: continue
             rarity_totals[p['category']] += 1
@@ -7312,9 +7301,8 @@ async def retos_view_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = "🔸 **Kanto:**\n\n"
 
     elif region == 'johto':
-        raw_group_ids = db.get_group_unique_johto_ids(chat_id)
-        excluded_ids = {172, 173, 174, 175, 201, 236, 238, 239, 240}
-        group_ids = {pid for pid in raw_group_ids if pid not in excluded_ids}
+        excluded_ids = db.GROUP_JOHTO_EXCLUDED
+        group_ids = db.get_group_unique_johto_ids(chat_id) - excluded_ids
 
         for p in ALL_POKEMON:
             if p['id'] < 152 or p['id'] > 251: continue
@@ -7327,11 +7315,9 @@ async def retos_view_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = "🔹 **Johto:**\n\n"
 
     elif region == 'hoenn':
-        # Leemos los de Hoenn directamente
-        raw_hoenn_ids = db.query_db('SELECT pokemon_id FROM group_pokedex WHERE chat_id = %s AND pokemon_id >= 252 AND pokemon_id <= 386', (chat_id,))
-        group_ids = {row[0] for row in raw_hoenn_ids} if raw_hoenn_ids else set()
-        excluded_ids = {298, 360}
-        group_ids = {pid for pid in group_ids if pid not in excluded_ids}
+        # Los de Hoenn salen de la Pokédex grupal en memoria
+        excluded_ids = db.GROUP_HOENN_EXCLUDED
+        group_ids = db.get_group_unique_hoenn_ids(chat_id) - excluded_ids
 
         for p in ALL_POKEMON:
             if p['id'] < 252 or p['id'] > 386: continue
@@ -7397,7 +7383,7 @@ async def clemailbox_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def removemail_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or update.effective_user.id != ADMIN_USER_ID: return
     try:
-        mail_id = int(context.args[0])
+        mail_id = db.parse_mail_id(context.args[0])
         if db.remove_mail_item_by_id(mail_id):
             await update.message.reply_text(f"✅ Regalo con ID `{mail_id}` eliminado correctamente.", disable_notification=True)
         else:
@@ -7882,10 +7868,8 @@ async def close_jirachi_event(context: ContextTypes.DEFAULT_TYPE):
             res_txt = f"✔️ ¡Genial, {mention}! Conseguiste un sticker de {p_display} {r_emoji}. Como ya lo tenías repetido, se convierte en <b>{format_money(money)}₽</b> 💰."
             # Comprobar si completó Hoenn
             if not db.is_hoenn_completed_by_user(u_id) and db.get_user_unique_hoenn_count(u_id) >= 135:
-                db.set_hoenn_completed_by_user(u_id)
-                db.update_money(u_id, 3000)
-                db.add_item_to_inventory(u_id, 'pack_shiny_hoenn', 1)
-                res_txt += f"\n\n🎊 ¡Felicidades, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
+                if db.grant_album_reward(u_id, 'hoenn', 3000, 'pack_shiny_hoenn'):
+                    res_txt += f"\n\n🎊 ¡Felicidades, has completado <b>Hoenn</b>! 🎊\n¡Recibes 3000₽ y un Sobre Brillante Hoenn!"
 
         final_text += f"{res_txt}\n\n"
 
@@ -8004,6 +7988,73 @@ async def admin_list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode='Markdown')
 
 
+async def admin_db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_USER_ID: return
+
+    # /dbstats reset -> pone a cero los histogramas de consultas
+    if context.args and context.args[0].lower() == 'reset':
+        db.reset_query_stats()
+        return await update.message.reply_text("✅ Estadísticas de consultas reiniciadas.")
+
+    stats = db.get_pool_stats()
+    if stats:
+        avg_wait = stats['wait_time'] / stats['waits'] if stats['waits'] else 0
+        text = (
+            "🏊 **Piscina de la base de datos:**\n"
+            f"- Carriles: {stats['in_use']} en uso (mín {stats['minconn']} / máx {stats['maxconn']})\n"
+            f"- Préstamos: {stats['checkouts']}\n"
+            f"- Esperas: {stats['waits']} (media {avg_wait:.2f}s) · Timeouts: {stats['timeouts']}\n"
+            f"- Fallos: {stats['failures']} · Reintentos: {stats['retries']} · Descartadas: {stats['discarded']}\n"
+        )
+    else:
+        text = "ℹ️ Sin piscina de conexiones (SQLite local o aún sin usar).\n"
+
+    # Las consultas que más tiempo acumulan (huella + helper que la lanza)
+    top = db.get_query_stats(limit=8)
+    text += "\n⏱️ **Consultas con más tiempo acumulado:**\n"
+    if not top:
+        text += "_Sin datos todavía._\n"
+    for row in top:
+        text += (f"- `{row['helper']}` ×{row['count']}: {row['total_ms']:.0f} ms "
+                 f"(media {row['avg_ms']:.1f} · p95 ≤{row['p95_ms']:g} · máx {row['max_ms']:.0f})\n"
+                 f"  `{row['query'][:80]}`\n")
+
+    slow = db.get_slow_queries(limit=5)
+    if slow:
+        text += f"\n🐢 **Últimas consultas lentas (>{db.DB_SLOW_QUERY_MS:g} ms):**\n"
+        for row in slow:
+            when = datetime.fromtimestamp(row['at'], TZ_SPAIN).strftime('%d/%m %H:%M:%S')
+            text += f"- {when} `{row['helper']}` {row['ms']:.0f} ms\n"
+
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
+async def admin_spawn_rate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/spawnrate -> estado del planificador de apariciones. /spawnrate <porcentaje> -> cambia el ritmo global."""
+    if update.effective_user.id != ADMIN_USER_ID: return
+
+    if context.args:
+        try:
+            percent = int(context.args[0].rstrip('%'))
+            if not 10 <= percent <= 1000: raise ValueError
+        except ValueError:
+            return await update.message.reply_text("Uso: `/spawnrate [porcentaje 10-1000]` (100 = normal)",
+                                                   parse_mode='Markdown')
+        await SPAWN_SCHEDULER.set_rate(percent)
+
+    stats = SPAWN_SCHEDULER.stats()
+    next_in = f"{stats['next_in'] / 60:.0f} min" if stats['next_in'] is not None else "-"
+    text = (
+        "🌿 **Planificador de apariciones:**\n"
+        f"- Ritmo global: {stats['rate_percent']}% (un spawn cada {stats['mean_delay'] / 3600:.1f} h de media por grupo)\n"
+        f"- Grupos programados: {stats['groups']} ({stats['running']} con aparición en curso)\n"
+        f"- Esperado: {stats['expected_per_hour']:.0f} apariciones/hora en total\n"
+        f"- Última hora: {stats['fired_last_hour']} lanzadas · Próxima hora: {stats['due_next_hour']} programadas\n"
+        f"- Siguiente aparición en: {next_in}\n"
+    )
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+
 async def admin_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or update.effective_user.id != ADMIN_USER_ID: return
     target_user, _ = await _get_target_user_from_command(update, context)
@@ -8151,14 +8202,8 @@ async def admin_force_stop_remote(update: Update, context: ContextTypes.DEFAULT_
     try:
         target_chat_id = int(context.args[0])
 
-        # --- CORRECCIÓN AQUÍ: Quitar disable_notification de get_jobs_by_name ---
-        jobs = context.job_queue.get_jobs_by_name(f"spawn_{target_chat_id}")
-        # ------------------------------------------------------------------------
-
-        for job in jobs:
-            job.schedule_removal()
-
         db.set_group_active(target_chat_id, False)
+        await SPAWN_SCHEDULER.cancel(target_chat_id)
 
         await update.message.reply_text(f"🛑 Juego detenido forzosamente en el grupo `{target_chat_id}`.",
                                         disable_notification=True)
@@ -8180,7 +8225,7 @@ async def force_hoenn_unlock_cmd(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     # 1. Limpiamos la base de datos de este grupo para poder testear de cero
-    db.query_db("DELETE FROM group_events WHERE chat_id = %s AND event_id = 'amelia_hoenn_unlock'", (chat_id,))
+    db.unmark_event_completed(chat_id, 'amelia_hoenn_unlock')
 
     # 2. Marcamos el evento como completado para liberar los spawns de Hoenn
     db.mark_event_completed(chat_id, 'amelia_hoenn_unlock')
@@ -8236,7 +8281,42 @@ async def post_init(application: Application):
     await check_delibird_startup(application)
     await check_jirachi_startup(application)
 
+    # --- DIFUSIONES A MEDIAS ---
+    await resume_broadcasts(application)
 
+    # --- PLANIFICADOR DE APARICIONES (retoma la hora guardada de cada grupo) ---
+    counts = await SPAWN_SCHEDULER.load()
+    logger.info(f"🌿 Apariciones: {counts['resumed']} grupos reanudados, {counts['overdue']} atrasados "
+                f"(repartidos), {counts['new']} nuevos.")
+
+
+async def post_shutdown(application: Application):
+    # Volcamos los contadores que queden en memoria antes de apagar
+    try:
+        db.flush_counters()
+    except Exception as e:
+        logger.error(f"No se pudieron volcar los contadores al apagar: {e}")
+
+
+async def flush_counters_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await db.aio.flush_counters()
+    except Exception as e:
+        logger.error(f"Error en el volcado periódico de contadores: {e}")
+
+
+async def spawn_scheduler_job(context: ContextTypes.DEFAULT_TYPE):
+    """Lanza la aparición de cada grupo al que ya le toca según el planificador."""
+    if not SPAWN_SCHEDULER.loaded:
+        return
+    for chat_id in SPAWN_SCHEDULER.pop_due():
+        if not db.is_group_active(chat_id):
+            await SPAWN_SCHEDULER.cancel(chat_id)
+            continue
+        context.job_queue.run_once(spawn_pokemon, 0, chat_id=chat_id, name=f"spawn_{chat_id}")
+
+
+@background_job
 async def daily_tombola_job(context: ContextTypes.DEFAULT_TYPE):
     # --- LOG DE CONTROL ---
     logger.info("🕒 EJECUTANDO TÓMBOLA DIARIA (SISTEMA GLOBAL)...")
@@ -8250,20 +8330,28 @@ async def daily_tombola_job(context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[InlineKeyboardButton("Probar Suerte ✨", callback_data="tombola_claim_public")]]
     markup = InlineKeyboardMarkup(keyboard)
 
-    active_groups = db.get_active_groups()
-    for chat_id in active_groups:
-        try:
-            msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, parse_mode='Markdown')
-            # Guardamos la tómbola en Supabase
-            db.set_tombola_state(chat_id, msg.message_id, [])
-        except Exception as e:
-            logger.error(f"No se pudo enviar la tómbola al chat {chat_id}: {e}")
+    async def send_tombola(chat_id):
+        msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, parse_mode='Markdown')
+        # Guardamos la tómbola en Supabase (en un hilo, para no frenar los envíos a los demás grupos)
+        await db.aio.set_tombola_state(chat_id, msg.message_id, reset_winners=True)
+
+    await fan_out("tombola_diaria", db.get_active_groups(), send_tombola)
 
 
 def main():
     keep_alive()
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    # Migraciones de esquema (solo hace trabajo si hay alguna versión pendiente)
+    db.init_db()
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .rate_limiter(PriorityRateLimiter())  # Todos los envíos pasan por el control de ritmo global
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- ZONA DE TAREAS PROGRAMADAS (LIMPIA) ---
 
@@ -8318,6 +8406,17 @@ def main():
         name="jirachi_monthly_scheduler"
     )
 
+    # 4.1.1 Inventario de imágenes (y precalentado de file_id si hay chat almacén)
+    application.job_queue.run_once(sticker_manifest_job, 15, name="sticker_manifest")
+
+    # 4.2 Volcado de contadores en memoria (ratio de captura y stickers del mes)
+    application.job_queue.run_repeating(
+        flush_counters_job,
+        interval=db.COUNTER_FLUSH_SECONDS,
+        first=db.COUNTER_FLUSH_SECONDS,
+        name="counter_flush"
+    )
+
     # 5. Incubadora de Huevos (Cada 5 minutos)
     application.job_queue.run_repeating(
         egg_hatch_job,
@@ -8413,6 +8512,8 @@ def main():
         CommandHandler("checkmoney", admin_check_money),
         CommandHandler("setmoney", admin_set_money),
         CommandHandler("listgroups", admin_list_groups),
+        CommandHandler("dbstats", admin_db_stats),
+        CommandHandler("spawnrate", admin_spawn_rate),
 
         CommandHandler("getid", admin_get_id),
         CommandHandler("vermochila", admin_view_inventory),
@@ -8508,10 +8609,9 @@ def main():
         MessageHandler(filters.TEXT & ~filters.COMMAND, process_friend_code_msg),
     ]
     application.add_handlers(all_handlers)
-    for chat_id in db.get_active_groups():
-        initial_delay = random.randint(MIN_SPAWN_TIME, MAX_SPAWN_TIME)
-        application.job_queue.run_once(spawn_pokemon, initial_delay, chat_id=chat_id, name=f"spawn_{chat_id}")
-        logger.info(f"Trabajo de spawn reanudado para el chat activo {chat_id}")
+    # Un solo job revisa el planificador de apariciones (las horas se cargan de la BD en post_init)
+    application.job_queue.run_repeating(spawn_scheduler_job, interval=SPAWN_TICK_SECONDS, first=SPAWN_TICK_SECONDS,
+                                        name="spawn_scheduler")
     application.run_polling()
 
 
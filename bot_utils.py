@@ -1,4 +1,9 @@
 # bot_utils.py
+import hashlib
+import json
+import os
+
+from pokemon_data import POKEMON_FORMS
 
 # Constantes de rareza compartidas
 RARITY_VISUALS = {'C': '🟤', 'B': '🟢', 'A': '🔵', 'S': '🟡', 'SS': '⭐', 'SSS': '🌟'}
@@ -26,3 +31,93 @@ def get_formatted_name(pokemon_data, is_shiny=False):
     # Devolvemos el nombre limpio en negrita.
     # Usamos <b> porque tu bot.py ahora funciona en modo HTML.
     return f"<b>{pokemon_data['name']}</b>{shiny_text}"
+
+
+def get_image_path(pokemon_id, is_shiny_value, form=None, prefer_webp=True):
+    """
+    Genera la ruta de la imagen leyendo el valor exacto guardado (0 al 7) o la forma directamente.
+    Si existe su variante WebP optimizada (ver sticker_assets.py --webp) devuelve esa; prefer_webp=False da el PNG.
+    """
+    if pokemon_id > 20000:
+        region = "Unown"
+    elif pokemon_id > 251:
+        region = "Hoenn"
+    elif pokemon_id > 151:
+        region = "Johto"
+    else:
+        region = "Kanto"
+
+    is_true_shiny = (is_shiny_value % 2 != 0)  # Si es impar (1, 3, 5, 7) es Shiny
+    base_form_val = is_shiny_value - 1 if is_true_shiny else is_shiny_value
+
+    shiny_str = 'Shiny/' if is_true_shiny else ''
+    s_suffix = 's' if is_true_shiny else ''
+
+    if pokemon_id in POKEMON_FORMS:
+        if form:
+            form_letter = form
+        else:
+            form_letter = POKEMON_FORMS[pokemon_id].get(base_form_val, ('A', ''))[0]
+        path = f"Stickers/{region}/{shiny_str}{pokemon_id}{form_letter}{s_suffix}.png"
+    else:
+        path = f"Stickers/{region}/{shiny_str}{pokemon_id}{s_suffix}.png"
+
+    return resolve_sticker_file(path) if prefer_webp else path
+
+
+# --- VARIANTES WEBP DE LOS STICKERS ---
+# `python sticker_assets.py --webp` genera Stickers/webp/<hash del PNG>.webp y un índice PNG -> WebP.
+# Si no se ha generado (o el PNG cambió después), se sigue usando el PNG de siempre.
+WEBP_INDEX_PATH = "Stickers/webp/index.json"
+_webp_index = None
+_hash_cache = {}  # ruta -> (mtime_ns, tamaño, hash): solo releemos el fichero si cambia
+
+
+def content_hash(path):
+    """Hash corto del contenido de un fichero (lanza FileNotFoundError si no existe)."""
+    st = os.stat(path)
+    cached = _hash_cache.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    _hash_cache[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def peek_content_hash(path):
+    """El hash ya calculado si el fichero no ha cambiado; None si hay que leerlo (content_hash)."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _hash_cache.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    return None
+
+
+def load_webp_index(reload=False):
+    global _webp_index
+    if _webp_index is None or reload:
+        try:
+            with open(WEBP_INDEX_PATH, encoding='utf-8') as f:
+                _webp_index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _webp_index = {}
+    return _webp_index
+
+
+def resolve_sticker_file(png_path):
+    """
+    La variante WebP de esa imagen si está generada y al día; si no, el propio PNG.
+    Se llama desde los handlers: no lee el PNG, solo compara con el hash que ya esté en caché
+    (el inventario de arranque los calcula todos en el executor). Sin hash en caché se confía en el índice.
+    """
+    entry = load_webp_index().get(png_path)
+    if not entry or not os.path.exists(entry['webp']):
+        return png_path
+    png_hash = peek_content_hash(png_path)
+    if png_hash is not None and png_hash != entry['hash']:
+        return png_path  # El PNG se retocó después de generar el WebP
+    return entry['webp']
@@ -8,3 +8,7 @@ TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 # El ID del admin puede ser público sin tanto riesgo, pero también podrías ocultarlo igual.
 # De momento lo dejamos así o lo cogemos del entorno si prefieres.
 ADMIN_USER_ID = int(os.environ.get("ADMIN_USER_ID", 118012153))
+
+# Chat (canal o grupo privado) donde el bot sube cada imagen una vez al arrancar para tener su file_id.
+# Si no se configura, las imágenes se suben la primera vez que se usan.
+STICKER_STORAGE_CHAT_ID = int(os.environ["STICKER_STORAGE_CHAT_ID"]) if os.environ.get("STICKER_STORAGE_CHAT_ID") else None
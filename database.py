@@ -1,31 +1,176 @@
 import os
+import re
+import sys
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool # <--- CAMBIO IMPORTANTE AQUI
+from psycopg2.pool import ThreadedConnectionPool, PoolError # <--- CAMBIO IMPORTANTE AQUI
 from psycopg2.extras import RealDictCursor
 import sqlite3
 import json
+import time
+import random
+import asyncio
+import functools
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pokemon_data import POKEMON_BY_ID, UNOWN_IDS
+from bot_utils import get_rarity, DUPLICATE_MONEY_VALUES
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Máximo de conexiones simultáneas contra la BD (piscina y ejecutor async comparten el límite)
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 5))
+
+# Ajustes de la piscina (todos por variable de entorno)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # Segundos esperando carril libre
+DB_PREPING_IDLE = float(os.environ.get("DB_PREPING_IDLE", 60))  # Conexiones paradas más de esto se comprueban
+DB_MAX_RETRIES = int(os.environ.get("DB_MAX_RETRIES", 3))
+DB_RETRY_BASE = float(os.environ.get("DB_RETRY_BASE", 0.2))  # Espera del primer reintento (luego se dobla)
+DB_RETRY_CAP = float(os.environ.get("DB_RETRY_CAP", 5))  # Espera máxima entre reintentos
+
+
+class PoolTimeout(PoolError):
+    """Todos los carriles siguen ocupados después de esperar DB_POOL_TIMEOUT segundos."""
+
+
+class ResilientPool:
+    """
+    Envoltorio de ThreadedConnectionPool con la misma interfaz (getconn / putconn):
+    - Si no hay carril libre, el hilo ESPERA su turno (hasta `timeout`) en vez de llevarse un PoolError.
+    - Las conexiones que llevan rato paradas se comprueban con un SELECT 1 antes de entregarlas;
+      las muertas (cortes de Supabase) se tiran y se abre otra.
+    - Lleva contadores para monitorizar: ver stats().
+    """
+
+    def __init__(self, minconn, maxconn, dsn, timeout=DB_POOL_TIMEOUT, preping_idle=DB_PREPING_IDLE, **kwargs):
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}  # id(conn) -> momento en que se devolvió a la piscina
+        self.minconn, self.maxconn = minconn, maxconn
+        self.timeout, self.preping_idle = timeout, preping_idle
+        self._counters = {'checkouts': 0, 'in_use': 0, 'waits': 0, 'wait_time': 0.0, 'timeouts': 0,
+                          'failures': 0, 'retries': 0, 'discarded': 0}
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            # Cola de espera: el semáforo despierta a los hilos según se liberan carriles
+            self.count('waits')
+            if not self._slots.acquire(timeout=self.timeout):
+                self.count('timeouts')
+                raise PoolTimeout(f"Sin conexiones libres tras {self.timeout}s")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self.count('failures')
+            self._slots.release()
+            raise
+        with self._lock:
+            self._counters['checkouts'] += 1
+            self._counters['in_use'] += 1
+            self._counters['wait_time'] += time.monotonic() - start
+        return conn
+
+    def _checkout(self):
+        # Como mucho probamos tantas conexiones como carriles hay: si todas están muertas, se abre una nueva
+        for _ in range(self.maxconn + 1):
+            conn = self._pool.getconn()
+            with self._lock:
+                last_used = self._last_used.pop(id(conn), None)
+            if not conn.closed and last_used is not None and time.monotonic() - last_used < self.preping_idle:
+                return conn
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                return conn
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                self.count('discarded')
+                self._pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No se pudo obtener una conexión válida de la piscina")
+
+    def putconn(self, conn, close=False):
+        try:
+            close = close or bool(conn.closed)
+            if close:
+                self.count('discarded')
+            else:
+                with self._lock:
+                    self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self._counters['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        """Copia de los contadores (más el tamaño configurado) para el panel de admin."""
+        with self._lock:
+            data = dict(self._counters)
+        data.update(minconn=self.minconn, maxconn=self.maxconn)
+        return data
+
+
 _db_pool = None
 
 def get_pool():
     global _db_pool
     if _db_pool is None and DATABASE_URL:
         try:
-            # Usamos ThreadedConnectionPool para evitar choques entre la Web y Telegram
-            _db_pool = ThreadedConnectionPool(1, 5, DATABASE_URL, sslmode='require')
+            # Piscina con cola de espera: la comparten la Web y Telegram
+            _db_pool = ResilientPool(DB_POOL_MIN, DB_MAX_CONNECTIONS, DATABASE_URL, sslmode='require')
             print("🏊 Piscina multicarril creada con éxito.")
         except Exception as e:
             print(f"❌ Error al crear la piscina: {e}")
     return _db_pool
 
 
+def get_pool_stats():
+    """Contadores de la piscina (None en SQLite o si aún no se ha creado)."""
+    return _db_pool.stats() if _db_pool else None
+
+
+# --- SQLITE LOCAL (staging / pruebas de carga) ---
+# Una sola conexión persistente en modo WAL compartida por todos los hilos (protegida por un lock),
+# en vez de abrir y cerrar el fichero en cada consulta.
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "pokesticker.db")
+_sqlite_conn = None
+_sqlite_lock = threading.RLock()
+
+
+def get_sqlite_connection():
+    """Devuelve la conexión SQLite persistente, creándola y afinándola la primera vez."""
+    global _sqlite_conn
+    with _sqlite_lock:
+        if _sqlite_conn is None:
+            # isolation_level=None: cada sentencia se confirma sola; las transacciones las abrimos a mano
+            conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # Seguro con WAL y mucho más rápido que FULL
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-16000")  # ~16 MB de caché de páginas
+            _sqlite_conn = conn
+    return _sqlite_conn
+
+
+def _sqlite_dict_row(cursor, row):
+    """Filas como diccionarios normales (igual que RealDictCursor en Postgres)."""
+    return {col[0]: row[i] for i, col in enumerate(cursor.description)}
+
+
 def get_connection():
     """Establece conexión con la base de datos PostgreSQL o SQLite."""
     if not DATABASE_URL:
         # Fallback a SQLite si no hay URL (para pruebas locales)
-        return sqlite3.connect("pokesticker.db")
+        return sqlite3.connect(SQLITE_PATH)
     return psycopg2.connect(DATABASE_URL, sslmode='require')
 
 
@@ -44,152 +189,337 @@ def get_minigame(chat_id, msg_id):
     res = query_db("SELECT * FROM minigames WHERE chat_id = %s AND msg_id = %s", (chat_id, msg_id), one=True,
                    dict_cursor=True)
     if res:
-        # Convertimos los textos JSON a listas de Python
-        res['winners'] = json.loads(res['winners'])
-        res['results'] = json.loads(res['results'])
+        # Ganadores y resultados salen de su propia tabla, en orden de llegada
+        rows = query_db("SELECT user_id, result_text FROM minigame_winners WHERE chat_id = %s AND msg_id = %s "
+                        "ORDER BY claimed_at", (chat_id, msg_id))
+        res['winners'] = [row[0] for row in rows]
+        res['results'] = [row[1] for row in rows]
     return res
 
 
 def update_minigame_winner(chat_id, msg_id, user_id, result_text):
-    """Añade un ganador y su texto de resultado al minijuego."""
-    game = get_minigame(chat_id, msg_id)
-    if not game: return False
-
-    winners = game['winners']
-    results = game['results']
-
-    if user_id in winners: return False  # Ya jugó
-
-    winners.append(user_id)
-    results.append(result_text)
-
-    sql = "UPDATE minigames SET winners = %s, results = %s WHERE chat_id = %s AND msg_id = %s"
-    query_db(sql, (json.dumps(winners), json.dumps(results), chat_id, msg_id))
-    return True
+    """
+    Apunta a un ganador con una sola inserción.
+    Devuelve False si ya había jugado (la clave primaria impide apuntarlo dos veces aunque pulse a la vez).
+    """
+    count = query_db("INSERT INTO minigame_winners (chat_id, msg_id, user_id, result_text, claimed_at) "
+                     "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                     (chat_id, msg_id, user_id, result_text, time.time()))
+    return bool(count)
 
 
 def delete_expired_minigames():
     """Borra los minijuegos que tengan más de 3 días."""
     sql = "DELETE FROM minigames WHERE created_at < NOW() - INTERVAL '3 days'"
     query_db(sql)
+    # Ganadores huérfanos de esos minijuegos
+    query_db("DELETE FROM minigame_winners WHERE NOT EXISTS (SELECT 1 FROM minigames m "
+             "WHERE m.chat_id = minigame_winners.chat_id AND m.msg_id = minigame_winners.msg_id)")
+
+
+# --- MIGRACIONES VERSIONADAS ---
+# Cada versión es una lista de sentencias que se aplica UNA vez y queda apuntada en schema_version.
+# Una versión publicada no se toca nunca: los cambios nuevos van en una versión nueva al final.
+def _schema_migrations(id_type, serial_type):
+    return [
+        # v1: el esquema de siempre (tablas + las columnas que se fueron añadiendo a mano).
+        # En BDs antiguas muchas de estas sentencias fallan porque la columna ya existe: se ignoran.
+        (1, [
+            f'''CREATE TABLE IF NOT EXISTS users (
+                user_id {id_type} PRIMARY KEY, username TEXT, money INTEGER DEFAULT 1000,
+                last_daily_claim TEXT DEFAULT NULL, capture_chance INTEGER DEFAULT 100,
+                stickers_this_month INTEGER DEFAULT 0, kanto_completed INTEGER DEFAULT 0
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS collection (
+                user_id {id_type}, pokemon_id INTEGER, is_shiny INTEGER DEFAULT 0,
+                FOREIGN KEY(user_id) REFERENCES users(user_id), PRIMARY KEY (user_id, pokemon_id, is_shiny)
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS groups (
+                chat_id {id_type} PRIMARY KEY, group_name TEXT, is_active INTEGER DEFAULT 1, is_banned INTEGER DEFAULT 0
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS group_members (
+                chat_id {id_type}, user_id {id_type}, PRIMARY KEY (chat_id, user_id)
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS group_pokedex (
+                chat_id {id_type}, pokemon_id INTEGER, PRIMARY KEY (chat_id, pokemon_id)
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS mailbox (
+                mail_id {serial_type}, recipient_user_id {id_type} NOT NULL, item_type TEXT NOT NULL,
+                item_details TEXT NOT NULL, message TEXT, claimed INTEGER DEFAULT 0,
+                FOREIGN KEY(recipient_user_id) REFERENCES users(user_id)
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS inventory (
+                user_id {id_type}, item_id TEXT NOT NULL, quantity INTEGER NOT NULL,
+                FOREIGN KEY(user_id) REFERENCES users(user_id), PRIMARY KEY (user_id, item_id)
+            )''',
+
+            f'''CREATE TABLE IF NOT EXISTS group_events (
+                chat_id {id_type}, event_id TEXT, completed INTEGER DEFAULT 1, PRIMARY KEY (chat_id, event_id)
+            )''',
+
+            '''CREATE TABLE IF NOT EXISTS system_flags (flag_name TEXT PRIMARY KEY, value INTEGER DEFAULT 0)''',
+
+            # Tabla CÓDIGOS DE AMIGO
+            # Guardamos el timestamp de caducidad (expiry)
+            f'''
+                CREATE TABLE IF NOT EXISTS friend_codes (
+                    user_id {id_type},
+                    game_nick TEXT,
+                    region TEXT,
+                    code TEXT,
+                    expiry_timestamp REAL,
+                    PRIMARY KEY (user_id, code) 
+                )''',
+
+            # Tabla HUEVOS (Incubadora)
+            f'''
+                CREATE TABLE IF NOT EXISTS incubator (
+                    user_id {id_type} PRIMARY KEY,
+                    hatch_time REAL,  -- Timestamp de cuando se abre
+                    pokemon_id INTEGER, -- Qué pokémon saldrá (ya decidido al nacer)
+                    is_shiny INTEGER -- Si será shiny
+                )''',
+
+            # Tabla de Eventos Regionales Programados
+            '''CREATE TABLE IF NOT EXISTS scheduled_events (
+                    event_date TEXT PRIMARY KEY,
+                    region TEXT
+                )''',
+
+            # Tablas que hasta ahora solo existían en Supabase (así SQLite local arranca con todo)
+            f'''CREATE TABLE IF NOT EXISTS minigames (
+                chat_id {id_type}, msg_id {id_type}, web_url TEXT, group_btn_url TEXT,
+                winners TEXT DEFAULT '[]', results TEXT DEFAULT '[]',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (chat_id, msg_id)
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS tombola_state (
+                chat_id {id_type} PRIMARY KEY, msg_id {id_type}, winners TEXT DEFAULT '[]'
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS active_spawns (
+                message_id {id_type} PRIMARY KEY, chat_id {id_type}, sticker_id {id_type}, spawn_time REAL
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS active_events (
+                message_id {id_type} PRIMARY KEY, chat_id {id_type}, event_id TEXT, event_time REAL
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS active_safaris (
+                message_id {id_type} PRIMARY KEY, chat_id {id_type}, sticker_id {id_type},
+                pokemon_id INTEGER, is_shiny INTEGER, rarity TEXT, p_name TEXT, spawn_time REAL,
+                participants TEXT DEFAULT '[]', job_started INTEGER DEFAULT 0
+            )''',
+
+            "ALTER TABLE users ADD COLUMN last_daily_claim TEXT DEFAULT NULL",
+            "ALTER TABLE groups ADD COLUMN is_active INTEGER DEFAULT 1",
+            "ALTER TABLE users ADD COLUMN capture_chance INTEGER DEFAULT 100",
+            "ALTER TABLE users ADD COLUMN stickers_this_month INTEGER DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN kanto_completed INTEGER DEFAULT 0",
+            "ALTER TABLE groups ADD COLUMN group_name TEXT",
+            "ALTER TABLE groups ADD COLUMN is_banned INTEGER DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN notifications_enabled INTEGER DEFAULT 1",
+            "ALTER TABLE group_members ADD COLUMN stickers_this_month INTEGER DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN code_notifications_enabled INTEGER DEFAULT 1",
+            "ALTER TABLE users ADD COLUMN last_delibird_claim TEXT DEFAULT NULL",
+            "ALTER TABLE users ADD COLUMN johto_completed INTEGER DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN hoenn_completed INTEGER DEFAULT 0",
+            "ALTER TABLE group_events ADD COLUMN claim_list TEXT DEFAULT '[]'",
+
+            # --- NUEVO PARA INTERCAMBIOS ---
+            "ALTER TABLE collection ADD COLUMN quantity INTEGER DEFAULT 1",
+            "ALTER TABLE users ADD COLUMN daily_trades INTEGER DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN last_trade_date TEXT DEFAULT NULL",
+        ]),
+
+        # v2: índices para las consultas calientes, la columna de Unown que faltaba y el resumen de colección
+        (2, [
+            "ALTER TABLE users ADD COLUMN unown_completed INTEGER DEFAULT 0",
+            # Resumen de colección por usuario (se mantiene al dar stickers, ver refresh_user_collection_summary)
+            f'''
+                CREATE TABLE IF NOT EXISTS user_collection_summary (
+                    user_id {id_type} PRIMARY KEY,
+                    kanto_count INTEGER DEFAULT 0, johto_count INTEGER DEFAULT 0,
+                    hoenn_count INTEGER DEFAULT 0, unown_count INTEGER DEFAULT 0,
+                    owned_unique INTEGER DEFAULT 0, owned_shiny INTEGER DEFAULT 0, owned_unown INTEGER DEFAULT 0,
+                    rarity_c INTEGER DEFAULT 0, rarity_b INTEGER DEFAULT 0, rarity_a INTEGER DEFAULT 0,
+                    rarity_s INTEGER DEFAULT 0, rarity_ss INTEGER DEFAULT 0, rarity_sss INTEGER DEFAULT 0
+                )''',
+            "CREATE INDEX IF NOT EXISTS idx_collection_user_quantity ON collection (user_id, quantity)",
+            "CREATE INDEX IF NOT EXISTS idx_incubator_hatch_time ON incubator (hatch_time)",
+            "CREATE INDEX IF NOT EXISTS idx_active_spawns_spawn_time ON active_spawns (spawn_time)",
+            "CREATE INDEX IF NOT EXISTS idx_friend_codes_expiry ON friend_codes (expiry_timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (LOWER(username))",
+        ]),
+
+        # v3: quién ha pulsado cada botón, en tablas hijas en vez de listas JSON reescritas en cada clic
+        (3, [
+            f'''CREATE TABLE IF NOT EXISTS minigame_winners (
+                chat_id {id_type}, msg_id {id_type}, user_id {id_type}, result_text TEXT, claimed_at REAL,
+                PRIMARY KEY (chat_id, msg_id, user_id)
+            )''',
+            # Sin hora: de los botones de evento solo se pregunta si el usuario ya pulsó, nunca se listan
+            f'''CREATE TABLE IF NOT EXISTS group_event_claims (
+                chat_id {id_type}, event_id TEXT, user_id {id_type},
+                PRIMARY KEY (chat_id, event_id, user_id)
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS tombola_winners (
+                chat_id {id_type}, user_id {id_type}, line TEXT, claimed_at REAL,
+                PRIMARY KEY (chat_id, user_id)
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS safari_participants (
+                message_id {id_type}, user_id {id_type}, first_name TEXT, joined_at REAL,
+                PRIMARY KEY (message_id, user_id)
+            )''',
+            _migrate_json_claims,
+        ]),
+
+        # v4: regalos masivos guardados una sola vez + marca de reclamado por usuario
+        (4, [
+            "ALTER TABLE users ADD COLUMN created_at REAL",
+            f'''CREATE TABLE IF NOT EXISTS broadcast_mail (
+                broadcast_id {serial_type}, item_type TEXT NOT NULL, item_details TEXT NOT NULL,
+                message TEXT, created_at REAL
+            )''',
+            f'''CREATE TABLE IF NOT EXISTS broadcast_claims (
+                broadcast_id INTEGER, user_id {id_type}, PRIMARY KEY (broadcast_id, user_id)
+            )''',
+        ]),
+
+        # v5: file_id de Telegram de cada imagen de sticker ya subida (ruta + hash del contenido)
+        (5, [
+            '''CREATE TABLE IF NOT EXISTS sticker_file_ids (
+                path TEXT PRIMARY KEY, content_hash TEXT NOT NULL, file_id TEXT NOT NULL, updated_at REAL
+            )''',
+        ]),
+
+        # v6: difusiones (/sendtoall) en segundo plano con cursor para poder reanudarlas
+        (6, [
+            f'''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id {serial_type}, text TEXT NOT NULL, status TEXT DEFAULT 'running',
+                last_user_id {id_type} DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0,
+                skipped INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+                admin_chat_id {id_type}, progress_msg_id INTEGER, created_at REAL, updated_at REAL
+            )''',
+        ]),
+
+        # v7: próxima aparición de cada grupo (timestamp en segundos) para sobrevivir a los reinicios
+        (7, [
+            f"ALTER TABLE groups ADD COLUMN next_spawn_at {id_type}",
+        ]),
+    ]
+
+
+SCHEMA_VERSION = 7
+
+
+def _migrate_json_claims(cursor, ph):
+    """v3: pasa las listas JSON que ya había a las tablas hijas (las columnas viejas se quedan sin usar)."""
+    now = time.time()
+
+    cursor.execute("SELECT chat_id, event_id, claim_list FROM group_events")
+    for chat_id, event_id, claim_list in cursor.fetchall():
+        for user_id in json.loads(claim_list or '[]'):
+            cursor.execute(f"INSERT INTO group_event_claims (chat_id, event_id, user_id) VALUES ({ph}, {ph}, {ph}) "
+                           f"ON CONFLICT DO NOTHING", (chat_id, event_id, user_id))
+
+    cursor.execute("SELECT chat_id, msg_id, winners, results FROM minigames")
+    for chat_id, msg_id, winners, results in cursor.fetchall():
+        # Ganadores y resultados se añadían siempre juntos: van emparejados por posición
+        for pos, (user_id, result_text) in enumerate(zip(json.loads(winners or '[]'), json.loads(results or '[]'))):
+            cursor.execute(f"INSERT INTO minigame_winners (chat_id, msg_id, user_id, result_text, claimed_at) "
+                           f"VALUES ({ph}, {ph}, {ph}, {ph}, {ph}) ON CONFLICT DO NOTHING",
+                           (chat_id, msg_id, user_id, result_text, now + pos))
+
+    cursor.execute("SELECT message_id, participants FROM active_safaris")
+    for message_id, participants in cursor.fetchall():
+        for pos, p in enumerate(json.loads(participants or '[]')):
+            cursor.execute(f"INSERT INTO safari_participants (message_id, user_id, first_name, joined_at) "
+                           f"VALUES ({ph}, {ph}, {ph}, {ph}) ON CONFLICT DO NOTHING",
+                           (message_id, p['id'], p.get('first_name'), now + pos))
+
+    # Las líneas de la tómbola no guardaban el user_id: esa lista solo dura un día y empieza de cero mañana
+
+
+# Códigos de error de Postgres para "ya existe" (columna, tabla/índice, restricción)
+_ALREADY_EXISTS_PGCODES = ('42701', '42P07', '42710')
+
+
+def _is_already_exists(error):
+    """¿El fallo es solo que la columna/tabla ya estaba ahí (BDs anteriores a las migraciones)?"""
+    if getattr(error, 'pgcode', None) in _ALREADY_EXISTS_PGCODES:
+        return True
+    if isinstance(error, sqlite3.OperationalError):
+        text = str(error).lower()
+        return 'duplicate column name' in text or 'already exists' in text
+    return False
 
 
 def init_db():
-    conn = get_connection()
+    """
+    Aplica las migraciones pendientes. Ya NO se ejecuta al importar el módulo:
+    lo llama main() una vez al arrancar. Si el esquema está al día, sale tras una sola consulta.
+    Cada versión va en su propia transacción: o se aplica entera (y se apunta en schema_version)
+    o se deshace y el arranque se detiene con el error.
+    """
     is_sqlite = not DATABASE_URL
-
     if is_sqlite:
-        cursor = conn.cursor()
+        # Sin transacciones implícitas: las abrimos nosotros con BEGIN
+        conn = sqlite3.connect(SQLITE_PATH, isolation_level=None)
     else:
-        conn.autocommit = True
-        cursor = conn.cursor()
-
-    # Tipos de datos
-    id_type = "INTEGER" if is_sqlite else "BIGINT"
-    serial_type = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite else "SERIAL PRIMARY KEY"
-
-    # Tablas Principales
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS users (
-        user_id {id_type} PRIMARY KEY, username TEXT, money INTEGER DEFAULT 1000,
-        last_daily_claim TEXT DEFAULT NULL, capture_chance INTEGER DEFAULT 100,
-        stickers_this_month INTEGER DEFAULT 0, kanto_completed INTEGER DEFAULT 0
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS collection (
-        user_id {id_type}, pokemon_id INTEGER, is_shiny INTEGER DEFAULT 0,
-        FOREIGN KEY(user_id) REFERENCES users(user_id), PRIMARY KEY (user_id, pokemon_id, is_shiny)
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS groups (
-        chat_id {id_type} PRIMARY KEY, group_name TEXT, is_active INTEGER DEFAULT 1, is_banned INTEGER DEFAULT 0
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS group_members (
-        chat_id {id_type}, user_id {id_type}, PRIMARY KEY (chat_id, user_id)
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS group_pokedex (
-        chat_id {id_type}, pokemon_id INTEGER, PRIMARY KEY (chat_id, pokemon_id)
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS mailbox (
-        mail_id {serial_type}, recipient_user_id {id_type} NOT NULL, item_type TEXT NOT NULL,
-        item_details TEXT NOT NULL, message TEXT, claimed INTEGER DEFAULT 0,
-        FOREIGN KEY(recipient_user_id) REFERENCES users(user_id)
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS inventory (
-        user_id {id_type}, item_id TEXT NOT NULL, quantity INTEGER NOT NULL,
-        FOREIGN KEY(user_id) REFERENCES users(user_id), PRIMARY KEY (user_id, item_id)
-    )''')
-
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS group_events (
-        chat_id {id_type}, event_id TEXT, completed INTEGER DEFAULT 1, PRIMARY KEY (chat_id, event_id)
-    )''')
-
-    cursor.execute('''CREATE TABLE IF NOT EXISTS system_flags (flag_name TEXT PRIMARY KEY, value INTEGER DEFAULT 0)''')
-
-    # Tabla CÓDIGOS DE AMIGO
-    # Guardamos el timestamp de caducidad (expiry)
-    cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS friend_codes (
-            user_id {id_type},
-            game_nick TEXT,
-            region TEXT,
-            code TEXT,
-            expiry_timestamp REAL,
-            PRIMARY KEY (user_id, code) 
-        )''')
-
-    # Tabla HUEVOS (Incubadora)
-    cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS incubator (
-            user_id {id_type} PRIMARY KEY,
-            hatch_time REAL,  -- Timestamp de cuando se abre
-            pokemon_id INTEGER, -- Qué pokémon saldrá (ya decidido al nacer)
-            is_shiny INTEGER -- Si será shiny
-        )''')
-
-    # Tabla de Eventos Regionales Programados
-    cursor.execute('''CREATE TABLE IF NOT EXISTS scheduled_events (
-            event_date TEXT PRIMARY KEY,
-            region TEXT
-        )''')
-
-    # --- MIGRACIONES MANUALES (A prueba de fallos) ---
-    # Intentamos añadir las columnas una a una. Si ya existen, el error se ignora.
-    migraciones = [
-        "ALTER TABLE users ADD COLUMN last_daily_claim TEXT DEFAULT NULL",
-        "ALTER TABLE groups ADD COLUMN is_active INTEGER DEFAULT 1",
-        "ALTER TABLE users ADD COLUMN capture_chance INTEGER DEFAULT 100",
-        "ALTER TABLE users ADD COLUMN stickers_this_month INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN kanto_completed INTEGER DEFAULT 0",
-        "ALTER TABLE groups ADD COLUMN group_name TEXT",
-        "ALTER TABLE groups ADD COLUMN is_banned INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN notifications_enabled INTEGER DEFAULT 1",
-        "ALTER TABLE group_members ADD COLUMN stickers_this_month INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN code_notifications_enabled INTEGER DEFAULT 1",
-        "ALTER TABLE users ADD COLUMN last_delibird_claim TEXT DEFAULT NULL",
-        "ALTER TABLE users ADD COLUMN johto_completed INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN hoenn_completed INTEGER DEFAULT 0",
-        "ALTER TABLE group_events ADD COLUMN claim_list TEXT DEFAULT '[]'",
-
-        # --- NUEVO PARA INTERCAMBIOS ---
-        "ALTER TABLE collection ADD COLUMN quantity INTEGER DEFAULT 1",
-        "ALTER TABLE users ADD COLUMN daily_trades INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN last_trade_date TEXT DEFAULT NULL"
-    ]
-
-    for cmd in migraciones:
-        try:
-            cursor.execute(cmd)
-            if not is_sqlite: conn.commit()
-        except Exception:
-            if not is_sqlite: conn.rollback()
-            pass
+        conn = get_connection()
+        conn.autocommit = False
+    cursor = conn.cursor()
 
-    if is_sqlite: conn.commit()
-    conn.close()
+    try:
+        if is_sqlite: cursor.execute("BEGIN")
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT)")
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        row = cursor.fetchone()
+        current = (row[0] if row else None) or 0
+        conn.commit()
+        if current >= SCHEMA_VERSION:
+            return
+
+        # Tipos de datos
+        id_type = "INTEGER" if is_sqlite else "BIGINT"
+        serial_type = "INTEGER PRIMARY KEY AUTOINCREMENT" if is_sqlite else "SERIAL PRIMARY KEY"
+        placeholder = "?" if is_sqlite else "%s"
+
+        for version, statements in _schema_migrations(id_type, serial_type):
+            if version <= current:
+                continue
+            print(f"🛠️ Aplicando migración de esquema v{version}...")
+            if is_sqlite: cursor.execute("BEGIN")
+            try:
+                for sql in statements:
+                    # Cada sentencia en su savepoint: si solo falla porque ya existía, se deshace ella sola
+                    cursor.execute("SAVEPOINT migration_step")
+                    try:
+                        # Además de SQL, una versión puede llevar pasos en Python (migraciones de datos)
+                        if callable(sql):
+                            sql(cursor, placeholder)
+                        else:
+                            cursor.execute(sql)
+                    except Exception as e:
+                        if not _is_already_exists(e):
+                            raise
+                        # Columnas/tablas que ya existían en BDs antiguas: seguimos con la siguiente
+                        cursor.execute("ROLLBACK TO SAVEPOINT migration_step")
+                    cursor.execute("RELEASE SAVEPOINT migration_step")
+
+                cursor.execute(f"INSERT INTO schema_version (version, applied_at) VALUES ({placeholder}, CURRENT_TIMESTAMP)",
+                               (version,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"❌ Migración v{version} fallida, se deshace entera: {e}")
+                raise
+    finally:
+        conn.close()
 
 
 
@@ -197,88 +527,477 @@ def init_db():
 def query_db(query, args=(), one=False, dict_cursor=False):
     """Ejecuta consultas de forma rápida y segura usando el Pool de conexiones."""
 
-    # --- CASO SQLITE (LOCAL) ---
+    # --- DENTRO DE UNA TRANSACCIÓN: usamos su conexión y NO confirmamos todavía ---
+    tx_conn = getattr(_tx_state, 'conn', None)
+    if tx_conn is not None:
+        return _execute(tx_conn, query, args, one, dict_cursor)
+
+    # --- CASO SQLITE (LOCAL, CONEXIÓN PERSISTENTE) ---
     if not DATABASE_URL:
-        conn = sqlite3.connect("pokesticker.db")
-        if dict_cursor: conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(query, args)
-        rv = cursor.fetchall()
-        conn.commit()
-        conn.close()
-        return (rv[0] if rv else None) if one else rv
+        with _sqlite_lock:
+            return _execute(get_sqlite_connection(), query, args, one, dict_cursor)
 
     # --- CASO SUPABASE (POSTGRES CON POOL) ---
     pool = get_pool()
     if not pool: return None
 
-    conn = None
+    # Reintentos acotados con espera exponencial (con algo de azar para no reintentar todos a la vez)
+    for attempt in range(DB_MAX_RETRIES + 1):
+        conn = None
+        try:
+            # Alquilamos una conexión de la piscina (si están todas ocupadas, esperamos turno)
+            conn = pool.getconn()
+            conn.autocommit = True
+            rv = _execute(conn, query, args, one, dict_cursor)
+            # Devolvemos la conexión a la piscina para que otro la use
+            pool.putconn(conn)
+            return rv
+
+        except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+            # Si una conexión de la piscina se puso "mala", la descartamos y reintentamos
+            if conn: pool.putconn(conn, close=True)
+            pool.count('failures')
+            if attempt == DB_MAX_RETRIES:
+                print(f"❌ Base de datos no disponible tras {attempt + 1} intentos: {e}")
+                raise
+            pool.count('retries')
+            time.sleep(min(DB_RETRY_CAP, DB_RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.0))
+        except Exception as e:
+            if conn: pool.putconn(conn)
+            print(f"❌ Error de base de datos: {e}")
+            raise e
+
+
+# --- CAPA ASÍNCRONA ---
+# Los handlers de Telegram corren en el event loop: si llaman a query_db directamente,
+# una consulta lenta congela TODOS los chats. Mandamos el trabajo a un ejecutor propio
+# con tantos hilos como conexiones tiene la piscina, así nunca se pelean por un carril.
+_db_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONNECTIONS, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    """Ejecuta cualquier función síncrona de BD en el ejecutor dedicado y la espera sin bloquear."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+
+async def aquery_db(query, args=(), one=False, dict_cursor=False):
+    """Versión awaitable de query_db."""
+    # En el hilo del ejecutor ya no se ve quién la llamó: lo apuntamos antes de saltar
+    helper = _calling_helper() if QUERY_STATS_ENABLED else None
+    return await run_db(_query_db_from, helper, query, args, one, dict_cursor)
+
+
+def _query_db_from(helper, query, args, one, dict_cursor):
+    _query_origin.helper = helper
+    try:
+        return query_db(query, args, one, dict_cursor)
+    finally:
+        _query_origin.helper = None
+
+
+class _AsyncHelpers:
+    """
+    Versión async de todos los helpers de este módulo:
+    `await db.aio.get_active_spawn(msg_id)` equivale a `db.get_active_spawn(msg_id)` sin bloquear el bot.
+    """
+
+    def __getattr__(self, name):
+        func = globals().get(name)
+        if name.startswith('_') or not callable(func):
+            raise AttributeError(f"database no tiene el helper '{name}'")
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_db(func, *args, **kwargs)
+
+        # Lo guardamos para no crear el envoltorio en cada llamada
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+aio = _AsyncHelpers()
+
+
+# --- TRANSACCIONES ---
+# Guardamos la conexión de la transacción abierta en el hilo actual: cualquier helper
+# (update_money, add_sticker_smart...) llamado dentro del `with` la reutiliza sin saberlo.
+_tx_state = threading.local()
+
+
+@contextmanager
+def transaction():
+    """
+    Unidad de trabajo: UNA conexión y UN commit para varias operaciones.
+
+        with db.transaction():
+            db.update_money(user_id, -500)
+            db.add_item_to_inventory(user_id, 'pack_small_kanto', 1)
+
+    Si algo falla dentro, se deshace todo. Las transacciones anidadas se unen a la exterior.
+    Todo el bloque debe ejecutarse en el mismo hilo (desde async: `await db.run_db(funcion)`).
+    """
+    if getattr(_tx_state, 'conn', None) is not None:
+        yield
+        return
+
+    if not DATABASE_URL:
+        # Retenemos el lock toda la transacción: el resto de hilos esperan a que termine
+        with _sqlite_lock:
+            conn = get_sqlite_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            _tx_state.conn = conn
+            try:
+                yield
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                _tx_state.conn = None
+        return
+
+    pool = get_pool()
+    conn = pool.getconn()
+    conn.autocommit = False
+    _tx_state.conn = conn
     try:
-        # Alquilamos una conexión de la piscina
-        conn = pool.getconn()
+        yield
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _tx_state.conn = None
         conn.autocommit = True
+        pool.putconn(conn)
+
 
-        if dict_cursor:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
+def _execute(conn, query, args, one, dict_cursor):
+    """
+    Ejecuta una consulta sobre una conexión ya abierta (transacción activa o SQLite persistente).
+    Mismo formato de retorno que query_db: filas si la sentencia las produce, contador si no.
+    """
+    start = time.perf_counter()
+    try:
+        if DATABASE_URL:
+            cursor = conn.cursor(cursor_factory=RealDictCursor) if dict_cursor else conn.cursor()
+            cursor.execute(query.replace('?', '%s'), args)
         else:
             cursor = conn.cursor()
+            if dict_cursor: cursor.row_factory = _sqlite_dict_row
+            # Muchos helpers están escritos con %s (Postgres): los adaptamos a ? para SQLite
+            cursor.execute(query.replace('%s', '?'), args)
 
-        # Adaptamos el formato de ? a %s
-        formatted_query = query.replace('?', '%s')
-        cursor.execute(formatted_query, args)
-
-        if query.strip().upper().startswith("SELECT"):
+        if cursor.description is not None:
             rv = cursor.fetchall()
             cursor.close()
-            # Devolvemos la conexión a la piscina para que otro la use
-            pool.putconn(conn)
             return (rv[0] if rv else None) if one else rv
-        else:
-            count = cursor.rowcount
-            cursor.close()
-            pool.putconn(conn)
-            return count
 
-    except (psycopg2.InterfaceError, psycopg2.OperationalError):
-        # Si una conexión de la piscina se puso "mala", la descartamos y reintentamos
-        if conn: pool.putconn(conn, close=True)
-        return query_db(query, args, one, dict_cursor)
-    except Exception as e:
-        if conn: pool.putconn(conn)
-        print(f"❌ Error de base de datos: {e}")
-        raise e
+        count = cursor.rowcount
+        cursor.close()
+        return count
+    finally:
+        if QUERY_STATS_ENABLED:
+            _record_query(query, time.perf_counter() - start)
+
+
+# --- INSTRUMENTACIÓN DE CONSULTAS ---
+# Cada sentencia suma su duración a un histograma por (huella de la consulta, helper que la lanzó).
+# Solo son unos contadores en memoria bajo un lock: se puede dejar siempre encendido.
+QUERY_STATS_ENABLED = os.environ.get("DB_QUERY_STATS", "1") != "0"
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 500))
+
+# Límites superiores de cada cubeta del histograma, en milisegundos (la última es "más de 2,5 s")
+QUERY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+_query_stats = {}  # (huella, helper) -> {'count', 'total', 'max', 'buckets'}
+_slow_queries = deque(maxlen=50)
+_query_stats_lock = threading.Lock()
+
+# Frames que no cuentan como "quien lanzó la consulta"
+_INSTRUMENTATION_FRAMES = {'_execute', 'query_db', 'aquery_db', '_record_query', '_calling_helper'}
+_query_origin = threading.local()  # Helper que lanzó una consulta async (ver aquery_db)
+
+_FP_STRING = re.compile(r"'(?:[^']|'')*'")
+_FP_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_FP_PARAM = re.compile(r"%s|\?")
+_FP_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_FP_SPACES = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=2048)
+def query_fingerprint(query):
+    """
+    Normaliza una consulta para agrupar sus variantes: literales y parámetros pasan a '?',
+    y las listas (IN (...), VALUES (...), (...)) de cualquier tamaño quedan como '(...)'.
+    """
+    fp = _FP_STRING.sub('?', query)
+    fp = _FP_PARAM.sub('?', fp)
+    fp = _FP_NUMBER.sub('?', fp)
+    fp = _FP_LIST.sub('(...)', fp)
+    return _FP_SPACES.sub(' ', fp).strip()
+
+
+def _calling_helper():
+    """Nombre del helper que lanzó la consulta (el primer frame fuera de query_db/_execute)."""
+    origin = getattr(_query_origin, 'helper', None)
+    if origin:
+        return origin
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_name in _INSTRUMENTATION_FRAMES:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    module = frame.f_globals.get('__name__')
+    return frame.f_code.co_name if module == __name__ else f"{module}.{frame.f_code.co_name}"
+
+
+def _record_query(query, elapsed):
+    ms = elapsed * 1000
+    fingerprint = query_fingerprint(query)
+    helper = _calling_helper()
+    bucket = next(i for i, limit in enumerate(QUERY_BUCKETS_MS) if ms <= limit)
+
+    with _query_stats_lock:
+        entry = _query_stats.get((fingerprint, helper))
+        if entry is None:
+            entry = _query_stats[(fingerprint, helper)] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                                           'buckets': [0] * len(QUERY_BUCKETS_MS)}
+        entry['count'] += 1
+        entry['total'] += ms
+        entry['max'] = max(entry['max'], ms)
+        entry['buckets'][bucket] += 1
+        if ms >= DB_SLOW_QUERY_MS:
+            _slow_queries.append({'at': time.time(), 'ms': ms, 'helper': helper, 'query': fingerprint})
+
+    if ms >= DB_SLOW_QUERY_MS:
+        print(f"🐢 Consulta lenta ({ms:.0f} ms) en {helper}: {fingerprint[:200]}")
+
+
+def _bucket_percentile(buckets, count, pct):
+    """Percentil aproximado: límite superior de la cubeta donde cae."""
+    target = count * pct
+    seen = 0
+    for limit, n in zip(QUERY_BUCKETS_MS, buckets):
+        seen += n
+        if seen >= target:
+            return limit
+    return QUERY_BUCKETS_MS[-1]
+
+
+def get_query_stats(limit=10, order_by='total'):
+    """
+    Las consultas que más pesan. order_by: 'total' (tiempo acumulado), 'count', 'max' o 'avg'.
+    Cada fila: {'query', 'helper', 'count', 'total_ms', 'avg_ms', 'max_ms', 'p50_ms', 'p95_ms', 'buckets'}.
+    """
+    with _query_stats_lock:
+        snapshot = [(key, dict(entry, buckets=list(entry['buckets']))) for key, entry in _query_stats.items()]
+
+    rows = []
+    for (fingerprint, helper), entry in snapshot:
+        rows.append({
+            'query': fingerprint, 'helper': helper, 'count': entry['count'],
+            'total_ms': entry['total'], 'avg_ms': entry['total'] / entry['count'], 'max_ms': entry['max'],
+            'p50_ms': _bucket_percentile(entry['buckets'], entry['count'], 0.50),
+            'p95_ms': _bucket_percentile(entry['buckets'], entry['count'], 0.95),
+            'buckets': dict(zip(QUERY_BUCKETS_MS, entry['buckets'])),
+        })
+    key = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms', 'avg': 'avg_ms'}.get(order_by, 'total_ms')
+    rows.sort(key=lambda row: row[key], reverse=True)
+    return rows[:limit] if limit else rows
+
+
+def get_slow_queries(limit=10):
+    """Las últimas consultas que pasaron de DB_SLOW_QUERY_MS (la más reciente primero)."""
+    with _query_stats_lock:
+        recent = list(_slow_queries)
+    return recent[::-1][:limit]
+
+
+def reset_query_stats():
+    with _query_stats_lock:
+        _query_stats.clear()
+        _slow_queries.clear()
+
+
+# --- BUFFER DE CONTADORES (write-behind) ---
+# capture_chance y los stickers del mes se tocan en CADA intento de captura. No son dinero:
+# los acumulamos en memoria y los escribimos por lotes cada pocos segundos (flush_counters),
+# así el camino de captura no espera a la BD. Las lecturas de estos contadores vacían antes el buffer.
+COUNTER_FLUSH_SECONDS = float(os.environ.get("DB_COUNTER_FLUSH_SECONDS", 5))
+
+_counter_lock = threading.Lock()
+_pending_capture_chance = {}  # user_id -> último valor (gana la escritura más reciente)
+_pending_user_stickers = {}  # user_id -> stickers a sumar
+_pending_group_stickers = {}  # (chat_id, user_id) -> stickers a sumar
+# Tanda que se está escribiendo ahora mismo: sigue visible para los lectores hasta que se confirma
+_inflight_capture_chance = {}
+_inflight_user_stickers = {}
+_inflight_group_stickers = {}
+_flush_lock = threading.Lock()  # Un solo volcado a la vez (el periódico y el de los rankings)
+
+
+def _case_update(table, column, key_col, values, additive):
+    """UPDATE ... SET col = CASE key WHEN ? THEN ? ... END WHERE key IN (...) por tandas de _BULK_CHUNK."""
+    items = list(values.items())
+    for start in range(0, len(items), _BULK_CHUNK):
+        chunk = items[start:start + _BULK_CHUNK]
+        cases = " ".join(["WHEN ? THEN ?"] * len(chunk))
+        marks = ", ".join(["?"] * len(chunk))
+        new_value = f"{column} + CASE {key_col} {cases} END" if additive else f"CASE {key_col} {cases} END"
+        query_db(f"UPDATE {table} SET {column} = {new_value} WHERE {key_col} IN ({marks})",
+                 tuple(v for pair in chunk for v in pair) + tuple(key for key, _ in chunk))
+
+
+def flush_counters():
+    """
+    Escribe en la BD todo lo acumulado. Devuelve cuántos contadores se han volcado.
+    Mientras la tanda se escribe queda en _inflight_*: quien lea antes del commit la sigue viendo.
+    Quien necesite los totales de la BD (rankings, reseteos) llama aquí antes de leer: si había otro
+    volcado en marcha, espera a que termine.
+    """
+    global _pending_capture_chance, _pending_user_stickers, _pending_group_stickers
+    global _inflight_capture_chance, _inflight_user_stickers, _inflight_group_stickers
+    with _flush_lock:
+        with _counter_lock:
+            chances, user_stickers, group_stickers = _pending_capture_chance, _pending_user_stickers, _pending_group_stickers
+            if not (chances or user_stickers or group_stickers):
+                return 0
+            _inflight_capture_chance, _inflight_user_stickers, _inflight_group_stickers = chances, user_stickers, group_stickers
+            _pending_capture_chance, _pending_user_stickers, _pending_group_stickers = {}, {}, {}
+
+        try:
+            _write_counters(chances, user_stickers, group_stickers)
+        except Exception as e:
+            # No perdemos nada: lo devolvemos al buffer (sin pisar valores más nuevos) para el siguiente intento
+            print(f"❌ Error volcando contadores: {e}")
+            with _counter_lock:
+                for user_id, chance in chances.items():
+                    _pending_capture_chance.setdefault(user_id, chance)
+                for user_id, delta in user_stickers.items():
+                    _pending_user_stickers[user_id] = _pending_user_stickers.get(user_id, 0) + delta
+                for key, delta in group_stickers.items():
+                    _pending_group_stickers[key] = _pending_group_stickers.get(key, 0) + delta
+                _inflight_capture_chance, _inflight_user_stickers, _inflight_group_stickers = {}, {}, {}
+            raise
+
+        with _counter_lock:
+            _inflight_capture_chance, _inflight_user_stickers, _inflight_group_stickers = {}, {}, {}
+
+    return len(chances) + len(user_stickers) + len(group_stickers)
+
+
+def _write_counters(chances, user_stickers, group_stickers):
+    """La escritura de una tanda de flush_counters, en una sola transacción."""
+    with transaction():
+        if chances:
+            _case_update("users", "capture_chance", "user_id", chances, additive=False)
+        if user_stickers:
+            _case_update("users", "stickers_this_month", "user_id", user_stickers, additive=True)
+
+        # Grupo: de paso registra al usuario en el grupo si no lo estaba (como hacía el helper antiguo)
+        items = list(group_stickers.items())
+        for start in range(0, len(items), _BULK_CHUNK):
+            chunk = items[start:start + _BULK_CHUNK]
+            rows_sql = ", ".join(["(?, ?, ?)"] * len(chunk))
+            query_db(f"INSERT INTO group_members (chat_id, user_id, stickers_this_month) VALUES {rows_sql} "
+                     f"ON CONFLICT (chat_id, user_id) DO UPDATE SET "
+                     f"stickers_this_month = group_members.stickers_this_month + excluded.stickers_this_month",
+                     tuple(v for (chat_id, user_id), delta in chunk for v in (chat_id, user_id, delta)))
 
 
 # --- FUNCIONES DE LÓGICA ---
 
 def get_user_capture_chance(user_id):
+    with _counter_lock:
+        pending = _pending_capture_chance.get(user_id)
+        if pending is None:
+            pending = _inflight_capture_chance.get(user_id)
+    if pending is not None:
+        return pending
     res = query_db("SELECT capture_chance FROM users WHERE user_id = ?", (user_id,), one=True)
     return res[0] if res and res[0] is not None else 100
 
 
 def update_user_capture_chance(user_id, new_chance):
-    query_db("UPDATE users SET capture_chance = ? WHERE user_id = ?", (new_chance, user_id))
+    """Se escribe en el siguiente volcado (flush_counters)."""
+    with _counter_lock:
+        _pending_capture_chance[user_id] = new_chance
 
 
 def increment_monthly_stickers(user_id):
-    query_db("UPDATE users SET stickers_this_month = stickers_this_month + 1 WHERE user_id = ?", (user_id,))
+    """Se escribe en el siguiente volcado (flush_counters)."""
+    with _counter_lock:
+        _pending_user_stickers[user_id] = _pending_user_stickers.get(user_id, 0) + 1
 
 
 def get_monthly_ranking():
+    flush_counters()
     return query_db(
         "SELECT user_id, username, stickers_this_month FROM users WHERE stickers_this_month > 0 ORDER BY stickers_this_month DESC")
 
 
 def reset_monthly_stickers():
+    # Lo pendiente es del mes que se cierra: se vuelca antes de poner a cero
+    flush_counters()
     query_db("UPDATE users SET stickers_this_month = 0")
 
 
+# --- MEMO DE USUARIOS Y MIEMBROS YA GUARDADOS ---
+# Casi todos los handlers empiezan con get_or_create_user + register_user_in_group.
+# Recordamos lo que ya está en la BD para que esas llamadas no toquen la base la segunda vez.
+KNOWN_USERS_MAX = int(os.environ.get("DB_KNOWN_USERS_MAX", 20000))
+
+
+class _LRUMemo:
+    """Diccionario con tope de tamaño: al llenarse olvida lo que lleva más tiempo sin usarse."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, self._MISSING)
+            if value is self._MISSING:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def put(self, key, value=True):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_known_users = _LRUMemo(KNOWN_USERS_MAX)  # user_id -> username guardado (None si no lo sabemos)
+_known_members = _LRUMemo(KNOWN_USERS_MAX)  # (chat_id, user_id)
+
+
+def _memo_allowed():
+    # Dentro de una transacción la escritura aún puede deshacerse: no la damos por guardada
+    return getattr(_tx_state, 'conn', None) is None
+
+
 def register_user_in_group(user_id, chat_id):
+    if (chat_id, user_id) in _known_members:
+        return
     if DATABASE_URL:
         query_db("INSERT INTO group_members (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
                  (chat_id, user_id))
     else:
         query_db("INSERT OR IGNORE INTO group_members (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
+    if _memo_allowed():
+        _known_members.put((chat_id, user_id))
 
 
 def get_users_in_group(chat_id):
@@ -287,9 +1006,7 @@ def get_users_in_group(chat_id):
 
 
 def get_user_unique_kanto_count(user_id):
-    res = query_db("SELECT COUNT(DISTINCT pokemon_id) FROM collection WHERE user_id = ? AND pokemon_id <= 151",
-                   (user_id,), one=True)
-    return res[0] if res else 0
+    return get_user_collection_summary(user_id)['kanto_count']
 
 
 def is_kanto_completed_by_user(user_id):
@@ -309,12 +1026,17 @@ def set_unown_completed_by_user(user_id):
 
 def get_user_unique_unown_count(user_id):
     # Los Unown son todos los que tienen ID mayor de 20000
-    res = query_db("SELECT COUNT(DISTINCT pokemon_id) FROM collection WHERE user_id = ? AND pokemon_id > 20000", (user_id,), one=True)
-    return res[0] if res else 0
+    return get_user_collection_summary(user_id)['unown_count']
 
 # --- MODIFICADO: Sistema de Pokedex Grupal Independiente ---
 def add_pokemon_to_group_pokedex(chat_id, pokemon_id):
     """Registra que un Pokémon ha sido avistado/capturado en este grupo."""
+    # Si ya está en la Pokédex grupal (en memoria), no hace falta ni tocar la BD
+    bit = 1 << pokemon_id
+    cached = _group_dex_cache.get(chat_id)
+    if cached is not None and cached & bit:
+        return
+
     # Bloqueo de Johto
     if 152 <= pokemon_id <= 251:
         if not is_event_completed(chat_id, 'amelia_johto_unlock'): return
@@ -328,38 +1050,115 @@ def add_pokemon_to_group_pokedex(chat_id, pokemon_id):
     else:
         query_db("INSERT OR IGNORE INTO group_pokedex (chat_id, pokemon_id) VALUES (?, ?)", (chat_id, pokemon_id))
 
+    # Write-through: la caché solo se actualiza si ese chat ya estaba cargado (o cargándose)
+    with _group_dex_lock:
+        if chat_id in _group_dex_cache:
+            _group_dex_cache[chat_id] |= bit
+        elif chat_id in _group_dex_pending:
+            _group_dex_pending[chat_id] |= bit
+
+
+# --- CACHÉ EN MEMORIA DE LA POKÉDEX GRUPAL ---
+# Un entero por chat usado como bitset: bit N encendido = el Pokémon #N ya se ha visto en el grupo.
+# Se carga de group_pokedex la primera vez que se pide y luego lo mantiene add_pokemon_to_group_pokedex.
+# El lock solo protege los diccionarios: la carga desde la BD va fuera, para que un chat lento no frene al resto.
+_group_dex_cache = {}
+_group_dex_pending = {}  # chat_id -> bits registrados mientras se carga ese chat
+_group_dex_resets = {}  # chat_id -> nº de reseteos (una carga que se cruza con uno no se guarda)
+_group_dex_lock = threading.Lock()
+
+# Bebés y Unown base que no cuentan para los retos grupales
+GROUP_JOHTO_EXCLUDED = {172, 173, 174, 175, 201, 236, 238, 239, 240}
+GROUP_HOENN_EXCLUDED = {298, 360}
+
+
+def _ids_to_mask(ids):
+    mask = 0
+    for pokemon_id in ids:
+        mask |= 1 << pokemon_id
+    return mask
+
+
+def _mask_to_ids(mask):
+    ids = set()
+    while mask:
+        low_bit = mask & -mask
+        ids.add(low_bit.bit_length() - 1)
+        mask ^= low_bit
+    return ids
+
+
+# Rangos completos de cada región (lo que devuelven los get_group_unique_*_ids)
+_GROUP_DEX_RANGES = {
+    'kanto': _ids_to_mask(range(0, 152)),
+    'johto': _ids_to_mask(range(152, 252)),
+    'hoenn': _ids_to_mask(range(252, 387)),
+}
+# Lo que cuenta para cada reto grupal (151 / 91 / 133)
+GROUP_CHALLENGE_MASKS = {
+    'kanto': _ids_to_mask(range(1, 152)),
+    'johto': _ids_to_mask(p for p in range(152, 252) if p not in GROUP_JOHTO_EXCLUDED),
+    'hoenn': _ids_to_mask(p for p in range(252, 387) if p not in GROUP_HOENN_EXCLUDED),
+}
+
+
+def _get_group_dex_mask(chat_id):
+    mask = _group_dex_cache.get(chat_id)
+    if mask is not None:
+        return mask
+    with _group_dex_lock:
+        _group_dex_pending.setdefault(chat_id, 0)
+        resets = _group_dex_resets.get(chat_id, 0)
+
+    rows = query_db('SELECT pokemon_id FROM group_pokedex WHERE chat_id = ?', (chat_id,))
+    mask = _ids_to_mask(row[0] for row in rows or [])
+
+    with _group_dex_lock:
+        # Lo que se registró durante la carga puede no estar en lo que leímos
+        mask |= _group_dex_pending.pop(chat_id, 0)
+        if chat_id in _group_dex_cache:
+            return _group_dex_cache[chat_id]  # Otra carga llegó antes
+        if _group_dex_resets.get(chat_id, 0) == resets:
+            _group_dex_cache[chat_id] = mask
+        return mask
+
+
+def get_group_region_count(chat_id, region):
+    """Progreso del reto grupal de una región ('kanto', 'johto', 'hoenn') sin exclusiones que filtrar a mano."""
+    return (_get_group_dex_mask(chat_id) & GROUP_CHALLENGE_MASKS[region]).bit_count()
+
 
 def get_group_unique_kanto_ids(chat_id):
     """
     Devuelve los IDs únicos capturados EN ESTE GRUPO.
-    Ya no mira los bolsillos de los usuarios (collection), mira la tabla group_pokedex.
+    Ya no mira los bolsillos de los usuarios (collection), mira la Pokédex grupal (en memoria).
     """
-    rows = query_db('SELECT pokemon_id FROM group_pokedex WHERE chat_id = ? AND pokemon_id <= 151', (chat_id,))
-    return {row[0] for row in rows}
+    return _mask_to_ids(_get_group_dex_mask(chat_id) & _GROUP_DEX_RANGES['kanto'])
 
 def get_group_unique_johto_ids(chat_id):
     """Devuelve los IDs únicos de Johto (152-251) capturados en este grupo."""
-    rows = query_db('SELECT pokemon_id FROM group_pokedex WHERE chat_id = ? AND pokemon_id >= 152 AND pokemon_id <= 251', (chat_id,))
-    return {row[0] for row in rows}
+    return _mask_to_ids(_get_group_dex_mask(chat_id) & _GROUP_DEX_RANGES['johto'])
+
+def get_group_unique_hoenn_ids(chat_id):
+    """Devuelve los IDs únicos de Hoenn (252-386) capturados en este grupo."""
+    return _mask_to_ids(_get_group_dex_mask(chat_id) & _GROUP_DEX_RANGES['hoenn'])
 
 def reset_group_pokedex(chat_id):
     """Elimina el progreso del reto grupal para un grupo específico (Admin)."""
     query_db("DELETE FROM group_pokedex WHERE chat_id = ?", (chat_id,))
+    with _group_dex_lock:
+        _group_dex_cache.pop(chat_id, None)
+        _group_dex_pending.pop(chat_id, None)
+        _group_dex_resets[chat_id] = _group_dex_resets.get(chat_id, 0) + 1
     # Opcional: También podríamos resetear el evento 'kanto_group_challenge' para que puedan ganar el premio otra vez
-    query_db("DELETE FROM group_events WHERE chat_id = ? AND event_id = 'kanto_group_challenge'", (chat_id,))
+    unmark_event_completed(chat_id, 'kanto_group_challenge')
 
 
 def increment_group_monthly_stickers(user_id, chat_id):
-    """Suma 1 punto al ranking de ESTE grupo."""
-    # Primero aseguramos que el usuario esté registrado en el grupo
-    if DATABASE_URL:
-        query_db("INSERT INTO group_members (chat_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
-                 (chat_id, user_id))
-    else:
-        query_db("INSERT OR IGNORE INTO group_members (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
-
-    query_db("UPDATE group_members SET stickers_this_month = stickers_this_month + 1 WHERE chat_id = ? AND user_id = ?",
-             (chat_id, user_id))
+    """Suma 1 punto al ranking de ESTE grupo (se escribe en el siguiente volcado, ver flush_counters)."""
+    with _counter_lock:
+        key = (chat_id, user_id)
+        _pending_group_stickers[key] = _pending_group_stickers.get(key, 0) + 1
 
 
 def get_group_monthly_ranking(chat_id):
@@ -372,11 +1171,13 @@ def get_group_monthly_ranking(chat_id):
     ORDER BY gm.stickers_this_month DESC
     """
     # ¡OJO! Hemos quitado el LIMIT 10
+    flush_counters()
     return query_db(sql, (chat_id,), dict_cursor=False)
 
 
 def reset_group_monthly_stickers():
     """Resetea el contador de TODOS los grupos (se ejecuta a fin de mes)."""
+    flush_counters()
     query_db("UPDATE group_members SET stickers_this_month = 0")
 # ------------------------------------------------------------
 
@@ -387,18 +1188,95 @@ def get_user_money(user_id):
 
 
 def remove_sticker_from_collection(user_id, pokemon_id, is_shiny):
-    count = query_db("DELETE FROM collection WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-                     (user_id, pokemon_id, int(is_shiny)))
-    return count > 0
+    with transaction():
+        res = query_db("DELETE FROM collection WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ? "
+                       "RETURNING quantity", (user_id, pokemon_id, int(is_shiny)), one=True)
+        if res:
+            _apply_summary_delta(user_id, {(int(pokemon_id), int(is_shiny)): res[0]})
+    return res is not None
+
+
+# --- CACHÉ DE ESTADO POR CHAT ---
+# Cada tick de spawn pregunta por los eventos completados del grupo (desbloqueos, misiones legendarias),
+# por los grupos activos y por el evento regional de hoy. Todo eso cambia muy de vez en cuando,
+# así que lo guardamos en memoria y solo los helpers que lo modifican lo actualizan.
+# El cerrojo solo protege los diccionarios: las cargas desde la BD se hacen fuera de él
+# (una consulta lenta no puede frenar a los demás chats). Cada escritura sube la generación;
+# una carga que se cruzó con una escritura devuelve su resultado pero no lo guarda.
+_chat_state_lock = threading.Lock()
+_chat_state_gen = 0
+_chat_events_cache = {}  # chat_id -> set(event_id) de group_events
+_active_groups_cache = None  # frozenset(chat_id) o None si hay que recargar
+_scheduled_event_cache = {}  # 'YYYY-MM-DD' -> región (o None si ese día no hay evento)
+
+
+def _bump_chat_state():
+    """Llamar con _chat_state_lock cogido tras cambiar algo que una carga en curso podría pisar."""
+    global _chat_state_gen
+    _chat_state_gen += 1
+
+
+def _chat_completed_events(chat_id):
+    """Conjunto de eventos completados del chat (se carga de la BD la primera vez)."""
+    with _chat_state_lock:
+        events = _chat_events_cache.get(chat_id)
+        gen = _chat_state_gen
+    if events is not None:
+        return events
+
+    rows = query_db("SELECT event_id FROM group_events WHERE chat_id = ?", (chat_id,))
+    events = {row[0] for row in rows or []}
+    with _chat_state_lock:
+        if gen == _chat_state_gen:
+            events = _chat_events_cache.setdefault(chat_id, events)
+    return events
+
+
+def _cache_event_flag(chat_id, event_id, completed):
+    with _chat_state_lock:
+        _bump_chat_state()
+        events = _chat_events_cache.get(chat_id)
+        if events is not None:
+            if completed:
+                events.add(event_id)
+            else:
+                events.discard(event_id)
+
+
+def _invalidate_active_groups():
+    global _active_groups_cache
+    with _chat_state_lock:
+        _bump_chat_state()
+        _active_groups_cache = None
 
 
 def set_group_active(chat_id, is_active):
     query_db("UPDATE groups SET is_active = ? WHERE chat_id = ?", (1 if is_active else 0, chat_id))
+    _invalidate_active_groups()
 
 
-def get_active_groups():
+def _active_groups_set():
+    global _active_groups_cache
+    with _chat_state_lock:
+        groups = _active_groups_cache
+        gen = _chat_state_gen
+    if groups is not None:
+        return groups
+
     rows = query_db("SELECT chat_id FROM groups WHERE is_active = 1")
-    return [row[0] for row in rows]
+    groups = frozenset(row[0] for row in rows or [])
+    with _chat_state_lock:
+        if gen == _chat_state_gen:
+            _active_groups_cache = groups
+    return groups
+
+
+def get_active_groups():
+    return list(_active_groups_set())
+
+
+def is_group_active(chat_id):
+    return chat_id in _active_groups_set()
 
 
 def get_user_inventory(user_id):
@@ -447,17 +1325,155 @@ def add_mail(recipient_id, item_type, item_details, message):
     )
 
 
-def get_user_mail(user_id):
-    return query_db("SELECT * FROM mailbox WHERE recipient_user_id = ? AND claimed = 0", (user_id,), dict_cursor=True)
+# Filas por sentencia en los INSERT masivos (muy por debajo del límite de parámetros de SQLite y Postgres)
+_BULK_CHUNK = 500
 
 
-def get_mail_item_by_id(mail_id):
-    res = query_db("SELECT * FROM mailbox WHERE mail_id = ?", (mail_id,), one=True, dict_cursor=True)
-    return res
+def add_mail_many(mails):
+    """
+    Mete muchos correos de golpe. mails: lista de (recipient_id, item_type, item_details, message).
+    Un INSERT multi-fila por cada bloque de _BULK_CHUNK, todo dentro de una sola transacción.
+    """
+    mails = list(mails)
+    if not mails:
+        return 0
+
+    with transaction():
+        for start in range(0, len(mails), _BULK_CHUNK):
+            chunk = mails[start:start + _BULK_CHUNK]
+            rows_sql = ", ".join(["(?, ?, ?, ?)"] * len(chunk))
+            query_db(f"INSERT INTO mailbox (recipient_user_id, item_type, item_details, message) VALUES {rows_sql}",
+                     tuple(v for mail in chunk for v in mail))
+    return len(mails)
+
+
+# --- CORREO MASIVO (/sendtoall) ---
+# Un regalo para todos se guarda UNA vez en broadcast_mail. Cada usuario solo deja una marca en
+# broadcast_claims cuando lo reclama. En el buzón aparece con ID "b<número>" junto al correo personal.
+BROADCAST_MAIL_PREFIX = 'b'
+
+# Lo que ve el usuario del regalo masivo: mismas columnas que una fila de mailbox
+_BROADCAST_AS_MAIL_SQL = f"""
+    SELECT '{BROADCAST_MAIL_PREFIX}' || b.broadcast_id AS mail_id, u.user_id AS recipient_user_id,
+           b.item_type, b.item_details, b.message,
+           CASE WHEN c.user_id IS NULL THEN 0 ELSE 1 END AS claimed
+    FROM broadcast_mail b
+    JOIN users u ON u.user_id = ?
+    LEFT JOIN broadcast_claims c ON c.broadcast_id = b.broadcast_id AND c.user_id = u.user_id
+    WHERE COALESCE(u.created_at, 0) <= b.created_at
+"""
+
+
+def parse_mail_id(text):
+    """'123' -> 123 (correo personal), 'b7' -> 'b7' (regalo masivo). Lanza ValueError si no es válido."""
+    text = str(text).strip().lower()
+    if text.startswith(BROADCAST_MAIL_PREFIX):
+        int(text[len(BROADCAST_MAIL_PREFIX):])
+        return text
+    return int(text)
+
+
+def _broadcast_id(mail_id):
+    """Número del regalo masivo, o None si es un correo personal."""
+    if isinstance(mail_id, str) and mail_id.startswith(BROADCAST_MAIL_PREFIX):
+        return int(mail_id[len(BROADCAST_MAIL_PREFIX):])
+    return None
 
 
-def claim_mail_item(mail_id):
-    query_db("UPDATE mailbox SET claimed = 1 WHERE mail_id = ?", (mail_id,))
+def add_broadcast_mail(item_type, item_details, message):
+    """Regalo para todos los usuarios actuales: una sola fila, da igual cuántos jugadores haya."""
+    query_db("INSERT INTO broadcast_mail (item_type, item_details, message, created_at) VALUES (?, ?, ?, ?)",
+             (item_type, item_details, message, time.time()))
+
+
+def get_user_mail(user_id):
+    """Correo pendiente del usuario: el personal y los regalos masivos que aún no ha reclamado."""
+    personal = query_db("SELECT * FROM mailbox WHERE recipient_user_id = ? AND claimed = 0", (user_id,),
+                        dict_cursor=True)
+    broadcast = query_db(_BROADCAST_AS_MAIL_SQL + " AND c.user_id IS NULL ORDER BY b.broadcast_id",
+                         (user_id,), dict_cursor=True)
+    return list(personal or []) + list(broadcast or [])
+
+
+def get_mail_item_by_id(mail_id, user_id=None):
+    """Un correo por ID. Para los regalos masivos hace falta user_id (el 'claimed' es de cada usuario)."""
+    b_id = _broadcast_id(mail_id)
+    if b_id is None:
+        return query_db("SELECT * FROM mailbox WHERE mail_id = ?", (mail_id,), one=True, dict_cursor=True)
+    if user_id is None:
+        return None
+    return query_db(_BROADCAST_AS_MAIL_SQL + " AND b.broadcast_id = ?", (user_id, b_id), one=True, dict_cursor=True)
+
+
+def claim_mail_item(mail_id, user_id=None):
+    """Marca un correo como reclamado. Devuelve False si ya lo estaba (evita cobrarlo dos veces)."""
+    b_id = _broadcast_id(mail_id)
+    if b_id is not None:
+        count = query_db("INSERT INTO broadcast_claims (broadcast_id, user_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                         (b_id, user_id))
+        return bool(count)
+    count = query_db("UPDATE mailbox SET claimed = 1 WHERE mail_id = ? AND claimed = 0", (mail_id,))
+    return bool(count)
+
+
+def claim_all_mail(user_id):
+    """
+    Reclama TODO el buzón (personal + regalos masivos) con un número fijo de consultas:
+    marca y devuelve los correos de golpe, suma el dinero, agrupa los objetos en un solo upsert
+    y entrega los stickers con grant_stickers_bulk. Devuelve un resumen para pintar el mensaje:
+    {'claimed': n, 'money': total, 'items': {item_id: cantidad}, 'stickers': [(id, forma, estado, dinero)]}
+    """
+    with transaction():
+        # 1. Correo personal: marcado y leído en la misma sentencia
+        personal = query_db("UPDATE mailbox SET claimed = 1 WHERE recipient_user_id = ? AND claimed = 0 "
+                            "RETURNING mail_id, item_type, item_details", (user_id,))
+        mails = sorted(personal or [], key=lambda row: row[0])
+
+        # 2. Regalos masivos: solo cuentan los que ESTA llamada consigue marcar
+        pending = query_db(_BROADCAST_AS_MAIL_SQL + " AND c.user_id IS NULL ORDER BY b.broadcast_id",
+                           (user_id,), dict_cursor=True)
+        if pending:
+            ids = [_broadcast_id(mail['mail_id']) for mail in pending]
+            rows_sql = ", ".join(["(?, ?)"] * len(ids))
+            claimed_ids = {row[0] for row in query_db(
+                f"INSERT INTO broadcast_claims (broadcast_id, user_id) VALUES {rows_sql} "
+                f"ON CONFLICT DO NOTHING RETURNING broadcast_id",
+                tuple(v for b_id in ids for v in (b_id, user_id)))}
+            mails += [(mail['mail_id'], mail['item_type'], mail['item_details']) for mail in pending
+                      if _broadcast_id(mail['mail_id']) in claimed_ids]
+
+        # 3. Agrupamos
+        summary = {'claimed': len(mails), 'money': 0, 'items': {}, 'stickers': []}
+        cards = []
+        for _, item_type, item_details in mails:
+            if item_type == 'money':
+                summary['money'] += int(item_details)
+            elif item_type == 'inventory_item':
+                summary['items'][item_details] = summary['items'].get(item_details, 0) + 1
+            elif item_type == 'single_sticker':
+                poke_id, is_shiny = map(int, item_details.split('_'))
+                if poke_id in POKEMON_BY_ID:
+                    cards.append((poke_id, is_shiny))
+
+        # 4. Stickers de golpe; los que ya tenía al máximo se pagan en dinero
+        for (poke_id, is_shiny), status in zip(cards, grant_stickers_bulk(user_id, cards)):
+            money = 0
+            if status == 'MAX':
+                rarity = get_rarity(POKEMON_BY_ID[poke_id]['category'], is_shiny)
+                money = DUPLICATE_MONEY_VALUES.get(rarity, 100)
+                summary['money'] += money
+            summary['stickers'].append((poke_id, is_shiny, status, money))
+
+        # 5. Objetos en un único upsert multi-fila y el dinero en un solo UPDATE
+        if summary['items']:
+            rows_sql = ", ".join(["(?, ?, ?)"] * len(summary['items']))
+            query_db(f"INSERT INTO inventory (user_id, item_id, quantity) VALUES {rows_sql} "
+                     f"ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = inventory.quantity + excluded.quantity",
+                     tuple(v for item_id, qty in summary['items'].items() for v in (user_id, item_id, qty)))
+        if summary['money'] > 0:
+            update_money(user_id, summary['money'])
+
+    return summary
 
 
 def add_group(chat_id, group_name=None):
@@ -472,6 +1488,8 @@ def add_group(chat_id, group_name=None):
         query_db("INSERT OR IGNORE INTO groups (chat_id, group_name) VALUES (?, ?)", (chat_id, group_name))
         if group_name:
             query_db("UPDATE groups SET group_name = ? WHERE chat_id = ?", (group_name, chat_id))
+    # Un grupo nuevo nace activo: que la próxima consulta recargue la lista
+    _invalidate_active_groups()
 
 
 def get_all_groups_info():
@@ -485,12 +1503,20 @@ def get_all_groups():
 
 
 def get_or_create_user(user_id, username):
+    # Ya guardado y con el mismo nombre: nada que hacer (sin ir a la BD)
+    known = _known_users.get(user_id, _LRUMemo._MISSING)
+    if known is not _LRUMemo._MISSING and (not username or known == username):
+        return
+
     res = query_db("SELECT user_id FROM users WHERE user_id = ?", (user_id,), one=True)
     if not res:
-        query_db("INSERT INTO users (user_id, username) VALUES (?, ?)",
-                 (user_id, username if username else f"User_{user_id}"))
+        username = username if username else f"User_{user_id}"
+        query_db("INSERT INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
+                 (user_id, username, time.time()))
     elif username:
         query_db("UPDATE users SET username = ? WHERE user_id = ? AND username != ?", (username, user_id, username))
+    if _memo_allowed():
+        _known_users.put(user_id, username or None)
 
 
 def check_sticker_owned(user_id, pokemon_id, is_shiny):
@@ -500,12 +1526,16 @@ def check_sticker_owned(user_id, pokemon_id, is_shiny):
 
 
 def add_sticker_to_collection(user_id, pokemon_id, is_shiny):
-    if DATABASE_URL:
-        query_db("INSERT INTO collection (user_id, pokemon_id, is_shiny) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
-                 (user_id, pokemon_id, int(is_shiny)))
-    else:
-        query_db("INSERT OR IGNORE INTO collection (user_id, pokemon_id, is_shiny) VALUES (?, ?, ?)",
-                 (user_id, pokemon_id, int(is_shiny)))
+    with transaction():
+        if DATABASE_URL:
+            res = query_db("INSERT INTO collection (user_id, pokemon_id, is_shiny) VALUES (?, ?, ?) "
+                           "ON CONFLICT DO NOTHING RETURNING quantity", (user_id, pokemon_id, int(is_shiny)), one=True)
+        else:
+            res = query_db("INSERT OR IGNORE INTO collection (user_id, pokemon_id, is_shiny) VALUES (?, ?, ?) "
+                           "RETURNING quantity", (user_id, pokemon_id, int(is_shiny)), one=True)
+        # Solo hay fila devuelta si se insertó (si ya existía, nada cambia)
+        if res:
+            _apply_summary_delta(user_id, {(int(pokemon_id), int(is_shiny)): None})
 
 
 def update_money(user_id, amount):
@@ -518,20 +1548,39 @@ def get_all_user_ids():
 
 
 def clear_user_mailbox(user_id):
-    return query_db("DELETE FROM mailbox WHERE recipient_user_id = ? AND claimed = 0", (user_id,))
+    with transaction():
+        count = query_db("DELETE FROM mailbox WHERE recipient_user_id = ? AND claimed = 0", (user_id,))
+        # Los regalos masivos no se pueden borrar solo para él: los damos por reclamados
+        count += query_db("INSERT INTO broadcast_claims (broadcast_id, user_id) "
+                          "SELECT b.broadcast_id, u.user_id FROM broadcast_mail b JOIN users u ON u.user_id = ? "
+                          "WHERE COALESCE(u.created_at, 0) <= b.created_at ON CONFLICT DO NOTHING", (user_id,))
+    return count
 
 
 def clear_all_mailboxes():
-    return query_db("DELETE FROM mailbox WHERE claimed = 0")
+    with transaction():
+        count = query_db("DELETE FROM mailbox WHERE claimed = 0")
+        count += query_db("DELETE FROM broadcast_mail")
+        query_db("DELETE FROM broadcast_claims")
+    return count
 
 
 def remove_mail_item_by_id(mail_id):
+    b_id = _broadcast_id(mail_id)
+    if b_id is not None:
+        with transaction():
+            count = query_db("DELETE FROM broadcast_mail WHERE broadcast_id = ?", (b_id,))
+            query_db("DELETE FROM broadcast_claims WHERE broadcast_id = ?", (b_id,))
+        return count > 0
     count = query_db("DELETE FROM mailbox WHERE mail_id = ?", (mail_id,))
     return count > 0
 
 
 def clear_user_collection(user_id):
-    return query_db("DELETE FROM collection WHERE user_id = ?", (user_id,))
+    with transaction():
+        count = query_db("DELETE FROM collection WHERE user_id = ?", (user_id,))
+        refresh_user_collection_summary(user_id)
+    return count
 
 
 def mark_event_completed(chat_id, event_id):
@@ -540,11 +1589,17 @@ def mark_event_completed(chat_id, event_id):
                  (chat_id, event_id))
     else:
         query_db("INSERT OR IGNORE INTO group_events (chat_id, event_id) VALUES (?, ?)", (chat_id, event_id))
+    _cache_event_flag(chat_id, event_id, True)
+
+
+def unmark_event_completed(chat_id, event_id):
+    """Borra el evento del grupo (para poder repetirlo)."""
+    query_db("DELETE FROM group_events WHERE chat_id = ? AND event_id = ?", (chat_id, event_id))
+    _cache_event_flag(chat_id, event_id, False)
 
 
 def is_event_completed(chat_id, event_id):
-    res = query_db("SELECT 1 FROM group_events WHERE chat_id = ? AND event_id = ?", (chat_id, event_id), one=True)
-    return res is not None
+    return event_id in _chat_completed_events(chat_id)
 
 
 def set_money(user_id, amount):
@@ -576,6 +1631,7 @@ def ban_group(chat_id):
         ON CONFLICT(chat_id) DO UPDATE SET is_active = 0, is_banned = 1;
         """
     query_db(sql, (chat_id,))
+    _invalidate_active_groups()
 
 def unban_group(chat_id):
     query_db("UPDATE groups SET is_banned = 0 WHERE chat_id = ?", (chat_id,))
@@ -600,31 +1656,255 @@ def is_user_notification_enabled(user_id):
     return res[0] != 0 if res else True
 
 
-def add_sticker_smart(user_id, pokemon_id, is_shiny):
-    res = query_db("SELECT quantity FROM collection WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-                   (user_id, pokemon_id, int(is_shiny)), one=True)
+# Upsert único: inserta con cantidad 1 o sube la cantidad (máximo 2) y devuelve la cantidad que tenía ANTES.
+# Cada cantidad nueva sale de una sola cantidad previa, así que "nueva - 1" es la de antes:
+# - Fila nueva o "Pokémon Fantasma" (qty <= 0)  -> devuelve 0 (no lo tenía)
+# - Tenía 1                                      -> devuelve 1
+# - Ya tenía 2 o más: el WHERE descarta el UPDATE -> no devuelve fila
+_STICKER_UPSERT_SQL = """
+    INSERT INTO collection (user_id, pokemon_id, is_shiny, quantity) VALUES (?, ?, ?, 1)
+    ON CONFLICT (user_id, pokemon_id, is_shiny) DO UPDATE
+    SET quantity = CASE WHEN COALESCE(collection.quantity, 0) <= 0 THEN 1 ELSE collection.quantity + 1 END
+    WHERE COALESCE(collection.quantity, 0) < 2
+    RETURNING quantity - 1 AS previous_quantity
+"""
+
 
+def _sticker_status_from_upsert(res):
+    """Traduce la cantidad previa que devuelve el upsert al estado de siempre: 'NEW', 'DUPLICATE' o 'MAX'."""
     if not res:
-        # No lo tiene, insertar
-        add_sticker_to_collection(user_id, pokemon_id, is_shiny)
-        return 'NEW'
+        return 'MAX'
+    previous_quantity = res[0]
+    return 'NEW' if previous_quantity <= 0 else 'DUPLICATE'
+
+
+def _grant_sticker(user_id, pokemon_id, is_shiny, before=None):
+    """
+    El upsert a secas, sin tocar el resumen. Devuelve 'NEW', 'DUPLICATE' o 'MAX'.
+    Si es NEW y se pasa `before`, apunta lo que había ({(p, s): cantidad previa, o None si no había fila})
+    para aplicar después el delta del resumen (_apply_summary_delta).
+    """
+    key = (int(pokemon_id), int(is_shiny))
+    if DATABASE_URL:
+        # xmax = 0 solo en filas recién insertadas: distingue "no había fila" de un fantasma con qty 0
+        res = query_db(_STICKER_UPSERT_SQL + ", (xmax = 0) AS inserted", (user_id,) + key, one=True)
+        existed = res is None or not res[1]
+    else:
+        # SQLite: la transacción tiene el lock de escritura, así que la lectura previa es exacta
+        existed = query_db("SELECT 1 FROM collection WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
+                           (user_id,) + key, one=True) is not None
+        res = query_db(_STICKER_UPSERT_SQL, (user_id,) + key, one=True)
+
+    status = _sticker_status_from_upsert(res)
+    if status == 'NEW' and before is not None and key not in before:
+        before[key] = res[0] if existed else None
+    return status
+
+
+def add_sticker_smart(user_id, pokemon_id, is_shiny):
+    """Añade un sticker a la colección y devuelve 'NEW', 'DUPLICATE' o 'MAX'."""
+    with transaction():
+        before = {}
+        status = _grant_sticker(user_id, pokemon_id, is_shiny, before)
+        # Repetidos y MAX no cambian el resumen: solo se toca si el sticker entra en la colección
+        if status == 'NEW':
+            _apply_summary_delta(user_id, before)
+    return status
 
-    qty = res[0]
 
-    if qty <= 0:
-        # Reparación de "Pokémon Fantasma"
-        query_db("UPDATE collection SET quantity = 1 WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-                 (user_id, pokemon_id, int(is_shiny)))
-        return 'NEW'
+def grant_stickers_bulk(user_id, cards):
+    """
+    Entrega muchos stickers de golpe (sobres, multisobre...).
+    cards: lista de (pokemon_id, valor_forma). Devuelve la lista de estados ('NEW', 'DUPLICATE', 'MAX')
+    en el MISMO orden, como si se hubiera llamado a add_sticker_smart carta a carta, pero con
+    un número fijo de consultas dentro de una sola transacción.
+    """
+    cards = [(int(p_id), int(s_val)) for p_id, s_val in cards]
+    if not cards:
+        return []
+
+    keys = list(dict.fromkeys(cards))
+    key_params = [v for key in keys for v in key]
+    in_values = ", ".join(["(?, ?)"] * len(keys))
+    lock = " FOR UPDATE" if DATABASE_URL else ""
+
+    with transaction():
+        # 0. Fila de partida (qty 0) para las cartas que no tenía: así el FOR UPDATE de abajo también las
+        #    bloquea y dos entregas simultáneas de la misma carta nueva no salen las dos 'NEW'.
+        #    Todas acaban con qty >= 1 en el paso 3, no quedan fantasmas.
+        rows_sql = ", ".join(["(?, ?, ?, 0)"] * len(keys))
+        inserted = query_db(
+            f"INSERT INTO collection (user_id, pokemon_id, is_shiny, quantity) VALUES {rows_sql} "
+            f"ON CONFLICT DO NOTHING RETURNING pokemon_id, is_shiny",
+            tuple(v for key in keys for v in (user_id, key[0], key[1])))
+        inserted = {(row[0], row[1]) for row in inserted or []}
+
+        # 1. Cantidades actuales de todas las cartas implicadas (una sola lectura)
+        rows = query_db(
+            f"SELECT pokemon_id, is_shiny, quantity FROM collection "
+            f"WHERE user_id = ? AND (pokemon_id, is_shiny) IN (VALUES {in_values}){lock}",
+            tuple([user_id] + key_params))
+        quantities = {(row[0], row[1]): row[2] for row in rows}
+        original = dict(quantities)
+
+        # 2. Simulamos add_sticker_smart carta a carta en memoria
+        statuses = []
+        for key in cards:
+            qty = quantities.get(key) or 0
+            if qty <= 0:
+                quantities[key] = 1
+                statuses.append('NEW')
+            elif qty == 1:
+                quantities[key] = 2
+                statuses.append('DUPLICATE')
+            else:
+                statuses.append('MAX')
+
+        # 3. Escribimos solo lo que ha cambiado en un único upsert multi-fila
+        changed = [key for key in keys if quantities.get(key) != original.get(key)]
+        if changed:
+            rows_sql = ", ".join(["(?, ?, ?, ?)"] * len(changed))
+            params = [v for key in changed for v in (user_id, key[0], key[1], quantities[key])]
+            query_db(
+                f"INSERT INTO collection (user_id, pokemon_id, is_shiny, quantity) VALUES {rows_sql} "
+                f"ON CONFLICT (user_id, pokemon_id, is_shiny) DO UPDATE SET quantity = excluded.quantity",
+                tuple(params))
+
+        # 4. Un solo delta del resumen para todo el sobre (y solo si ha entrado algo nuevo)
+        new_keys = {key for key, status in zip(cards, statuses) if status == 'NEW'}
+        if new_keys:
+            _apply_summary_delta(user_id, {key: None if key in inserted else original.get(key)
+                                           for key in new_keys})
+
+    return statuses
+
+
+# --- RESUMEN DE COLECCIÓN POR USUARIO ---
+# Una fila por usuario con los contadores del Álbumdex y de los premios de álbum completo.
+# Se actualiza con un delta dentro de la misma transacción que da/quita el sticker, y solo cuando cambia
+# lo que el usuario posee (sticker nuevo, intercambio, admin). El recálculo completo queda para el
+# relleno perezoso de usuarios antiguos y para vaciar una colección. Leerla es una consulta por clave primaria.
+_SUMMARY_RARITY_COLUMNS = {'C': 'rarity_c', 'B': 'rarity_b', 'A': 'rarity_a',
+                           'S': 'rarity_s', 'SS': 'rarity_ss', 'SSS': 'rarity_sss'}
+_SUMMARY_COLUMNS = ['kanto_count', 'johto_count', 'hoenn_count', 'unown_count',
+                    'owned_unique', 'owned_shiny', 'owned_unown'] + list(_SUMMARY_RARITY_COLUMNS.values())
+
+
+def _compute_collection_summary(rows):
+    """
+    Calcula los contadores a partir de las filas (pokemon_id, is_shiny, quantity) de un usuario.
+    - *_count: especies registradas (cualquier fila, también los fantasmas de qty=0), como los premios de álbum.
+    - owned_* y rarezas: solo lo que tiene ahora (qty >= 1), como el Álbumdex.
+    """
+    registered = {row[0] for row in rows}
+    owned = {(row[0], row[1]) for row in rows if (row[2] or 0) >= 1}
+
+    summary = {
+        'kanto_count': sum(1 for p in registered if p <= 151),
+        # Johto: 152-251 sin el 201 base, +1 si tiene CUALQUIER Unown (Efecto Espejo)
+        'johto_count': sum(1 for p in registered if 152 <= p <= 251 and p != 201)
+                       + (1 if any(p > 20000 for p in registered) else 0),
+        # Hoenn: sin Azurill ni Wynaut (bebés)
+        'hoenn_count': sum(1 for p in registered if 252 <= p <= 386 and p not in (298, 360)),
+        'unown_count': sum(1 for p in registered if p > 20000),
+        'owned_unique': len({201 if p in UNOWN_IDS else p for p, _ in owned}),
+        'owned_shiny': len({201 if p in UNOWN_IDS else p for p, s in owned if s == 1}),
+        'owned_unown': len({p for p, _ in owned if p in UNOWN_IDS}),
+    }
+
+    rarity_counts = {code: 0 for code in _SUMMARY_RARITY_COLUMNS}
+    for p, s in owned:
+        pokemon_data = POKEMON_BY_ID.get(p)
+        if pokemon_data:
+            final_rarity = get_rarity(pokemon_data['category'], s)
+            if final_rarity in rarity_counts: rarity_counts[final_rarity] += 1
+    for code, column in _SUMMARY_RARITY_COLUMNS.items():
+        summary[column] = rarity_counts[code]
+
+    return summary
+
+
+def _summary_with_rarities(summary):
+    summary = dict(summary)
+    summary['rarity_counts'] = {code: summary[col] or 0 for code, col in _SUMMARY_RARITY_COLUMNS.items()}
+    return summary
+
+
+def refresh_user_collection_summary(user_id, overwrite=True):
+    """
+    Recalcula y guarda el resumen de un usuario. Devuelve el resumen (dict).
+    Con overwrite=False no pisa una fila que ya exista (relleno perezoso de usuarios antiguos).
+    """
+    with transaction():
+        if DATABASE_URL:
+            # Serializamos los refrescos del mismo usuario: el segundo espera y ya ve los cambios del primero
+            query_db("SELECT 1 FROM users WHERE user_id = ? FOR UPDATE", (user_id,))
+        rows = query_db("SELECT pokemon_id, is_shiny, quantity FROM collection WHERE user_id = ?", (user_id,))
+        summary = _compute_collection_summary(rows)
+
+        columns = ", ".join(_SUMMARY_COLUMNS)
+        placeholders = ", ".join(["?"] * (len(_SUMMARY_COLUMNS) + 1))
+        if overwrite:
+            conflict = "DO UPDATE SET " + ", ".join(f"{col} = excluded.{col}" for col in _SUMMARY_COLUMNS)
+        else:
+            conflict = "DO NOTHING"
+        query_db(
+            f"INSERT INTO user_collection_summary (user_id, {columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT (user_id) {conflict}",
+            tuple([user_id] + [summary[col] for col in _SUMMARY_COLUMNS]))
 
-    elif qty == 1:
-        # Tiene 1, subimos a 2
-        query_db("UPDATE collection SET quantity = 2 WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-                 (user_id, pokemon_id, int(is_shiny)))
-        return 'DUPLICATE'
+    return _summary_with_rarities(summary)
 
-    # Tiene 2 o más
-    return 'MAX'
+
+def _apply_summary_delta(user_id, before):
+    """
+    Suma al resumen lo que han cambiado las filas de `before` ({(pokemon_id, is_shiny): cantidad previa,
+    o None si la fila no existía}). Va en la misma transacción que el cambio, ya escrito en collection.
+    Solo lee las filas de esas especies (más el #201 y todos los Unown si entra alguno, que cuentan juntos):
+    con eso el antes y el después de cada contador se calculan igual que en el recálculo completo.
+    """
+    if not before:
+        return
+
+    # Bloquea la fila del resumen: dos entregas a la vez al mismo usuario aplican su delta de una en una
+    lock = " FOR UPDATE" if DATABASE_URL else ""
+    exists = query_db(f"SELECT 1 FROM user_collection_summary WHERE user_id = ?{lock}", (user_id,), one=True)
+    if not exists:
+        # Usuario de antes del resumen: relleno completo (ya incluye este cambio)
+        refresh_user_collection_summary(user_id, overwrite=False)
+        return
+
+    species = {p for p, _ in before}
+    unown_group = any(p == 201 or p > 20000 for p in species)
+    if unown_group:
+        species.add(201)
+    sql = (f"SELECT pokemon_id, is_shiny, quantity FROM collection WHERE user_id = ? "
+           f"AND (pokemon_id IN ({', '.join(['?'] * len(species))})" + (" OR pokemon_id > 20000)" if unown_group else ")"))
+    after_rows = query_db(sql, tuple([user_id] + sorted(species))) or []
+
+    before_rows = {(row[0], row[1]): row[2] for row in after_rows}
+    for key, quantity in before.items():
+        if quantity is None:
+            before_rows.pop(key, None)
+        else:
+            before_rows[key] = quantity
+
+    old = _compute_collection_summary([(p, s, q) for (p, s), q in before_rows.items()])
+    new = _compute_collection_summary(after_rows)
+    deltas = {col: new[col] - old[col] for col in _SUMMARY_COLUMNS if new[col] != old[col]}
+    if deltas:
+        query_db(f"UPDATE user_collection_summary SET {', '.join(f'{col} = {col} + ?' for col in deltas)} "
+                 f"WHERE user_id = ?", tuple(list(deltas.values()) + [user_id]))
+
+
+def get_user_collection_summary(user_id):
+    """Resumen de la colección con una sola lectura por clave primaria (dict con 'rarity_counts' incluido)."""
+    res = query_db(f"SELECT {', '.join(_SUMMARY_COLUMNS)} FROM user_collection_summary WHERE user_id = ?",
+                   (user_id,), one=True, dict_cursor=True)
+    if res:
+        return _summary_with_rarities(res)
+    # Usuario de antes del resumen: lo calculamos una vez y queda guardado
+    return refresh_user_collection_summary(user_id, overwrite=False)
 
 
 def get_user_duplicates(user_id, region_ids=None):
@@ -665,16 +1945,26 @@ def check_trade_daily_limit(user_id):
 
 
 def execute_trade(user_a, pokemon_a, is_shiny_a, user_b, pokemon_b, is_shiny_b):
-    query_db("UPDATE collection SET quantity = quantity - 1 WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-             (user_a, pokemon_a, int(is_shiny_a)))
-
-    query_db("UPDATE collection SET quantity = quantity - 1 WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ?",
-             (user_b, pokemon_b, int(is_shiny_b)))
-
-    status_a = add_sticker_smart(user_a, pokemon_b, is_shiny_b)
-    status_b = add_sticker_smart(user_b, pokemon_a, is_shiny_a)
-
-    query_db("UPDATE users SET daily_trades = daily_trades + 1 WHERE user_id IN (?, ?)", (user_a, user_b))
+    # Todo o nada: si algo falla a mitad, nadie pierde su sticker
+    with transaction():
+        before_a, before_b = {}, {}
+        for uid, p_id, shiny, before in ((user_a, pokemon_a, is_shiny_a, before_a),
+                                         (user_b, pokemon_b, is_shiny_b, before_b)):
+            res = query_db("UPDATE collection SET quantity = quantity - 1 "
+                           "WHERE user_id = ? AND pokemon_id = ? AND is_shiny = ? RETURNING quantity + 1",
+                           (uid, p_id, int(shiny)), one=True)
+            # Solo cambia el resumen si se queda sin él (tenía 1)
+            if res and res[0] <= 1:
+                before[(int(p_id), int(shiny))] = res[0]
+
+        status_a = _grant_sticker(user_a, pokemon_b, is_shiny_b, before_a)
+        status_b = _grant_sticker(user_b, pokemon_a, is_shiny_a, before_b)
+
+        query_db("UPDATE users SET daily_trades = daily_trades + 1 WHERE user_id IN (?, ?)", (user_a, user_b))
+
+        # Ambos pueden ganar un sticker nuevo y quedarse sin el que dan: delta en los dos resúmenes
+        for uid, before in sorted(((user_a, before_a), (user_b, before_b)), key=lambda item: item[0]):
+            _apply_summary_delta(uid, before)
 
     return status_a, status_b
 
@@ -831,6 +2121,30 @@ def set_delibird_claimed(user_id):
     query_db("UPDATE users SET last_delibird_claim = ? WHERE user_id = ?", (current_week, user_id))
 
 
+# Columna de "álbum completado" de cada región
+ALBUM_COMPLETION_FLAGS = {
+    'kanto': 'kanto_completed',
+    'johto': 'johto_completed',
+    'hoenn': 'hoenn_completed',
+    'unown': 'unown_completed',
+}
+
+
+def grant_album_reward(user_id, region, money, item_id):
+    """
+    Marca el álbum de la región como completado y entrega el premio (dinero + sobre) en UNA transacción.
+    Devuelve True solo si se ha concedido ahora; si ya estaba marcado no paga dos veces.
+    """
+    flag = ALBUM_COMPLETION_FLAGS[region]
+    with transaction():
+        updated = query_db(f"UPDATE users SET {flag} = 1 WHERE user_id = ? AND COALESCE({flag}, 0) = 0", (user_id,))
+        if not updated:
+            return False
+        update_money(user_id, money)
+        add_item_to_inventory(user_id, item_id, 1)
+    return True
+
+
 def is_johto_completed_by_user(user_id):
     res = query_db("SELECT johto_completed FROM users WHERE user_id = ?", (user_id,), one=True)
     return res[0] if res else 0
@@ -843,26 +2157,9 @@ def set_johto_completed_by_user(user_id):
 def get_user_unique_johto_count(user_id):
     """
     Cuenta cuántos Pokémon de Johto tiene el jugador INDIVIDUALMENTE.
-    Debe llegar a 100 (incluyendo bebés y al menos 1 Unown).
+    Debe llegar a 100 (incluyendo bebés y al menos 1 Unown, por el Efecto Espejo).
     """
-    # 1. Contamos los de Johto (del 152 al 251), excluyendo al 201 base
-    # (Aquí SÍ contamos a los bebés porque el jugador puede criarlos)
-    res = query_db("""
-        SELECT COUNT(DISTINCT pokemon_id) 
-        FROM collection 
-        WHERE user_id = %s 
-        AND pokemon_id >= 152 AND pokemon_id <= 251
-        AND pokemon_id != 201
-    """, (user_id,), one=True)
-    count = res[0] if res else 0
-
-    # 2. Efecto Espejo Unown: Si tiene CUALQUIERA de los 28 Unown (>20000)
-    # le sumamos el Unown #201 al conteo total de Johto.
-    has_unown = query_db("SELECT 1 FROM collection WHERE user_id = %s AND pokemon_id > 20000 LIMIT 1", (user_id,), one=True)
-    if has_unown:
-        count += 1
-
-    return count
+    return get_user_collection_summary(user_id)['johto_count']
 
 def is_hoenn_completed_by_user(user_id):
     res = query_db("SELECT hoenn_completed FROM users WHERE user_id = %s", (user_id,), one=True)
@@ -872,40 +2169,38 @@ def set_hoenn_completed_by_user(user_id):
     query_db("UPDATE users SET hoenn_completed = 1 WHERE user_id = %s", (user_id,))
 
 def get_user_unique_hoenn_count(user_id):
-    res = query_db("""
-        SELECT COUNT(DISTINCT pokemon_id) 
-        FROM collection 
-        WHERE user_id = %s 
-        AND pokemon_id >= 252 AND pokemon_id <= 386
-        AND pokemon_id NOT IN (298, 360) -- Excluimos Azurill y Wynaut (Bebés)
-    """, (user_id,), one=True)
-    return res[0] if res else 0
+    # Sin Azurill ni Wynaut (bebés)
+    return get_user_collection_summary(user_id)['hoenn_count']
 
 
 # --- TÓMBOLA Y SPAWNS PERSISTENTES ---
 
 def get_tombola_state(chat_id):
-    res = query_db("SELECT msg_id, winners FROM tombola_state WHERE chat_id = %s", (chat_id,), one=True,
-                   dict_cursor=True)
+    res = query_db("SELECT msg_id FROM tombola_state WHERE chat_id = %s", (chat_id,), one=True, dict_cursor=True)
     if res:
-        try:
-            # Intentamos leer la lista de ganadores. Si hay algo raro guardado en Supabase (None, "", etc.)
-            # el except lo cazará y pondrá una lista vacía en lugar de colgar el bot.
-            res['winners'] = json.loads(res['winners']) if res['winners'] else []
-        except Exception:
-            res['winners'] = []
-
+        rows = query_db("SELECT line FROM tombola_winners WHERE chat_id = %s ORDER BY claimed_at", (chat_id,))
+        res['winners'] = [row[0] for row in rows]
         return res
     return None
 
 
-def set_tombola_state(chat_id, msg_id, winners):
-    winners_json = json.dumps(winners)
+def set_tombola_state(chat_id, msg_id, reset_winners=False):
+    """Guarda el mensaje de la tómbola del chat. Con reset_winners=True empieza la lista del día de cero."""
     sql = """
-        INSERT INTO tombola_state (chat_id, msg_id, winners) VALUES (%s, %s, %s)
-        ON CONFLICT (chat_id) DO UPDATE SET msg_id = EXCLUDED.msg_id, winners = EXCLUDED.winners
+        INSERT INTO tombola_state (chat_id, msg_id) VALUES (%s, %s)
+        ON CONFLICT (chat_id) DO UPDATE SET msg_id = EXCLUDED.msg_id
     """
-    query_db(sql, (chat_id, msg_id, winners_json))
+    query_db(sql, (chat_id, msg_id))
+    if reset_winners:
+        query_db("DELETE FROM tombola_winners WHERE chat_id = %s", (chat_id,))
+
+
+def add_tombola_winner(chat_id, user_id, line):
+    """Añade la línea de un ganador a la tómbola del chat (una sola inserción, sin reescribir la lista)."""
+    query_db("""
+        INSERT INTO tombola_winners (chat_id, user_id, line, claimed_at) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET line = EXCLUDED.line, claimed_at = EXCLUDED.claimed_at
+    """, (chat_id, user_id, line, time.time()))
 
 def add_active_spawn(message_id, chat_id, sticker_id, spawn_time):
     sql = "INSERT INTO active_spawns (message_id, chat_id, sticker_id, spawn_time) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING"
@@ -917,6 +2212,14 @@ def get_active_spawn(message_id):
 def remove_active_spawn(message_id):
     query_db("DELETE FROM active_spawns WHERE message_id = %s", (message_id,))
 
+def claim_active_spawn(message_id):
+    """
+    Reclama un spawn de forma atómica: lo borra y devuelve sus datos en una sola sentencia.
+    Si dos personas pulsan a la vez, solo una recibe la fila; la otra recibe None.
+    """
+    return query_db("DELETE FROM active_spawns WHERE message_id = %s RETURNING sticker_id, chat_id",
+                    (message_id,), one=True, dict_cursor=True)
+
 def clean_old_spawns():
     import time
     limit = time.time() - 259200 # Borra los Pokémon de hace 3 días
@@ -944,16 +2247,28 @@ def add_active_safari(message_id, chat_id, sticker_id, pokemon_id, is_shiny, rar
 def get_active_safari(message_id):
     res = query_db("SELECT * FROM active_safaris WHERE message_id = %s", (message_id,), one=True, dict_cursor=True)
     if res:
-        res['participants'] = json.loads(res['participants'])
+        rows = query_db("SELECT user_id, first_name FROM safari_participants WHERE message_id = %s "
+                        "ORDER BY joined_at", (message_id,))
+        res['participants'] = [{'id': row[0], 'first_name': row[1]} for row in rows]
         res['job_started'] = bool(res['job_started'])
     return res
 
-def update_safari_participants(message_id, participants, job_started):
-    sql = "UPDATE active_safaris SET participants = %s, job_started = %s WHERE message_id = %s"
-    query_db(sql, (json.dumps(participants), int(job_started), message_id))
+def add_safari_participant(message_id, user_id, first_name):
+    """Apunta a un jugador al safari. Devuelve False si ya estaba apuntado."""
+    count = query_db("INSERT INTO safari_participants (message_id, user_id, first_name, joined_at) "
+                     "VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                     (message_id, user_id, first_name, time.time()))
+    return bool(count)
+
+def mark_safari_job_started(message_id):
+    """Marca que el reloj del safari ya corre. Solo devuelve True a quien lo arranca de verdad."""
+    count = query_db("UPDATE active_safaris SET job_started = 1 WHERE message_id = %s AND job_started = 0",
+                     (message_id,))
+    return bool(count)
 
 def remove_active_safari(message_id):
     query_db("DELETE FROM active_safaris WHERE message_id = %s", (message_id,))
+    query_db("DELETE FROM safari_participants WHERE message_id = %s", (message_id,))
 
 
 # --- SISTEMA DE GUARDERÍA (HUEVOS) ---
@@ -988,15 +2303,30 @@ def add_scheduled_event(date_str, region):
         query_db("INSERT INTO scheduled_events (event_date, region) VALUES (%s, %s) ON CONFLICT (event_date) DO UPDATE SET region = EXCLUDED.region", (date_str, region))
     else:
         query_db("INSERT OR REPLACE INTO scheduled_events (event_date, region) VALUES (?, ?)", (date_str, region))
+    with _chat_state_lock:
+        _bump_chat_state()
+        _scheduled_event_cache[date_str] = region
 
 def get_scheduled_event(date_str):
-    """Comprueba si hay un evento hoy."""
+    """Comprueba si hay un evento hoy (la respuesta de cada día se recuerda, también la de 'no hay')."""
+    with _chat_state_lock:
+        if date_str in _scheduled_event_cache:
+            return _scheduled_event_cache[date_str]
+        gen = _chat_state_gen
+
     res = query_db("SELECT region FROM scheduled_events WHERE event_date = ?", (date_str,), one=True)
-    return res[0] if res else None
+    region = res[0] if res else None
+    with _chat_state_lock:
+        if gen == _chat_state_gen:
+            _scheduled_event_cache[date_str] = region
+    return region
 
 def clean_old_scheduled_events(date_str):
     """Borra eventos pasados para limpiar la BD."""
     query_db("DELETE FROM scheduled_events WHERE event_date < ?", (date_str,))
+    with _chat_state_lock:
+        for old_date in [d for d in _scheduled_event_cache if d < date_str]:
+            del _scheduled_event_cache[old_date]
 
 def set_codes_board_msg(chat_id, message_id):
     """Guarda la ID del mensaje del tablón fijo de códigos de un grupo."""
@@ -1012,30 +2342,23 @@ def get_codes_board_msg(chat_id):
 
 def check_event_button_claim(chat_id, event_id, user_id):
     """Comprueba si un usuario ya ha pulsado un botón persistente de evento."""
-    res = query_db("SELECT claim_list FROM group_events WHERE chat_id = %s AND event_id = %s", (chat_id, event_id), one=True)
-    if res and res[0]:
-        claim_list = json.loads(res[0])
-        return user_id in claim_list
-    return False
+    res = query_db("SELECT 1 FROM group_event_claims WHERE chat_id = %s AND event_id = %s AND user_id = %s",
+                   (chat_id, event_id, user_id), one=True)
+    return res is not None
 
 
 def add_event_button_claim(chat_id, event_id, user_id):
-    """Registra que un usuario ha pulsado el botón del evento, creándolo si no existía."""
-    res = query_db("SELECT claim_list FROM group_events WHERE chat_id = %s AND event_id = %s", (chat_id, event_id),
-                   one=True)
-
-    if res and res[0]:
-        claim_list = json.loads(res[0])
-    else:
-        # SI NO EXISTE EL EVENTO (Por ser un mensaje antiguo), lo creamos sobre la marcha en Supabase
-        claim_list = []
-        query_db("INSERT INTO group_events (chat_id, event_id, completed) VALUES (%s, %s, 1) ON CONFLICT DO NOTHING",
-                 (chat_id, event_id))
-
-    if user_id not in claim_list:
-        claim_list.append(user_id)
-        query_db("UPDATE group_events SET claim_list = %s WHERE chat_id = %s AND event_id = %s",
-                 (json.dumps(claim_list), chat_id, event_id))
+    """
+    Registra que un usuario ha pulsado el botón del evento, creándolo si no existía.
+    Devuelve False si ya lo había pulsado antes (sirve también como comprobación atómica).
+    """
+    # SI NO EXISTE EL EVENTO (Por ser un mensaje antiguo), lo creamos sobre la marcha
+    query_db("INSERT INTO group_events (chat_id, event_id, completed) VALUES (%s, %s, 1) ON CONFLICT DO NOTHING",
+             (chat_id, event_id))
+    _cache_event_flag(chat_id, event_id, True)
+    count = query_db("INSERT INTO group_event_claims (chat_id, event_id, user_id) VALUES (%s, %s, %s) "
+                     "ON CONFLICT DO NOTHING", (chat_id, event_id, user_id))
+    return bool(count)
 
 
 # --- SISTEMA EVENTO JIRACHI ---
@@ -1059,5 +2382,97 @@ def clear_jirachi_schedule(chat_id):
     query_db("DELETE FROM system_flags WHERE flag_name = ?", (f"jirachi_sched_{chat_id}",))
 
 
-# Iniciar la DB
-init_db()
+# --- REGISTRO DE FILE_ID DE STICKERS ---
+def get_sticker_file_ids():
+    """Todo el registro: {ruta: (hash_contenido, file_id)}."""
+    rows = query_db("SELECT path, content_hash, file_id FROM sticker_file_ids")
+    return {row[0]: (row[1], row[2]) for row in rows or []}
+
+
+def set_sticker_file_id(path, content_hash, file_id):
+    """Guarda (o sustituye) el file_id que devolvió Telegram al subir esa imagen."""
+    query_db("INSERT INTO sticker_file_ids (path, content_hash, file_id, updated_at) VALUES (?, ?, ?, ?) "
+             "ON CONFLICT (path) DO UPDATE SET content_hash = excluded.content_hash, file_id = excluded.file_id, "
+             "updated_at = excluded.updated_at", (path, content_hash, file_id, time.time()))
+
+
+def delete_sticker_file_id(path):
+    query_db("DELETE FROM sticker_file_ids WHERE path = ?", (path,))
+
+
+# --- DIFUSIONES EN SEGUNDO PLANO ---
+# Cada /sendtoall es un trabajo con cursor (último user_id avisado): si el bot se reinicia, sigue por ahí.
+def create_broadcast_job(text, admin_chat_id):
+    """Crea la difusión (apuntando cuántos usuarios hay ahora) y devuelve su job_id."""
+    now = time.time()
+    total = query_db("SELECT COUNT(*) FROM users", one=True)[0]
+    row = query_db("INSERT INTO broadcast_jobs (text, total, admin_chat_id, created_at, updated_at) "
+                   "VALUES (?, ?, ?, ?, ?) RETURNING job_id", (text, total, admin_chat_id, now, now), one=True)
+    return row[0]
+
+
+def set_broadcast_progress_msg(job_id, message_id):
+    query_db("UPDATE broadcast_jobs SET progress_msg_id = ? WHERE job_id = ?", (message_id, job_id))
+
+
+def get_broadcast_job(job_id):
+    return query_db("SELECT * FROM broadcast_jobs WHERE job_id = ?", (job_id,), one=True, dict_cursor=True)
+
+
+def get_unfinished_broadcast_jobs():
+    return query_db("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id", dict_cursor=True)
+
+
+def get_broadcast_recipients(after_user_id, limit):
+    """Siguiente página de destinatarios: [(user_id, quiere_notificaciones)] ordenada por user_id."""
+    rows = query_db("SELECT user_id, COALESCE(notifications_enabled, 1) FROM users WHERE user_id > ? "
+                    "ORDER BY user_id LIMIT ?", (after_user_id, limit))
+    return [(row[0], row[1] != 0) for row in rows or []]
+
+
+def advance_broadcast_job(job_id, last_user_id, sent, skipped, failed):
+    """Mueve el cursor tras una página y suma sus contadores."""
+    query_db("UPDATE broadcast_jobs SET last_user_id = ?, sent = sent + ?, skipped = skipped + ?, "
+             "failed = failed + ?, updated_at = ? WHERE job_id = ?",
+             (last_user_id, sent, skipped, failed, time.time(), job_id))
+
+
+def finish_broadcast_job(job_id, status='done'):
+    query_db("UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id))
+
+
+# --- PLANIFICADOR DE APARICIONES ---
+# La próxima aparición de cada grupo vive en groups.next_spawn_at: al reiniciar se sigue con la misma hora.
+def get_spawn_schedule():
+    """{chat_id: next_spawn_at o None} de los grupos activos."""
+    rows = query_db("SELECT chat_id, next_spawn_at FROM groups WHERE is_active = 1")
+    return {row[0]: row[1] for row in rows or []}
+
+
+def set_next_spawn(chat_id, timestamp):
+    query_db("UPDATE groups SET next_spawn_at = ? WHERE chat_id = ?",
+             (int(timestamp) if timestamp is not None else None, chat_id))
+
+
+def rescale_next_spawns(now, factor):
+    """Multiplica por `factor` el tiempo que le queda a cada aparición pendiente (al cambiar el ritmo global)."""
+    query_db("UPDATE groups SET next_spawn_at = ? + CAST((next_spawn_at - ?) * ? AS INTEGER) "
+             "WHERE is_active = 1 AND next_spawn_at > ?", (int(now), int(now), factor, int(now)))
+
+
+def get_spawn_rate_percent():
+    """Ritmo global de apariciones en % (100 = normal, 200 = el doble de apariciones)."""
+    res = query_db("SELECT value FROM system_flags WHERE flag_name = 'spawn_rate_percent'", one=True)
+    return res[0] if res and res[0] else 100
+
+
+def set_spawn_rate_percent(percent):
+    if DATABASE_URL:
+        sql = """
+        INSERT INTO system_flags (flag_name, value) VALUES ('spawn_rate_percent', %s)
+        ON CONFLICT (flag_name) DO UPDATE SET value = EXCLUDED.value;
+        """
+    else:
+        sql = "INSERT OR REPLACE INTO system_flags (flag_name, value) VALUES ('spawn_rate_percent', ?)"
+
+    query_db(sql, (int(percent),))
@@ -442,3 +442,11 @@ ALL_POKEMON_PACKS = [p for p in ALL_POKEMON if p['id'] not in EXCLUDED_FROM_PACK
 # 2. EXCLUIDOS DE SALVAJES (Todo lo anterior + Legendarios por desbloquear)
 EXCLUDED_FROM_WILD = set(BABY_IDS + UNOWN_BASE_ID + UNOWN_IDS + LEGENDARY_JOHTO_IDS + LEGENDARY_HOENN_IDS + JIRACHI_ID)
 ALL_POKEMON_SPAWNABLE = [p for p in ALL_POKEMON if p['id'] not in EXCLUDED_FROM_WILD]
+
+# --- SISTEMA DE FORMAS MULTIPLES (Hoenn) ---
+# Mapeo: Forma A (0,1), Forma B (2,3), Forma C (4,5), Forma D (6,7)
+POKEMON_FORMS = {
+    351: {0: ('A', 'Normal'), 2: ('B', 'Soleado'), 4: ('C', 'Lluvia'), 6: ('D', 'Nieve')},
+    352: {0: ('A', 'Normal'), 2: ('B', 'Camuflaje')},
+    386: {0: ('A', 'Normal'), 2: ('B', 'Ataque'), 4: ('C', 'Defensa'), 6: ('D', 'Velocidad')}
+}
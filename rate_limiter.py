@@ -0,0 +1,228 @@
+# rate_limiter.py
+"""
+Control de envíos a la API de Telegram para TODO el bot.
+
+Se engancha en la Application (`Application.builder().rate_limiter(PriorityRateLimiter())`), así que
+cualquier `context.bot.send_*` pasa por aquí sin tocar los handlers:
+- Cubetas de fichas: límite global (~30 mensajes/s) y por chat (grupos ~20/min, privados ~1/s).
+- Si Telegram responde RetryAfter, se para todo el tiempo que pida y se reintenta.
+- Prioridad: lo que responde a un jugador pasa delante de los trabajos de fondo (difusiones, tómbola,
+  rankings...). Un trabajo se marca como de fondo con @background_job o `with background_sends():`.
+- fan_out(): reparte un trabajo por chat (tómbola, avisos a grupos...) con concurrencia acotada,
+  sin que el fallo de un chat pare al resto, y deja en el log cuánto ha tardado.
+"""
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Prioridad de los envíos de la tarea actual (cada handler/job de PTB corre en su propia tarea)
+SEND_PRIORITY = contextvars.ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", 30))  # Mensajes por segundo en total
+GROUP_RATE = float(os.environ.get("TG_GROUP_RATE", 20 / 60))  # Mensajes por segundo en un grupo
+GROUP_BURST = float(os.environ.get("TG_GROUP_BURST", 10))  # Ráfaga permitida (abrir un sobre son varios stickers)
+PRIVATE_RATE = float(os.environ.get("TG_PRIVATE_RATE", 1))
+PRIVATE_BURST = float(os.environ.get("TG_PRIVATE_BURST", 3))
+FANOUT_CONCURRENCY = int(os.environ.get("TG_FANOUT_CONCURRENCY", 20))  # Chats atendidos a la vez por fan_out
+
+# Solo cuentan los métodos que publican algo en un chat; el resto (answerCallbackQuery, getChatMember...) pasa directo
+_LIMITED_PREFIXES = ('send', 'edit', 'forward', 'copy')
+
+
+@contextmanager
+def background_sends():
+    """Los envíos hechos dentro del bloque ceden el paso a los interactivos."""
+    token = SEND_PRIORITY.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        SEND_PRIORITY.reset(token)
+
+
+def background_job(func):
+    """Decorador para jobs: todos sus envíos son de fondo."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with background_sends():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class TokenBucket:
+    """Cubeta de fichas clásica: `rate` fichas por segundo, como mucho `capacity` acumuladas."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Segundos que faltan para que haya una ficha (0 si ya la hay)."""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        # Reservamos la ficha al momento (puede quedar en negativo) y dormimos lo que toque:
+        # así las peticiones del mismo chat salen en orden de llegada
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Limitador para python-telegram-bot. Cada petición limitada espera su ficha del chat,
+    y después se pone en la cola global (ordenada por prioridad y llegada) hasta tener ficha global.
+    """
+
+    def __init__(self, max_retries=3):
+        self.max_retries = max_retries
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._waiting = []  # heap de (prioridad, orden, futuro)
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0.0
+        self.stats = {'requests': 0, 'limited': 0, 'retry_after': 0, 'waited': 0.0}
+
+    async def initialize(self):
+        self._ensure_dispatcher()
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 5000:
+                # Tras una difusión quedan miles de cubetas: tiramos las que ya están llenas (chats en reposo)
+                for key in [k for k, b in self._chats.items() if b.wait_time() == 0 and b.tokens >= b.capacity]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, str) or chat_id < 0  # Grupos/canales: id negativo o @nombre
+            bucket = TokenBucket(GROUP_RATE, GROUP_BURST) if is_group else TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        """Reparte las fichas globales: siempre al primero de la cola (menor prioridad, luego el más antiguo)."""
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            delay = max(pause, self._global.wait_time())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():  # La petición se canceló mientras esperaba
+                continue
+            self._global.take()
+            future.set_result(None)
+
+    async def _acquire(self, chat_id, priority):
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        self._ensure_dispatcher()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._counter), future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.stats['requests'] += 1
+        limited = endpoint.lower().startswith(_LIMITED_PREFIXES)
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else SEND_PRIORITY.get()
+        chat_id = data.get('chat_id') if data else None
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                start = time.monotonic()
+                await self._acquire(chat_id, priority)
+                self.stats['limited'] += 1
+                self.stats['waited'] += time.monotonic() - start
+            else:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Telegram nos ha frenado: paramos TODOS los envíos lo que pida y reintentamos
+                self.stats['retry_after'] += 1
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after + 0.1)
+                logger.warning(f"⏳ RetryAfter de {retry_after}s en {endpoint} (chat {chat_id}), intento {attempt + 1}")
+                if attempt == self.max_retries:
+                    raise
+
+
+async def fan_out(name, chat_ids, worker, concurrency=FANOUT_CONCURRENCY):
+    """
+    Ejecuta `await worker(chat_id)` para cada chat, como mucho `concurrency` a la vez.
+    El ritmo real de envío lo marca el limitador; esto solo evita ir grupo a grupo en serie.
+    - Un fallo en un chat se registra y no afecta a los demás.
+    - No se repite el worker: los RetryAfter ya los reintenta el limitador petición a petición,
+      así que un worker de varios pasos (editar y enviar, enviar y guardar...) nunca duplica mensajes.
+    Devuelve {'total', 'ok', 'failed', 'elapsed', 'slowest': (chat_id, segundos)}.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    started = time.monotonic()
+    durations = {}
+    failed = []
+
+    async def run(chat_id):
+        async with semaphore:
+            t0 = time.monotonic()
+            try:
+                await worker(chat_id)
+            except Exception as e:
+                failed.append(chat_id)
+                logger.error(f"[{name}] Error en el chat {chat_id}: {e}")
+            finally:
+                durations[chat_id] = time.monotonic() - t0
+
+    await asyncio.gather(*(run(chat_id) for chat_id in chat_ids))
+
+    elapsed = time.monotonic() - started
+    slowest = max(durations.items(), key=lambda item: item[1]) if durations else (None, 0.0)
+    result = {'total': len(durations), 'ok': len(durations) - len(failed), 'failed': len(failed),
+              'elapsed': elapsed, 'slowest': slowest}
+    logger.info(f"📡 [{name}] {result['ok']}/{result['total']} chats en {elapsed:.1f}s "
+                f"({result['failed']} fallidos, el más lento {slowest[0]}: {slowest[1]:.1f}s)")
+    return result
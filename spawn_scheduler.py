@@ -0,0 +1,156 @@
+# spawn_scheduler.py
+"""
+Planificador de apariciones de Pokémon de TODOS los grupos.
+
+Antes cada grupo tenía su propio job `spawn_{chat_id}` con un retraso aleatorio que solo vivía en memoria:
+en cada reinicio se sorteaba otro de 2-4 h para todos, así que los redeploys dejaban a los grupos sin apariciones.
+Ahora:
+- La hora de la próxima aparición de cada grupo se guarda en groups.next_spawn_at.
+- Un único montículo (heap) en memoria ordena todos los grupos y un solo job repetitivo lo revisa cada pocos
+  segundos (bot.py lanza la aparición de los que ya toquen).
+- Al arrancar se cargan las horas guardadas: las futuras se respetan tal cual y las que vencieron con el bot
+  apagado se reparten en los primeros minutos (para no lanzar cientos de apariciones a la vez).
+- El ritmo global (en %, 100 = normal) escala todos los intervalos; se ve y se cambia con /spawnrate.
+"""
+import heapq
+import logging
+import random
+import time
+from collections import deque
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+class SpawnScheduler:
+
+    def __init__(self, min_delay, max_delay, catchup_window=600, running_timeout=900):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.catchup_window = catchup_window  # Segundos en los que se reparten las apariciones atrasadas
+        self.running_timeout = running_timeout  # Una aparición "en curso" más tiempo que esto se da por perdida
+        self.rate_percent = 100
+        self.loaded = False
+        self._heap = []  # (hora, chat_id); las entradas reprogramadas se quedan y se ignoran al salir
+        self._due = {}  # chat_id -> hora vigente
+        self._running = {}  # chat_id -> cuándo empezó su aparición (se reprograma al terminar)
+        self._fired = deque()  # Horas de las apariciones lanzadas en la última hora
+
+    def next_delay(self):
+        """Segundos hasta la siguiente aparición de un grupo, con el ritmo global aplicado."""
+        return random.randint(self.min_delay, self.max_delay) * 100 / self.rate_percent
+
+    def _push(self, chat_id, due):
+        due = int(due)
+        self._due[chat_id] = due
+        heapq.heappush(self._heap, (due, chat_id))
+
+    async def load(self):
+        """Carga las horas guardadas de los grupos activos. Devuelve cuántos se reanudan/recuperan/estrenan."""
+        self.rate_percent = await db.aio.get_spawn_rate_percent()
+        schedule = await db.aio.get_spawn_schedule()
+        now = time.time()
+        counts = {'resumed': 0, 'overdue': 0, 'new': 0}
+
+        for chat_id, due in schedule.items():
+            if due is None:
+                # Grupo sin hora guardada (primer arranque con el planificador)
+                due = now + self.next_delay()
+                await db.aio.set_next_spawn(chat_id, due)
+                counts['new'] += 1
+            elif due <= now:
+                # Le tocaba mientras el bot estaba apagado: sale pronto, pero repartido
+                due = now + random.uniform(0, self.catchup_window)
+                counts['overdue'] += 1
+            else:
+                counts['resumed'] += 1
+            self._push(chat_id, due)
+
+        self.loaded = True
+        return counts
+
+    async def schedule(self, chat_id, delay=None):
+        """
+        Programa (o reprograma) la próxima aparición del grupo. Devuelve el retraso usado.
+        Primero se guarda en la BD; si eso falla, se programa igualmente en memoria (el grupo no se
+        queda sin apariciones) y el error sube para que quien llama se entere.
+        """
+        if delay is None:
+            delay = self.next_delay()
+        due = time.time() + delay
+        try:
+            await db.aio.set_next_spawn(chat_id, due)
+        finally:
+            self._running.pop(chat_id, None)
+            self._push(chat_id, due)
+        return delay
+
+    def reschedule_in_memory(self, chat_id, delay=None):
+        """Plan B sin BD: el grupo sigue en el heap con el retraso normal (la hora guardada queda atrás)."""
+        self._running.pop(chat_id, None)
+        self._push(chat_id, time.time() + (self.next_delay() if delay is None else delay))
+
+    async def cancel(self, chat_id):
+        """Quita al grupo del planificador (/stop, baneo...). Su entrada del heap se descarta sola."""
+        self._due.pop(chat_id, None)
+        self._running.pop(chat_id, None)
+        await db.aio.set_next_spawn(chat_id, None)
+
+    def is_scheduled(self, chat_id):
+        return chat_id in self._due or chat_id in self._running
+
+    def is_running(self, chat_id):
+        """¿Tiene la aparición en curso (sacada del heap y todavía sin reprogramar)?"""
+        return chat_id in self._running
+
+    def pop_due(self, now=None):
+        """Saca los grupos a los que ya les toca. Quedan 'en curso' hasta que se llame a schedule/cancel."""
+        now = now or time.time()
+
+        # Apariciones que nunca se reprogramaron (la tarea murió a medias): vuelven al heap
+        for chat_id, started in list(self._running.items()):
+            if now - started > self.running_timeout:
+                logger.warning(f"🌿 La aparición del chat {chat_id} no se reprogramó en "
+                               f"{self.running_timeout}s: se vuelve a programar.")
+                self.reschedule_in_memory(chat_id)
+
+        due_chats = []
+        while self._heap and self._heap[0][0] <= now:
+            due, chat_id = heapq.heappop(self._heap)
+            if self._due.get(chat_id) != due:
+                continue  # Entrada vieja (el grupo se reprogramó o se canceló)
+            del self._due[chat_id]
+            self._running[chat_id] = now
+            self._fired.append(now)
+            due_chats.append(chat_id)
+        return due_chats
+
+    async def set_rate(self, percent):
+        """Cambia el ritmo global. Las apariciones pendientes se acercan/alejan en la misma proporción."""
+        factor = self.rate_percent / percent
+        now = time.time()
+        await db.aio.set_spawn_rate_percent(percent)
+        await db.aio.rescale_next_spawns(now, factor)
+        self.rate_percent = percent
+        for chat_id, due in list(self._due.items()):
+            if due > now:
+                self._push(chat_id, now + int((due - now) * factor))
+
+    def stats(self):
+        now = time.time()
+        while self._fired and self._fired[0] < now - 3600:
+            self._fired.popleft()
+        groups = len(self._due) + len(self._running)
+        mean_delay = (self.min_delay + self.max_delay) / 2 * 100 / self.rate_percent
+        upcoming = min(self._due.values()) if self._due else None
+        return {
+            'groups': groups,
+            'running': len(self._running),
+            'rate_percent': self.rate_percent,
+            'mean_delay': mean_delay,
+            'expected_per_hour': groups * 3600 / mean_delay,
+            'fired_last_hour': len(self._fired),
+            'next_in': max(0, upcoming - now) if upcoming is not None else None,
+            'due_next_hour': sum(1 for due in self._due.values() if due <= now + 3600),
+        }
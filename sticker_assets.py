@@ -0,0 +1,169 @@
+# sticker_assets.py
+"""
+Inventario de las imágenes de Stickers/.
+
+Recorre el catálogo (todas las combinaciones que puede pedir get_image_path: normal/shiny y cada forma),
+comprueba que el fichero existe y apunta tamaño + hash. También avisa de los ficheros que sobran.
+
+Además genera las variantes WebP de 512 px que envía el bot (get_image_path las prefiere si existen).
+Es un paso de build: necesita Pillow (pip install Pillow), el bot no.
+
+Uso desde consola (escribe Stickers/manifest.json y sale con error si falta alguna imagen):
+    python sticker_assets.py            # solo el manifiesto
+    python sticker_assets.py --webp     # genera/actualiza los WebP y después el manifiesto
+"""
+import json
+import os
+import sys
+import time
+
+from pokemon_data import ALL_POKEMON, POKEMON_FORMS, UNOWN_BASE_ID
+from bot_utils import get_image_path, content_hash, load_webp_index, resolve_sticker_file, WEBP_INDEX_PATH
+
+STICKERS_DIR = "Stickers"
+MANIFEST_PATH = os.path.join(STICKERS_DIR, "manifest.json")
+IMAGE_EXTENSIONS = ('.png',)
+
+WEBP_DIR = os.path.dirname(WEBP_INDEX_PATH)
+WEBP_SIZE = 512  # Lado mayor de un sticker estático de Telegram
+WEBP_QUALITY = 85
+
+
+def iter_catalog_images():
+    """(pokemon_id, valor_forma, ruta) de cada imagen que el bot puede llegar a enviar."""
+    for pokemon in ALL_POKEMON:
+        p_id = pokemon['id']
+        # El #201 del Álbumdex solo redirige a la sección Unown: nunca se envía como sticker
+        if p_id in UNOWN_BASE_ID:
+            continue
+        form_offsets = sorted(POKEMON_FORMS[p_id]) if p_id in POKEMON_FORMS else [0]
+        for offset in form_offsets:
+            for shiny in (0, 1):
+                yield p_id, offset + shiny, get_image_path(p_id, offset + shiny, prefer_webp=False)
+
+
+def build_manifest():
+    """
+    Devuelve {'generated_at', 'files': {ruta: {'pokemon_id', 'value', 'size', 'hash'}},
+    'missing': [rutas del catálogo sin fichero], 'unused': [ficheros que el catálogo no usa]}.
+    """
+    files, missing = {}, []
+    for p_id, value, path in iter_catalog_images():
+        if path in files or path in missing:
+            continue
+        try:
+            files[path] = {'pokemon_id': p_id, 'value': value, 'size': os.path.getsize(path),
+                           'hash': content_hash(path)}
+        except FileNotFoundError:
+            missing.append(path)
+
+    unused = []
+    for folder, _, names in os.walk(STICKERS_DIR):
+        for name in names:
+            path = os.path.join(folder, name).replace(os.sep, '/')
+            if name.lower().endswith(IMAGE_EXTENSIONS) and path not in files:
+                unused.append(path)
+
+    return {'generated_at': time.time(), 'files': files, 'missing': missing, 'unused': sorted(unused)}
+
+
+def sent_file_hashes(png_paths):
+    """
+    {fichero que se envía de verdad (el WebP si está generado): hash} de esos PNG.
+    Lee ficheros enteros: el bot lo llama en el executor, y de paso deja los hashes en caché.
+    """
+    hashes = {}
+    for png_path in png_paths:
+        path = resolve_sticker_file(png_path)
+        try:
+            hashes[path] = content_hash(path)
+        except FileNotFoundError:
+            continue
+    return hashes
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """El manifiesto guardado, o None si todavía no se ha generado."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build_webp_variants(force=False):
+    """
+    Convierte cada PNG del catálogo a WebP de WEBP_SIZE px. La caché va por hash del PNG:
+    si Stickers/webp/<hash>.webp ya existe no se vuelve a convertir (force=True lo rehace todo).
+    Solo entra en el índice la variante que pese menos que su PNG.
+    Devuelve {'built', 'cached', 'skipped', 'saved_bytes'}.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Para generar los WebP hace falta Pillow: pip install Pillow")
+
+    os.makedirs(WEBP_DIR, exist_ok=True)
+    index, stats = {}, {'built': 0, 'cached': 0, 'skipped': 0, 'saved_bytes': 0}
+    keep = set()
+
+    for _, _, png_path in iter_catalog_images():
+        if png_path in index:
+            continue
+        try:
+            src_hash = content_hash(png_path)
+        except FileNotFoundError:
+            continue
+
+        webp_path = f"{WEBP_DIR}/{src_hash}.webp"
+        keep.add(webp_path)
+        if force or not os.path.exists(webp_path):
+            with Image.open(png_path) as img:
+                img = img.convert('RGBA')
+                scale = WEBP_SIZE / max(img.size)
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                                 Image.LANCZOS)
+                img.save(webp_path, 'WEBP', quality=WEBP_QUALITY, method=6)
+            stats['built'] += 1
+        else:
+            stats['cached'] += 1
+
+        png_size, webp_size = os.path.getsize(png_path), os.path.getsize(webp_path)
+        if webp_size >= png_size:
+            stats['skipped'] += 1
+            continue
+        stats['saved_bytes'] += png_size - webp_size
+        index[png_path] = {'hash': src_hash, 'webp': webp_path, 'size': webp_size}
+
+    # WebP de versiones antiguas de las imágenes: ya no los apunta nadie
+    for name in os.listdir(WEBP_DIR):
+        path = f"{WEBP_DIR}/{name}"
+        if name.endswith('.webp') and path not in keep:
+            os.remove(path)
+
+    with open(WEBP_INDEX_PATH, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    load_webp_index(reload=True)
+    return stats
+
+
+if __name__ == '__main__':
+    if '--webp' in sys.argv[1:]:
+        result = build_webp_variants(force='--force' in sys.argv[1:])
+        print(f"🖼️ WebP: {result['built']} nuevos, {result['cached']} en caché, {result['skipped']} descartados "
+              f"(no ahorraban), {result['saved_bytes'] / 1024 / 1024:.1f} MB menos -> {WEBP_INDEX_PATH}")
+
+    manifest = build_manifest()
+    save_manifest(manifest)
+    total_size = sum(info['size'] for info in manifest['files'].values())
+    print(f"🗂️ {len(manifest['files'])} imágenes ({total_size / 1024 / 1024:.1f} MB) -> {MANIFEST_PATH}")
+    for path in manifest['missing']:
+        print(f"❌ Falta: {path}")
+    for path in manifest['unused']:
+        print(f"⚠️ Sin usar: {path}")
+    sys.exit(1 if manifest['missing'] else 0)